@@ -4,6 +4,8 @@ from celery import Celery
 
 from ._version import get_versions
 from .conf import playground
+from . import blobs  # noqa: F401  (registers the blob-pickle serializer)
+from . import condor
 from . import email
 from . import lvalert
 from . import sentry
@@ -18,7 +20,8 @@ del get_versions
 app = Celery(__name__, broker='redis://', autofinalize=False)
 """Celery application object."""
 
-# Register email, LVAlert and VOEvent subsystems.
+# Register HTCondor, email, LVAlert and VOEvent subsystems.
+condor.install(app)
 email.install(app)
 lvalert.install(app)
 voevent.install(app)
@@ -36,4 +39,9 @@ app.config_from_envvar('CELERY_CONFIG_MODULE', silent=True)
 # Use the same URL for both the result backend and the broker.
 app.conf['result_backend'] = app.conf.broker_url
 
+# Move large byte strings to the blob store, if one is configured.
+if app.conf['blob_store']:
+    app.conf['result_serializer'] = app.conf['task_serializer'] = \
+        'blob-pickle'
+
 sentry.configure()
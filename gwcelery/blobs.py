@@ -0,0 +1,214 @@
+"""Content-addressed storage for large byte strings passed between tasks.
+
+Sky maps, PSDs, posterior samples, and plots are passed between tasks as
+:class:`bytes` arguments and return values. Normally, these travel through the
+Redis broker and result backend, so every hop of a chain costs serialization,
+compression, and Redis memory.
+
+If the :obj:`~gwcelery.conf.blob_store` configuration option is set, then the
+``blob-pickle`` serializer that is registered by this module is used for task
+messages and results instead of the ``pickle`` serializer. It replaces any
+:class:`bytes` object that is larger than
+:obj:`~gwcelery.conf.blob_store_threshold` by a small handle that contains the
+SHA-256 digest of its contents, and stores the contents in a blob store. The
+handle is resolved back into the original :class:`bytes` object when the
+message is deserialized, so tasks do not need to know about the blob store.
+
+Two kinds of blob stores are supported:
+
+*   ``file:///path/to/directory``: files in a directory on a filesystem that is
+    shared by all workers.
+*   ``redis://``: keys in the Redis database that Celery uses.
+
+Blobs expire after :obj:`~gwcelery.conf.blob_store_expires` seconds.
+"""
+import functools
+import hashlib
+import io
+import os
+import pickle
+import tempfile
+import time
+from urllib.parse import urlparse
+
+from kombu.serialization import pickle_protocol, register
+
+__all__ = ('FileBlobStore', 'RedisBlobStore', 'get_blob_store')
+
+
+class FileBlobStore:
+    """Blob store in a directory on a shared filesystem.
+
+    Parameters
+    ----------
+    path : str
+        The directory.
+    expires : float
+        Delete blobs that have not been stored or loaded for this many
+        seconds.
+
+    """
+
+    cleanup_interval = 60.0
+    """Minimum time in seconds between scans for expired blobs."""
+
+    def __init__(self, path, expires):
+        self.path = path
+        self.expires = expires
+        self._last_cleanup = time.monotonic()
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, digest):
+        return os.path.join(self.path, digest)
+
+    def put(self, digest, data):
+        """Store a blob, unless a blob with the same digest already exists."""
+        filename = self._filename(digest)
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            with tempfile.NamedTemporaryFile(
+                    dir=self.path, prefix='.', delete=False) as f:
+                f.write(data)
+            os.replace(f.name, filename)
+        self.cleanup()
+
+    def get(self, digest):
+        """Load a blob, and reset the time until it expires."""
+        filename = self._filename(digest)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            pass  # Deleted by another worker
+        return data
+
+    def cleanup(self, force=False):
+        """Delete expired blobs, if it has been at least
+        :attr:`cleanup_interval` seconds since the last time.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_cleanup < self.cleanup_interval:
+            return
+        self._last_cleanup = now
+        cutoff = time.time() - self.expires
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass  # Deleted by another worker
+
+
+class RedisBlobStore:
+    """Blob store in a Redis database.
+
+    Parameters
+    ----------
+    client : redis.Redis
+        The Redis client.
+    expires : float
+        Delete blobs that have not been stored for this many seconds.
+
+    """
+
+    def __init__(self, client, expires):
+        self.client = client
+        self.expires = expires
+
+    def _key(self, digest):
+        return '{}:{}'.format(__name__, digest)
+
+    def put(self, digest, data):
+        """Store a blob, unless a blob with the same digest already exists."""
+        key = self._key(digest)
+        px = int(self.expires * 1000)
+        if not self.client.set(key, data, px=px, nx=True):
+            self.client.pexpire(key, px)
+
+    def get(self, digest):
+        """Load a blob."""
+        data = self.client.get(self._key(digest))
+        if data is None:
+            raise KeyError('blob {} has expired'.format(digest))
+        return data
+
+
+@functools.lru_cache()
+def _get_blob_store(url, expires):
+    from . import app
+
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        return FileBlobStore(parsed.path, expires)
+    elif parsed.scheme == 'redis':
+        return RedisBlobStore(app.backend.client, expires)
+    else:
+        raise ValueError('unknown blob store: {}'.format(url))
+
+
+def get_blob_store():
+    """Get the blob store that is described by the
+    :obj:`~gwcelery.conf.blob_store` configuration option.
+
+    Returns
+    -------
+    store : :class:`FileBlobStore`, :class:`RedisBlobStore`, None
+        The blob store, or :obj:`None` if no blob store is configured.
+
+    """
+    from . import app
+
+    url = app.conf['blob_store']
+    if url:
+        return _get_blob_store(url, app.conf['blob_store_expires'])
+
+
+class _BlobPickler(pickle.Pickler):
+
+    def __init__(self, file, store, threshold):
+        super().__init__(file, protocol=pickle_protocol)
+        self.store = store
+        self.threshold = threshold
+
+    def persistent_id(self, obj):
+        if type(obj) is bytes and len(obj) >= self.threshold:
+            digest = hashlib.sha256(obj).hexdigest()
+            self.store.put(digest, obj)
+            return 'blob', digest
+
+
+class _BlobUnpickler(pickle.Unpickler):
+
+    def persistent_load(self, pid):
+        kind, digest = pid
+        if kind != 'blob':
+            raise pickle.UnpicklingError(
+                'unsupported persistent ID: {!r}'.format(pid))
+        return get_blob_store().get(digest)
+
+
+def dumps(obj):
+    """Serialize an object like :func:`pickle.dumps`, but move large byte
+    strings to the blob store.
+    """
+    from . import app
+
+    store = get_blob_store()
+    if store is None:
+        return pickle.dumps(obj, protocol=pickle_protocol)
+    with io.BytesIO() as f:
+        _BlobPickler(f, store, app.conf['blob_store_threshold']).dump(obj)
+        return f.getvalue()
+
+
+def loads(data):
+    """Deserialize an object that was serialized by :func:`dumps`."""
+    return _BlobUnpickler(io.BytesIO(data)).load()
+
+
+register('blob-pickle', dumps, loads,
+         content_type='application/x-gwcelery-blob-pickle',
+         content_encoding='binary')
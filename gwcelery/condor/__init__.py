@@ -0,0 +1,17 @@
+"""Embed an HTCondor job tracker into a Celery worker by :doc:`extending
+Celery with bootsteps <celery:userguide/extending>`.
+"""
+from .bootsteps import JobTracker
+
+
+def add_worker_arguments(parser):
+    parser.add_argument(
+        '--condor', action='store_true', help='Enable HTCondor job tracker')
+
+
+def install(app):
+    """Register the HTCondor job tracker subsystem in the application boot
+    steps.
+    """
+    app.steps['consumer'] |= {JobTracker}
+    app.user_options['worker'].add(add_worker_arguments)
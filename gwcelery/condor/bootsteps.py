@@ -0,0 +1,77 @@
+from threading import Event, Thread
+
+from celery import bootsteps
+from celery.utils.log import get_logger
+
+__all__ = ('JobTracker',)
+
+log = get_logger(__name__)
+
+
+class CondorBootStep(bootsteps.ConsumerStep):
+    """Generic boot step to limit us to appropriate kinds of workers.
+
+    Only include this bootstep in workers that are started with the
+    ``--condor`` command line option.
+    """
+
+    def __init__(self, consumer, condor=False, **kwargs):
+        self.enabled = bool(condor)
+
+    def start(self, consumer):
+        log.info('Starting %s', self.name)
+
+    def stop(self, consumer):
+        log.info('Stopping %s', self.name)
+
+
+class JobTracker(CondorBootStep):
+    """Follow the shared HTCondor job event log in a background thread, and
+    resume the tasks that are waiting for jobs when the jobs terminate.
+
+    The log is read incrementally with :class:`gwcelery.tasks.condor.EventLog`
+    every :obj:`~gwcelery.conf.condor_event_log_poll_interval` seconds.
+    Terminal events are passed to :func:`gwcelery.tasks.condor.job_terminated`.
+    Start exactly one worker with the ``--condor`` option.
+    """
+
+    name = 'HTCondor job tracker'
+
+    def _runloop(self):
+        from ..tasks import condor
+
+        while not self._stopping.wait(self._interval):
+            try:
+                for event in self._log.read():
+                    if event.get('MyType') in condor.TERMINAL_EVENTS \
+                            and 'Cluster' in event:
+                        condor.job_terminated(event)
+            except Exception:
+                log.exception('Failed to process HTCondor job events')
+
+    def create(self, consumer):
+        from ..tasks import condor
+
+        super().create(consumer)
+        path = consumer.app.conf['condor_event_log']
+        if not path:
+            raise RuntimeError(
+                'The HTCondor job tracker requires the condor_event_log '
+                'configuration option to be set.')
+        self._log = condor.EventLog(path)
+        self._interval = consumer.app.conf['condor_event_log_poll_interval']
+        self._stopping = Event()
+        self._thread = Thread(target=self._runloop, name='JobTrackerThread')
+
+    def start(self, consumer):
+        super().start(consumer)
+        self._thread.start()
+
+    def stop(self, consumer):
+        super().stop(consumer)
+        self._stopping.set()
+        self._thread.join()
+
+    def info(self, consumer):
+        return {'condor-event-log': self._log.path,
+                'condor-event-log-offset': self._log.offset}
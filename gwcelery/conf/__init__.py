@@ -24,8 +24,11 @@ import os
 # large because we pass large byte strings as task arguments and return values.
 result_expires = 7200
 
-# Use pickle serializer, because it supports byte values.
-accept_content = ['json', 'pickle']
+# Use pickle serializer, because it supports byte values. If a blob store is
+# configured, then the blob-pickle serializer from :mod:`gwcelery.blobs` is
+# used instead; it is the same as pickle, except that it moves large byte
+# values to the blob store.
+accept_content = ['json', 'pickle', 'blob-pickle']
 event_serializer = 'json'
 result_serializer = 'pickle'
 task_serializer = 'pickle'
@@ -44,11 +47,48 @@ broker_transport_options = {
 worker_log_format = "[%(asctime)s: %(levelname)s/%(processName)s/%(threadName)s] %(message)s"  # noqa: E501
 """Custom worker log format that includes the thread name."""
 
+blob_store = None
+"""Where to keep large byte strings that are passed between tasks, instead of
+passing them through the Redis broker. Either ``file:///path/to/directory``
+for a directory on a filesystem that is shared by all workers, or ``redis://``
+for the Redis database that Celery uses. If set, then tasks and results are
+serialized with the ``blob-pickle`` serializer. If None, then use the
+``pickle`` serializer and pass byte strings through the broker. See
+:mod:`gwcelery.blobs`."""
+
+blob_store_threshold = 65536
+"""Byte strings of at least this many bytes are kept in the blob store."""
+
+blob_store_expires = result_expires
+"""Delete blobs from the blob store after this many seconds. Blobs are stored
+again whenever a task message that refers to them is sent again, so this must
+be longer than the longest time that a message can wait in a queue, including
+countdowns and retry delays. The longest retry delay of GWCelery's own tasks
+is 20 minutes, in :mod:`gwcelery.tasks.external_skymaps`."""
+
 # GWCelery-specific settings.
 
 condor_accounting_group = 'ligo.dev.o3.cbc.pe.bayestar'
 """HTCondor accounting group for Celery workers launched with condor_submit."""
 
+condor_event_log = None
+"""Path of an XML HTCondor job event log that is shared by all jobs that are
+submitted by :meth:`gwcelery.tasks.condor.submit` and
+:meth:`gwcelery.tasks.condor.check_output`. If set, then the tasks that
+submit the jobs wait for the job tracker in the worker that is started with
+the ``--condor`` command line option to find their terminal events in this
+log, rather than re-reading a separate log for each job with exponential
+backoff. If None, then each job writes its own log."""
+
+condor_event_log_poll_interval = 1.0
+"""Interval in seconds at which the job tracker checks the shared HTCondor job
+event log for new events."""
+
+condor_event_log_ttl = 86400
+"""Keep the terminal events of HTCondor jobs in Redis for this many seconds,
+so that a task that starts waiting for a job that has already terminated is
+resumed right away."""
+
 expose_to_public = False
 """Set to True if events meeting the public alert threshold really should be
 exposed to the public."""
@@ -59,6 +99,58 @@ lvalert_host = 'lvalert-playground.cgca.uwm.edu'
 gracedb_host = 'gracedb-playground.ligo.org'
 """GraceDB host."""
 
+gracedb_pool_maxsize = 10
+"""Maximum number of persistent HTTPS connections to GraceDB to keep open in
+each worker process. The connections are shared by all GraceDB clients (see
+:obj:`gwcelery.tasks.gracedb.transport`)."""
+
+gracedb_pool_block = False
+"""If True, then limit the number of concurrent requests to GraceDB from each
+worker process to :obj:`~gwcelery.conf.gracedb_pool_maxsize`. If False, then
+open additional connections as needed, but do not keep them open
+afterwards."""
+
+gracedb_cache_ttl = 10.0
+"""Cache the results of tasks that read events, superevents, labels, and logs
+from GraceDB (such as :meth:`gwcelery.tasks.gracedb.get_event`) for this many
+seconds. The cached results for an event or superevent are discarded whenever
+a task modifies it or whenever an LVAlert message about it is received. Set to
+zero to disable the cache."""
+
+gracedb_download_cache_ttl = 60.0
+"""Keep the contents of files that were downloaded from GraceDB (by
+:meth:`gwcelery.tasks.gracedb.download`) for this many seconds so that other
+tasks that need the same file share one download. The contents for an event
+or superevent are discarded whenever a task modifies it or whenever an LVAlert
+message about it is received. Set to zero to disable sharing downloads."""
+
+gracedb_download_cache_max_size = 8 * 1024 * 1024
+"""Maximum size in bytes of a file that is shared between downloads (see
+:obj:`~gwcelery.conf.gracedb_download_cache_ttl`) by keeping its contents in
+Redis. Larger files are downloaded separately by each task that needs them.
+This limit does not apply if a :obj:`~gwcelery.conf.blob_store` is
+configured, because then the contents are kept in the blob store."""
+
+gracedb_log_index_ttl = 86400
+"""Keep the index of the log messages of uploaded files for each event or
+superevent (see :meth:`gwcelery.tasks.gracedb.index_log_entries`) for this many
+seconds after the last upload. Set to zero to disable the index and always
+search the full log when tagging files."""
+
+gracedb_trigger_index_ttl = 86400
+"""Keep external events and superevents in the time-sorted trigger index (see
+:meth:`gwcelery.tasks.gracedb.index_trigger`) for this many seconds after
+their GPS times. RAVEN coincidence searches only query GraceDB if the index
+has candidates in the search window, or if the LVAlert listener was not
+connected for the whole window. Set to zero to disable the index and always
+query GraceDB."""
+
+plot_cache_ttl = 3600
+"""Keep the PNG images made by plotting tasks (such as
+:meth:`gwcelery.tasks.skymaps.plot_allsky`) in Redis for this many seconds,
+keyed by a hash of the task arguments, so that plotting the same file again
+does not redraw it. Set to zero to disable the cache."""
+
 voevent_broadcaster_address = ':5342'
 """The VOEvent broker will bind to this address to send GCNs.
 This should be a string of the form `host:port`. If `host` is empty,
@@ -97,6 +189,24 @@ superevent_query_d_t_start = 100.
 superevent_query_d_t_end = 100.
 """Upper extent of superevents query"""
 
+superevent_index_max_age = 600.0
+"""The superevent worker keeps an index of recent superevents so that it does
+not have to query GraceDB for every new event (see
+:meth:`gwcelery.tasks.superevents.process`). Discard the index for a category
+and refresh it from GraceDB after this many seconds, in case any changes were
+missed."""
+
+superevent_batch_window = 0.0
+"""If nonzero, then collect LVAlert messages for new events for up to this
+many seconds and process events that overlap in time together, as a single
+cluster (see :meth:`gwcelery.tasks.superevents.process_cluster`). If zero,
+then process every event separately as soon as it arrives."""
+
+superevent_batch_size = 4
+"""If :obj:`~gwcelery.conf.superevent_batch_window` is nonzero, then process
+the collected events as soon as there are this many of them, without waiting
+for the end of the batch window."""
+
 superevent_default_d_t_start = 1.0
 """Default lower extent of superevent segments"""
 
@@ -305,9 +415,27 @@ detchar_bit_definitions = {
 }
 """Bit definitions for detchar checks"""
 
+detchar_concurrent_reads = True
+"""If true, then :meth:`gwcelery.tasks.detchar.check_vectors` reads all of the
+state vector and iDQ channels for each detector in a single pass over its
+frame files, and reads the detectors in parallel. If false, then each channel
+is read separately, one after another."""
+
+detchar_cache_ttl = 600.0
+"""Time in seconds to keep state vector and iDQ time series in memory after
+they have been read by :meth:`gwcelery.tasks.detchar.check_vectors`, so that
+repeated checks of overlapping time spans do not have to read the same frame
+files again. Set to 0 to disable the cache."""
+
 omegascan_durations = [0.5, 2.0, 10.0]
 """Durations for omegascans, symmetric about t0"""
 
+omegascan_threads = 3
+"""Number of threads to use for computing the Q-transforms of omegascans
+(see :meth:`gwcelery.tasks.detchar.make_omegascan`), one per duration in
+:obj:`omegascan_durations` by default. If 1, then compute them one after
+another in the task."""
+
 pe_results_path = os.path.join(os.getenv('HOME'), 'public_html/online_pe')
 """Path to the results of Parameter Estimation (see
 :mod:`gwcelery.tasks.inference`)"""
@@ -326,6 +454,14 @@ raven_coincidence_windows = {'GRB_CBC': [-5, 1],
 superevents of the appropriate type are considered to be coincident if
 within time window of each other."""
 
+raven_skymap_overlap_cache_ttl = 86400
+"""Keep the sky map overlap integrals that are computed for RAVEN
+spatiotemporal coincidence false alarm rates (see
+:meth:`gwcelery.tasks.raven.skymap_overlap`) in Redis for this many seconds,
+keyed by the versioned file names of both sky maps, so that recomputing the
+false alarm rate when neither sky map has changed does not download or decode
+them again. Set to zero to disable the cache."""
+
 mock_events_simulate_multiple_uploads = False
 """If True, then upload each mock event several times in rapid succession with
 random jitter in order to simulate multiple pipeline uploads."""
@@ -1,3 +1,6 @@
+from threading import Event, Thread
+
+from astropy.time import Time
 from celery import bootsteps
 from celery.utils.log import get_logger
 
@@ -31,26 +34,71 @@ def _send_lvalert_received(node, payload):
 
 
 class Receiver(LVAlertBootStep):
-    """Run the global LVAlert receiver in background thread."""
+    """Run the global LVAlert receiver in background thread.
+
+    While the receiver is connected, it also reports so every
+    :attr:`heartbeat_interval` seconds in a background thread (see
+    :meth:`gwcelery.tasks.gracedb.record_lvalert_listener`), so that the
+    trigger index that is kept up to date from LVAlert messages is only
+    trusted while no messages can have been missed.
+    """
 
     name = 'LVAlert client'
 
+    heartbeat_interval = 10.0
+    """Interval in seconds at which the receiver reports that it is
+    connected."""
+
+    def _record_connection(self):
+        from ..tasks import gracedb
+
+        try:
+            gracedb.record_lvalert_listener(self._connected_since,
+                                            3 * self.heartbeat_interval)
+        except Exception:
+            log.exception('Failed to record LVAlert connection status')
+
+    def _on_session_start(self, event):
+        self._connected_since = Time.now().gps
+        self._record_connection()
+
+    def _on_disconnected(self, event):
+        self._connected_since = None
+        self._record_connection()
+
+    def _heartbeat(self):
+        while not self._stopping.wait(self.heartbeat_interval):
+            if self._connected_since is not None:
+                self._record_connection()
+
     def create(self, consumer):
         super().create(consumer)
         from .client import LVAlertClient
         self._client = LVAlertClient(
             server=consumer.app.conf['lvalert_host'],
             nodes=consumer.app.conf['lvalert_nodes'])
+        self._client.add_event_handler('session_start',
+                                       self._on_session_start)
+        self._client.add_event_handler('disconnected', self._on_disconnected)
+        self._connected_since = None
+        self._stopping = Event()
+        self._heartbeat_thread = Thread(target=self._heartbeat,
+                                        name='LVAlertHeartbeatThread')
 
     def start(self, consumer):
         super().start(consumer)
         self._client.connect()
         self._client.process()
         self._client.listen(_send_lvalert_received)
+        self._heartbeat_thread.start()
 
     def stop(self, consumer):
         super().stop(consumer)
         self._client.disconnect()
+        self._stopping.set()
+        self._heartbeat_thread.join()
+        self._connected_since = None
+        self._record_connection()
 
     def info(self, consumer):
         return {'lvalert-nodes': self._client.get_subscriptions()}
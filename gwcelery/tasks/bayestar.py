@@ -1,24 +1,48 @@
 """Rapid sky localization with :mod:`BAYESTAR <ligo.skymap.bayestar>`."""
+import hashlib
 import io
 import logging
 import urllib.parse
 
 from celery.exceptions import Ignore
-from ligo.lw.utils import load_fileobj
-from ligo.lw.utils.ligolw_add import merge_ligolws
 from ligo.skymap import bayestar as _bayestar
 from ligo.skymap.io import events
 from ligo.skymap.io import fits
 
 from .. import app
+from ..util.ligolw import BAYESTAR_TABLES, load_ligolw
 from . import gracedb
 
 log = logging.getLogger('BAYESTAR')
 
+_psd_docs = {}
+"""Parsed ``psd.xml.gz`` documents, keyed by the SHA-256 digest of the file
+contents. Pipelines upload the same PSDs with many events, so this spares
+the OpenMP worker from parsing them again for every event."""
+
+_PSD_DOCS_MAXSIZE = 16
+"""Maximum number of entries in :obj:`_psd_docs`."""
+
+
+def _load_psd(filecontents):
+    """Parse a ``psd.xml.gz`` file, or get it from :obj:`_psd_docs` if the
+    same file has been parsed before.
+    """
+    key = hashlib.sha256(filecontents).digest()
+    try:
+        doc = _psd_docs.pop(key)
+    except KeyError:
+        doc = load_ligolw(filecontents)
+        if len(_psd_docs) >= _PSD_DOCS_MAXSIZE:
+            del _psd_docs[next(iter(_psd_docs))]
+    # Move to the end so that the least recently used entry is evicted first.
+    _psd_docs[key] = doc
+    return doc
+
 
 @app.task(queue='openmp', shared=False)
 def localize(coinc_psd, graceid, filename='bayestar.fits.gz',
-             disabled_detectors=None):
+             disabled_detectors=None, fast_xml=True):
     """Generate a rapid sky localization using
     :mod:`BAYESTAR <ligo.skymap.bayestar>`.
 
@@ -34,6 +58,10 @@ def localize(coinc_psd, graceid, filename='bayestar.fits.gz',
         The name of the FITS file.
     disabled_detectors : list, optional
         List of detectors to disable.
+    fast_xml : bool, optional
+        If True (the default), then read only the parts of ``coinc.xml`` that
+        BAYESTAR needs (see :obj:`gwcelery.util.ligolw.BAYESTAR_TABLES`). If
+        False, then read the whole document.
 
     Returns
     -------
@@ -47,7 +75,9 @@ def localize(coinc_psd, graceid, filename='bayestar.fits.gz',
     <ligo.skymap:tool/bayestar_localize_lvalert>`.
 
     It should execute in a special queue for computationally intensive,
-    multithreaded, OpenMP tasks.
+    multithreaded, OpenMP tasks. The workers for that queue are long-lived
+    and process one task at a time, so they keep their OpenMP thread pool and
+    the parsed PSDs in :obj:`_psd_docs` from one event to the next.
 
     """
     # Determine the base URL for event pages.
@@ -58,15 +88,15 @@ def localize(coinc_psd, graceid, filename='bayestar.fits.gz',
         # A little bit of Cylon humor
         log.info('by your command...')
 
-        # Combine coinc.xml and psd.xml.gz into one XML document
-        doc = None
-        for filecontents in coinc_psd:
-            doc = load_fileobj(io.BytesIO(filecontents), xmldoc=doc,
-                               contenthandler=events.ligolw.ContentHandler)
-        merge_ligolws(doc)
+        # Parse coinc.xml and psd.xml.gz
+        coinc, psd = coinc_psd
+        coinc_doc = load_ligolw(
+            coinc, tables=BAYESTAR_TABLES if fast_xml else None)
+        psd_doc = _load_psd(psd)
 
         # Parse event
-        event_source = events.ligolw.open(doc, psd_file=doc, coinc_def=None)
+        event_source = events.ligolw.open(
+            coinc_doc, psd_file=psd_doc, coinc_def=None)
         if disabled_detectors:
             event_source = events.detector_disabled.open(
                 event_source, disabled_detectors)
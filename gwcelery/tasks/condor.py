@@ -4,6 +4,13 @@ Notes
 -----
 Internally, we use the XML condor log format [2]_ for easier parsing.
 
+By default, each job writes its own log, and the task that submitted it is
+re-queued with exponential backoff until the log shows that the job has
+terminated. If :obj:`~gwcelery.conf.condor_event_log` is set, then all jobs
+write to that shared log instead, and the task that submitted each job is
+suspended until the job tracker (see :mod:`gwcelery.condor`) finds the job's
+terminal event in the log and resumes it.
+
 References
 ----------
 .. [1] http://research.cs.wisc.edu/htcondor/manual/latest/condor_submit.html
@@ -11,10 +18,14 @@ References
 
 """
 from distutils.dir_util import mkpath
+import json
 import os
+import pickle
+import re
 import subprocess
 import tempfile
 
+from celery.exceptions import Ignore
 import lxml.etree
 
 from .. import app
@@ -48,6 +59,8 @@ def _read(filename):
 
 def _rm_f(*args):
     for arg in args:
+        if arg is None:
+            continue
         try:
             os.remove(arg)
         except OSError:
@@ -82,14 +95,136 @@ def _parse_classad(c):
 def _read_last_event(log):
     """Get the last event from an HTCondor log file.
 
-    FIXME: It would be more efficient in terms of I/O and file desciptors to
-    use a single HTCondor log file for all jobs and use the inotify
-    capabilities of ``htcondor.read_events`` to avoid unnecessary polling.
+    This is only used for jobs that write their own log. Jobs that write to
+    the shared :obj:`~gwcelery.conf.condor_event_log` are tracked by reading
+    it incrementally with :class:`EventLog`.
     """
     tree = lxml.etree.fromstring('<classads>' + _read(log) + '</classads>')
     return dict(_parse_classad(tree.find('c[last()]')))
 
 
+TERMINAL_EVENTS = frozenset({'JobTerminatedEvent', 'JobAbortedEvent'})
+"""Types of events after which there are no further events for a job."""
+
+
+class EventLog:
+    """Incremental reader for an XML HTCondor job event log that is shared by
+    many jobs.
+
+    Each call to :meth:`read` reads only the bytes that were appended to the
+    log since the last call, starting from the byte offset where the last
+    complete event ended.
+
+    Parameters
+    ----------
+    path : str
+        The path of the log file.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def read(self):
+        """Read the events that have been appended to the log.
+
+        Returns
+        -------
+        list
+            The new events, as dictionaries of ClassAd attributes.
+
+        """
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return []
+        with f:
+            if os.fstat(f.fileno()).st_size < self.offset:
+                # The log was truncated or replaced; start over.
+                self.offset = 0
+            f.seek(self.offset)
+            data = f.read()
+        start = data.find(b'<c>')
+        end = data.rfind(b'</c>')
+        if start < 0 or end < 0:
+            return []
+        end += len(b'</c>')
+        self.offset += end
+        tree = lxml.etree.fromstring(
+            b'<classads>' + data[start:end] + b'</classads>')
+        return [dict(_parse_classad(c)) for c in tree.findall('c')]
+
+
+_WAITING_KEY = __name__ + '.waiting'
+"""Redis hash of the signatures of the tasks that are waiting for jobs, keyed
+by cluster ID."""
+
+
+def _terminated_key(cluster):
+    """Get the Redis key for the terminal event of a job."""
+    return '{}.terminated:{}'.format(__name__, cluster)
+
+
+def _resume(cluster, event):
+    """Resume the task that is waiting for a job, if any.
+
+    The waiting task is removed from the hash before it is resumed, and only
+    whichever caller succeeds in removing it resumes it, so that it is resumed
+    exactly once.
+    """
+    redis = app.backend.client
+    signature = redis.hget(_WAITING_KEY, cluster)
+    if signature is not None and redis.hdel(_WAITING_KEY, cluster):
+        pickle.loads(signature).clone(kwargs={'event': event}).apply_async()
+
+
+def job_terminated(event):
+    """Record the terminal event of a job, and resume the task that is
+    waiting for it. This is called by the job tracker.
+
+    Parameters
+    ----------
+    event : dict
+        The event, as returned by :meth:`EventLog.read`.
+
+    """
+    cluster = str(event['Cluster'])
+    app.backend.client.set(
+        _terminated_key(cluster), json.dumps(event),
+        px=int(app.conf['condor_event_log_ttl'] * 1000))
+    _resume(cluster, event)
+
+
+def _wait(task, cluster, args, kwargs):
+    """Suspend a task until the job tracker finds the terminal event of its
+    job, and then run it again with the same task ID and with the event as
+    the ``event`` keyword argument.
+
+    This works like :meth:`celery.app.task.Task.retry`, except that the task is
+    sent again by the job tracker rather than after a countdown.
+    """
+    cluster = str(cluster)
+    redis = app.backend.client
+    signature = task.signature_from_request(task.request, args, kwargs)
+    redis.hset(_WAITING_KEY, mapping={cluster: pickle.dumps(signature)})
+    # The job may have terminated before we started waiting for it.
+    event = redis.get(_terminated_key(cluster))
+    if event is not None:
+        _resume(cluster, json.loads(event))
+    raise Ignore()
+
+
+def _parse_cluster_id(output):
+    """Get the cluster ID from the output of ``condor_submit``."""
+    match = re.search(rb'submitted to cluster (\d+)', output)
+    if match is None:
+        raise ValueError(
+            'could not find cluster ID in condor_submit output: {!r}'.format(
+                output))
+    return int(match[1])
+
+
 def _submit(submit_file=None, **kwargs):
     args = ['condor_submit']
     for key, value in kwargs.items():
@@ -98,7 +233,7 @@ def _submit(submit_file=None, **kwargs):
         args += ['/dev/null', '-queue', '1']
     else:
         args += [submit_file]
-    subprocess.run(args, capture_output=True, check=True)
+    return subprocess.run(args, capture_output=True, check=True)
 
 
 class JobAborted(Exception):
@@ -116,7 +251,7 @@ class JobFailed(subprocess.CalledProcessError):
 @app.task(bind=True, autoretry_for=(JobRunning,), default_retry_delay=1,
           ignore_result=True, max_retries=None, retry_backoff=True,
           shared=False)
-def submit(self, submit_file, log=None):
+def submit(self, submit_file, log=None, event=None):
     """Submit a job using HTCondor.
 
     Parameters
@@ -125,6 +260,9 @@ def submit(self, submit_file, log=None):
         Path of the submit file.
     log: str
         Used internally to track job state. Caller should not set.
+    event: dict
+        Used internally to pass the terminal event of the job from the job
+        tracker. Caller should not set.
 
     Raises
     ------
@@ -142,16 +280,21 @@ def submit(self, submit_file, log=None):
     ...          accounting_group='ligo.dev.o3.cbc.explore.test')
 
     """
-    if log is None:
-        log = _mklog('.log')
+    if log is None and event is None:
+        shared_log = app.conf['condor_event_log']
+        log = shared_log or _mklog('.log')
         try:
-            _submit(submit_file, log_xml='true', log=log)
+            result = _submit(submit_file, log_xml='true', log=log)
         except subprocess.CalledProcessError:
-            _rm_f(log)
+            if not shared_log:
+                _rm_f(log)
             raise
+        if shared_log:
+            _wait(self, _parse_cluster_id(result.stdout), (submit_file,), {})
         self.retry((submit_file,), dict(log=log))
     else:
-        event = _read_last_event(log)
+        if event is None:
+            event = _read_last_event(log)
         if event.get('MyType') == 'JobTerminatedEvent':
             _rm_f(log)
             if event['TerminatedNormally'] and event['ReturnValue'] != 0:
@@ -165,7 +308,8 @@ def submit(self, submit_file, log=None):
 
 @app.task(bind=True, autoretry_for=(JobRunning,), default_retry_delay=1,
           max_retries=None, retry_backoff=True, shared=False)
-def check_output(self, args, log=None, error=None, output=None, **kwargs):
+def check_output(self, args, log=None, error=None, output=None, event=None,
+                 **kwargs):
     """Call a process using HTCondor.
 
     Call an external process using HTCondor, in a manner patterned after
@@ -178,6 +322,9 @@ def check_output(self, args, log=None, error=None, output=None, **kwargs):
         Command line arguments, as if passed to :func:`subprocess.check_call`.
     log, error, output : str
         Used internally to track job state. Caller should not set.
+    event : dict
+        Used internally to pass the terminal event of the job from the job
+        tracker. Caller should not set.
     **kwargs
         Extra submit description file commands. See the documentation for
         ``condor_submit`` for possible values.
@@ -206,8 +353,9 @@ def check_output(self, args, log=None, error=None, output=None, **kwargs):
     # FIXME: Refactor to reuse common code from this task and
     # gwcelery.tasks.condor.submit.
 
-    if log is None:
-        log = _mklog('.log')
+    if log is None and event is None:
+        shared_log = app.conf['condor_event_log']
+        log = shared_log or _mklog('.log')
         error = _mklog('.err')
         output = _mklog('.out')
         kwargs = dict(kwargs,
@@ -218,13 +366,17 @@ def check_output(self, args, log=None, error=None, output=None, **kwargs):
                       arguments=_escape_args(args),
                       log=log, error=error, output=output)
         try:
-            _submit(**kwargs)
+            result = _submit(**kwargs)
         except subprocess.CalledProcessError:
-            _rm_f(log, error, output)
+            _rm_f(None if shared_log else log, error, output)
             raise
+        if shared_log:
+            _wait(self, _parse_cluster_id(result.stdout), (args,),
+                  dict(error=error, output=output))
         self.retry((args,), kwargs)
     else:
-        event = _read_last_event(log)
+        if event is None:
+            event = _read_last_event(log)
         if event.get('MyType') == 'JobTerminatedEvent':
             captured_error = _read(error)
             captured_output = _read(output)
@@ -14,10 +14,12 @@ References
 .. [DMT] https://wiki.ligo.org/DetChar/DmtDqVector
 
 """
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import getpass
-import glob
 import io
 import json
+import math
 import socket
 import time
 
@@ -26,7 +28,7 @@ from celery import group
 from celery.utils.log import get_task_logger
 from glue.lal import Cache
 from gwdatafind import find_urls
-from gwpy.timeseries import Bits, StateVector, TimeSeries
+from gwpy.timeseries import Bits, StateVector, TimeSeries, TimeSeriesDict
 from gwpy.plot import Plot
 import matplotlib.pyplot as plt
 import numpy as np
@@ -35,7 +37,7 @@ from . import gracedb
 from ..import app
 from ..import _version
 from ..jinja import env
-from ..util import closing_figures
+from ..util import closing_figures, FrameIndex
 
 
 __author__ = 'Geoffrey Mo <geoffrey.mo@ligo.org>'
@@ -43,10 +45,19 @@ __author__ = 'Geoffrey Mo <geoffrey.mo@ligo.org>'
 log = get_task_logger(__name__)
 
 
+_frame_indices = {}
+"""Indices of the low-latency frame files, keyed by glob pattern."""
+
+
 def create_cache(ifo, start, end):
     """Find .gwf files and create cache. Will first look in the llhoft, and
     if the frames have expired from llhoft, will call gwdatafind.
 
+    The llhoft frame files are looked up in a
+    :class:`~gwcelery.util.FrameIndex` that is kept up to date as frames
+    arrive and expire, and only the frames that overlap the requested time
+    interval are returned.
+
     Parameters
     ----------
     ifo : str
@@ -70,18 +81,18 @@ def create_cache(ifo, start, end):
 
     """
     pattern = app.conf['llhoft_glob'].format(detector=ifo)
-    filenames = glob.glob(pattern)
-    cache = Cache.from_urls(filenames)
-
     try:
-        cache_starttime = int(
-            list(cache.to_segmentlistdict().values())[0][0][0])
-    except IndexError:
-        log.exception('Files do not exist in llhoft_glob')
-        return cache  # returns empty cache
+        index = _frame_indices[pattern]
+    except KeyError:
+        index = _frame_indices[pattern] = FrameIndex(pattern)
+
+    cache_starttime = index.start_time()
+    if cache_starttime is None:
+        log.error('Files do not exist in llhoft_glob')
+        return Cache()  # returns empty cache
 
     if start >= cache_starttime:  # required data is in llhoft
-        return cache
+        return Cache.from_urls(index.find(start, end))
 
     # otherwise, required data has left llhoft
     high_latency = app.conf['high_latency_frame_types'][ifo]
@@ -98,6 +109,52 @@ def create_cache(ifo, start, end):
     return Cache.from_urls(urls)
 
 
+_OMEGASCAN_PADDING = 4.0
+"""Minimum amount of whitened data in seconds to keep on either side of each
+omegascan window, so that the longest Q tiles are not affected by the edges of
+the data."""
+
+
+def _whiten(ts):
+    """Whiten strain data for omegascans.
+
+    This uses the same parameters as the default whitening of
+    :meth:`gwpy.timeseries.TimeSeries.q_transform`: the ASD is estimated with
+    Hann-windowed FFTs of 2 s (or 2048 samples, whichever is longer) and 50%
+    overlap, and the whitening filter has a duration of 2 s.
+    """
+    fftlength = max(2, math.ceil(2048 * ts.dt.decompose().value))
+    asd = ts.asd(fftlength, fftlength / 2, window='hann')
+    return ts.whiten(asd=asd, fduration=2)
+
+
+def _q_transform(whitened, t0, dur):
+    """Compute the Q-transform for one omegascan window from whitened data.
+
+    The data is cropped to the window plus some padding first, so that the
+    cost of the short scans does not depend on the longest duration.
+    """
+    padding = max(dur, _OMEGASCAN_PADDING)
+    start, end = whitened.span
+    whitened = whitened.crop(max(start, t0 - dur - padding),
+                             min(end, t0 + dur + padding))
+    return whitened.q_transform(
+        frange=(20, 4096), gps=t0, outseg=(t0 - dur, t0 + dur),
+        logf=True, whiten=False)
+
+
+def _q_transforms(whitened, t0, durs):
+    """Compute the Q-transforms for all omegascan windows, in parallel in
+    :obj:`~gwcelery.conf.omegascan_threads` threads.
+    """
+    threads = min(app.conf['omegascan_threads'], len(durs))
+    if threads <= 1:
+        return [_q_transform(whitened, t0, dur) for dur in durs]
+    with ThreadPoolExecutor(threads) as executor:
+        return list(executor.map(
+            lambda dur: _q_transform(whitened, t0, dur), durs))
+
+
 @app.task(shared=False)
 @closing_figures()
 def make_omegascan(ifo, t0, durs):
@@ -119,6 +176,13 @@ def make_omegascan(ifo, t0, durs):
     bytes or None
         bytes of png of the omegascan, or None if no omegascan created.
 
+    Notes
+    -----
+    The strain data for the longest duration is read and whitened only once.
+    The shorter scans are computed from sub-windows of the same whitened
+    data, and the Q-transforms can be computed in parallel in
+    :obj:`~gwcelery.conf.omegascan_threads` threads.
+
     """
     # Explicitly use a non-interactive Matplotlib backend.
     plt.switch_backend('agg')
@@ -131,10 +195,9 @@ def make_omegascan(ifo, t0, durs):
     try:
         ts = TimeSeries.read(cache, strain_name,
                              start=long_start, end=long_end).astype('float64')
+        whitened = _whiten(ts)
         # Do q_transforms for the different durations
-        qgrams = [ts.q_transform(
-            frange=(20, 4096), gps=t0, outseg=(t0 - dur, t0 + dur), logf=True)
-            for dur in durs]
+        qgrams = _q_transforms(whitened, t0, durs)
     except (IndexError, FloatingPointError, ValueError):
         # data from cache can't be properly read, or data is weird
         fig = plt.figure()
@@ -213,7 +276,7 @@ def generate_table(title, high_bit_list, low_bit_list, unknown_bit_list):
                            unknown_bit_list=unknown_bit_list)
 
 
-def dqr_json(state, summary):
+def dqr_json(state, summary, bit_states=None):
     """Generate DQR-compatible json-ready dictionary from process results, as
     described in :class:`data-quality-report.design`.
 
@@ -223,6 +286,10 @@ def dqr_json(state, summary):
         State of the detchar checks.
     summary : str
         Summary of results from the process.
+    bit_states : :class:`numpy.ndarray`, optional
+        The states of the individual bits, as returned by
+        :func:`evaluate_bits`. If provided, then they are listed in the
+        ``extra`` field.
 
     Returns
     -------
@@ -254,11 +321,156 @@ def dqr_json(state, summary):
         figures=[],
         tables=[],
         links=links,
-        extra=[],
+        extra=[] if bit_states is None else [
+            {'ifo': ifo, 'bit': name,
+             'state': {1: 'pass', 0: 'fail', -1: 'unknown'}[bit_state]}
+            for ifo, name, _, bit_state in bit_states.tolist()],
     )
 
 
-def check_idq(cache, channel, start, end):
+_series = {}
+"""Recently read state vector and iDQ time series, keyed by channel. Each
+value is a tuple of the :func:`time.monotonic` time at which the entry was
+stored and the :class:`gwpy.timeseries.TimeSeries`. The same superevent window
+is checked several times (for example, when it is selected for EM follow-up
+and again when an external trigger arrives), so this spares reading the same
+frame data again."""
+
+_SERIES_MAXSIZE = 64
+"""Maximum number of entries in :obj:`_series`."""
+
+_SERIES_MAX_DURATION = 1024.0
+"""Maximum duration in seconds of each entry in :obj:`_series`. Longer time
+series are cropped to their most recent data before they are stored."""
+
+
+def _get_series(channel):
+    try:
+        stored, series = _series.pop(channel)
+    except KeyError:
+        return None
+    if time.monotonic() - stored > app.conf['detchar_cache_ttl']:
+        return None
+    # Move to the end so that the least recently used entry is evicted first.
+    _series[channel] = stored, series
+    return series
+
+
+def _put_series(channel, series):
+    if series.span[1] - series.span[0] > _SERIES_MAX_DURATION:
+        # Copy, so that the cropped part of the array can be freed.
+        series = series.crop(series.span[1] - _SERIES_MAX_DURATION, copy=True)
+    _series.pop(channel, None)
+    if len(_series) >= _SERIES_MAXSIZE:
+        _series.pop(next(iter(_series)), None)
+    _series[channel] = time.monotonic(), series
+
+
+def _read_series(cache, channels, start, end):
+    """Read several channels, reusing any data that is in :obj:`_series`.
+
+    If a channel is cached for a time span that overlaps the requested one,
+    then only the missing data at either edge is read and joined to the
+    cached data. Channels that are missing the same span are read together.
+    If an edge cannot be read, then the whole span is read instead, so that
+    the cached data alone is never returned for a longer span.
+    """
+    if not app.conf['detchar_cache_ttl']:
+        return TimeSeriesDict.read(cache, channels, start=start, end=end)
+
+    data = {}
+    reads = defaultdict(list)
+    for channel in channels:
+        series = _get_series(channel)
+        if series is None or series.span[0] > end or series.span[1] < start:
+            reads[start, end].append(channel)
+            continue
+        data[channel] = series
+        if start < series.span[0]:
+            reads[start, series.span[0]].append(channel)
+        if end > series.span[1]:
+            reads[series.span[1], end].append(channel)
+
+    rereads = []
+    for (read_start, read_end), read_channels in reads.items():
+        try:
+            new_data = TimeSeriesDict.read(
+                cache, read_channels, start=read_start, end=read_end)
+        except (IndexError, RuntimeError, TypeError, ValueError):
+            if (read_start, read_end) == (start, end):
+                raise
+            # The edge could not be read. Read the whole span again, which
+            # raises if the data is really missing (for example, if the
+            # frames have not arrived yet).
+            rereads.extend(read_channels)
+            continue
+        for channel, series in new_data.items():
+            old = data.get(channel)
+            if old is not None:
+                try:
+                    if series.span[0] < old.span[0]:
+                        series = series.append(old, inplace=False)
+                    else:
+                        series = old.append(series, inplace=False)
+                except ValueError:
+                    # The new data is not contiguous with the cached data.
+                    rereads.append(channel)
+                    continue
+            data[channel] = series
+            _put_series(channel, series)
+    if rereads:
+        new_data = TimeSeriesDict.read(
+            cache, list(dict.fromkeys(rereads)), start=start, end=end)
+        for channel, series in new_data.items():
+            data[channel] = series
+            _put_series(channel, series)
+
+    return {channel: series.crop(max(start, series.span[0]),
+                                 min(end, series.span[1]))
+            for channel, series in data.items()}
+
+
+def read_channels(ifo, channels, start, end):
+    """Create the cache for a detector and read several of its channels with a
+    single pass over the frame files.
+
+    Parameters
+    ----------
+    ifo : str
+        Interferometer name (e.g. ``H1``).
+    channels : list
+        Names of the channels to read.
+    start, end : int or float
+        GPS start and end times desired.
+
+    Returns
+    -------
+    cache : :class:`glue.lal.Cache`
+        The cache for the detector.
+    data : dict
+        Maps each channel to its :class:`gwpy.timeseries.TimeSeries`. Empty
+        if the channels could not be read together, in which case they may
+        still be read one at a time from the cache.
+
+    Notes
+    -----
+    Channels that have been read recently are kept in memory for
+    :obj:`~gwcelery.conf.detchar_cache_ttl` seconds. If they are requested
+    again for an overlapping time span, then only the missing data at the
+    edges is read from the frame files.
+
+    """
+    cache = create_cache(ifo, start, end)
+    if cache and channels:
+        try:
+            return cache, _read_series(cache, channels, start, end)
+        except (IndexError, RuntimeError, TypeError, ValueError):
+            log.warning('Failed to read %s channels from low-latency frame '
+                        'files in one pass', ifo)
+    return cache, {}
+
+
+def check_idq(cache, channel, start, end, data=None):
     """Looks for iDQ frame and reads them.
 
     Parameters
@@ -269,6 +481,8 @@ def check_idq(cache, channel, start, end):
         which idq channel (pglitch)
     start, end: int or float
         GPS start and end times desired.
+    data : :class:`gwpy.timeseries.TimeSeries`, optional
+        The channel, if it has already been read (see :func:`read_channels`).
 
     Returns
     -------
@@ -282,6 +496,8 @@ def check_idq(cache, channel, start, end):
     ('H1:IDQ-PGLITCH-OVL-100-1000', 0.87)
 
     """
+    if data is not None:
+        return (channel, float(data.max().value))
     if cache:
         try:
             idq_prob = TimeSeries.read(
@@ -297,7 +513,8 @@ def check_idq(cache, channel, start, end):
     return (channel, None)
 
 
-def check_vector(cache, channel, start, end, bits, logic_type='all'):
+def check_vector(cache, channel, start, end, bits, logic_type='all',
+                 data=None):
     """Check timeseries of decimals against a bitmask.
     This is inclusive of the start time and exclusive of the end time, i.e.
     [start, ..., end).
@@ -316,6 +533,8 @@ def check_vector(cache, channel, start, end, bits, logic_type='all'):
         Type of logic to apply for vetoing.
         If ``all``, then all samples in the window must pass the bitmask.
         If ``any``, then one or more samples in the window must pass.
+    data : :class:`gwpy.timeseries.TimeSeries`, optional
+        The channel, if it has already been read (see :func:`read_channels`).
 
     Returns
     -------
@@ -334,12 +553,21 @@ def check_vector(cache, channel, start, end, bits, logic_type='all'):
      'H1:NO_DETCHAR_HW_INJ': True}
 
     """
-    if logic_type not in ('any', 'all'):
-        raise ValueError("logic_type must be either 'all' or 'any'.")
-    else:
-        logic_map = {'any': np.any, 'all': np.all}
-    bitname = '{}:{}'
-    if cache:
+    states = evaluate_bits(
+        _read_state_vector(cache, channel, start, end, bits, data),
+        channel.split(':')[0], bits, logic_type)
+    return {name: None if state < 0 else bool(state) for name, state
+            in zip(states['name'].tolist(), states['state'].tolist())}
+
+
+def _read_state_vector(cache, channel, start, end, bits, data=None):
+    """Read a state vector channel as an array of integers, or return None if
+    it cannot be read.
+    """
+    statevector = None
+    if data is not None:
+        statevector = data
+    elif cache:
         try:
             statevector = StateVector.read(cache, channel,
                                            start=start, end=end, bits=bits)
@@ -350,21 +578,75 @@ def check_vector(cache, channel, start, end, bits, logic_type='all'):
             # FIXME: Change from log.exception to log.warning until this fixed,
             # because it's saturating Sentry.
             log.warning('Failed to read from low-latency frame files')
-        else:
-            # FIXME: In the playground environment, the Virgo state vector
-            # channel is stored as a float. Is this also the case in the
-            # production environment?
-            statevector = statevector.astype(np.uint32)
-            if len(statevector) > 0:  # statevector must not be empty
-                return {bitname.format(channel.split(':')[0], key):
-                        bool(logic_map[logic_type](
-                            value.value if len(value.value) > 0 else None))
-                        for key, value in statevector.get_bit_series().items()}
+    if statevector is not None:
+        # FIXME: In the playground environment, the Virgo state vector
+        # channel is stored as a float. Is this also the case in the
+        # production environment?
+        return np.asarray(statevector).astype(np.uint32)
     # FIXME: figure out how to get access to low-latency frames outside
     # of the cluster. Until we figure that out, actual I/O errors have
     # to be non-fatal.
-    return {bitname.format(channel.split(':')[0], key):
-            None for key in bits if key is not None}
+    return None
+
+
+BIT_STATE_DTYPE = np.dtype([
+    ('ifo', 'U2'), ('name', 'U64'), ('injection', '?'), ('state', 'i1')])
+"""Data type of the arrays of bit states that are returned by
+:func:`evaluate_bits`. The fields are the interferometer (e.g. ``H1``), the
+name of the bit (e.g. ``H1:HOFT_OK``), whether the bit indicates the absence
+of a hardware injection, and its state: 1 if the bit passed, 0 if it failed,
+or -1 if it is unknown."""
+
+
+def evaluate_bits(values, ifo, bits, logic_type='all'):
+    """Evaluate all of the bits of a state vector at once.
+
+    Rather than splitting the state vector into one time series per bit, the
+    samples are first combined into a single word with a bitwise AND (for
+    ``all``) or a bitwise OR (for ``any``) along the time axis. Then the mask
+    of every bit is applied to that word. The cost therefore hardly depends
+    on the number of bits, and long windows are cheap to evaluate.
+
+    Parameters
+    ----------
+    values : :class:`numpy.ndarray`, None
+        The samples of the state vector as unsigned integers, or None if the
+        state vector could not be read.
+    ifo : str
+        Interferometer name (e.g. ``H1``).
+    bits: :class:`gwpy.TimeSeries.Bits`
+        Definitions of the bits in the channel.
+    logic_type : str, optional
+        Type of logic to apply for vetoing.
+        If ``all``, then all samples in the window must pass the bitmask.
+        If ``any``, then one or more samples in the window must pass.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        The state of each bit, as a structured array of type
+        :obj:`BIT_STATE_DTYPE`. All states are unknown if `values` is None
+        or empty.
+
+    """
+    if logic_type not in ('any', 'all'):
+        raise ValueError("logic_type must be either 'all' or 'any'.")
+    positions = [position for position, name in enumerate(bits)
+                 if name is not None]
+    names = [bits[position] for position in positions]
+    states = np.empty(len(names), dtype=BIT_STATE_DTYPE)
+    states['ifo'] = ifo
+    states['name'] = ['{}:{}'.format(ifo, name) for name in names]
+    states['injection'] = [name.endswith('_INJ') for name in names]
+    if values is None or len(values) == 0:
+        states['state'] = -1
+    else:
+        reduce = {'all': np.bitwise_and, 'any': np.bitwise_or}[logic_type]
+        word = reduce.reduce(np.asarray(values, dtype=np.uint32))
+        masks = np.left_shift(np.uint32(1),
+                              np.asarray(positions, dtype=np.uint32))
+        states['state'] = (word & masks) != 0
+    return states
 
 
 @app.task(shared=False)
@@ -381,6 +663,9 @@ def check_vectors(event, graceid, start, end):
     A cache is then created for H1, L1, and V1, regardless of the detectors
     involved in the event. Then, the bits and channels specified in the
     configuration file (:obj:`~gwcelery.conf.llhoft_channels`) are checked.
+    If :obj:`~gwcelery.conf.detchar_concurrent_reads` is set, then all of the
+    channels for each detector are read in a single pass over its frame files
+    (see :func:`read_channels`), and the detectors are read in parallel.
     If an injection is found in the active detectors, 'INJ' is labeled to
     GraceDB. If an injection is found in any detector, a message with the
     injection found is logged to GraceDB. If no injections are found across
@@ -431,35 +716,53 @@ def check_vectors(event, graceid, start, end):
 
     ifos = {key.split(':')[0] for key, val in
             app.conf['llhoft_channels'].items()}
-    caches = {ifo: create_cache(ifo, start, end) for ifo in ifos}
     bit_defs = {channel_type: Bits(channel=bitdef['channel'],
                                    bits=bitdef['bits'])
                 for channel_type, bitdef
                 in app.conf['detchar_bit_definitions'].items()}
 
-    # Examine injection and DQ states
     # Do not analyze DMT-DQ_VECTOR if pipeline uses gated h(t)
-    states = {}
     analysis_channels = app.conf['llhoft_channels'].items()
     if app.conf['uses_gatedhoft'][pipeline]:
         analysis_channels = {k: v for k, v in analysis_channels
                              if k[3:] != 'DMT-DQ_VECTOR'}.items()
-    for channel, bits in analysis_channels:
-        states.update(check_vector(caches[channel.split(':')[0]], channel,
-                                   start, end, bit_defs[bits]))
+
+    if app.conf['detchar_concurrent_reads']:
+        # Read all channels for each detector in one pass over its frame
+        # files, and read the detectors in parallel.
+        channels = [*dict(analysis_channels), *app.conf['idq_channels']]
+        ifo_channels = {ifo: [channel for channel in channels
+                              if channel.split(':')[0] == ifo]
+                        for ifo in ifos}
+        with ThreadPoolExecutor(len(ifos) or None) as executor:
+            results = dict(zip(ifos, executor.map(
+                lambda ifo: read_channels(
+                    ifo, ifo_channels[ifo], start, end), ifos)))
+        caches = {ifo: cache for ifo, (cache, _) in results.items()}
+        data = {channel: series for _, ifo_data in results.values()
+                for channel, series in ifo_data.items()}
+    else:
+        caches = {ifo: create_cache(ifo, start, end) for ifo in ifos}
+        data = {}
+
+    # Examine injection and DQ states
+    states = np.concatenate([
+        evaluate_bits(
+            _read_state_vector(caches[channel.split(':')[0]], channel,
+                               start, end, bit_defs[bits],
+                               data.get(channel)),
+            channel.split(':')[0], bit_defs[bits])
+        for channel, bits in analysis_channels] or [
+        np.empty(0, dtype=BIT_STATE_DTYPE)])
     # Pick out DQ and injection states, then filter for active detectors
-    dq_states = {key: value for key, value in states.items()
-                 if key.split('_')[-1] != 'INJ'}
-    inj_states = {key: value for key, value in states.items()
-                  if key.split('_')[-1] == 'INJ'}
-    active_dq_states = {key: value for key, value in dq_states.items()
-                        if key.split(':')[0] in instruments}
-    active_inj_states = {key: value for key, value in inj_states.items()
-                         if key.split(':')[0] in instruments}
+    dq_states = states[~states['injection']]
+    inj_states = states[states['injection']]
+    active_dq_states = dq_states[np.isin(dq_states['ifo'], instruments)]
+    active_inj_states = inj_states[np.isin(inj_states['ifo'], instruments)]
 
     # Check iDQ states
     idq_probs = dict(check_idq(caches[channel.split(':')[0]],
-                               channel, start, end)
+                               channel, start, end, data=data.get(channel))
                      for channel in app.conf['idq_channels'])
 
     # Logging iDQ to GraceDB
@@ -491,18 +794,18 @@ def check_vectors(event, graceid, start, end):
         None, None, graceid, idq_msg + prepost_msg, ['data_quality'])
 
     # Labeling INJ to GraceDB
-    if False in active_inj_states.values():
+    if np.any(active_inj_states['state'] == 0):
         # Label 'INJ' if injection found in active IFOs
         gracedb.create_label('INJ', graceid)
         # Add labels to return value to avoid querying GraceDB again.
         event = dict(event, labels=event.get('labels', []) + ['INJ'])
-    if False in inj_states.values():
+    if np.any(inj_states['state'] == 0):
         # Write all found injections into GraceDB log
-        injs = [k for k, v in inj_states.items() if v is False]
+        injs = inj_states['name'][inj_states['state'] == 0].tolist()
         inj_fmt = "Injection found.\n{}\n"
         inj_msg = inj_fmt.format(
             generate_table('Injection bits', [], injs, []))
-    elif all(inj_states.values()) and len(inj_states.values()) > 0:
+    elif len(inj_states) > 0 and np.all(inj_states['state'] == 1):
         inj_msg = 'No HW injections found. '
         gracedb.remove_label('INJ', graceid)
         event = dict(event, labels=list(event.get('labels', [])))
@@ -516,16 +819,15 @@ def check_vectors(event, graceid, start, end):
         None, None, graceid, inj_msg + prepost_msg, ['data_quality'])
 
     # Determining overall_dq_active_state
-    if None in active_dq_states.values() or len(
-            active_dq_states.values()) == 0:
+    if np.any(active_dq_states['state'] < 0) or len(active_dq_states) == 0:
         overall_dq_active_state = None
-    elif False in active_dq_states.values():
+    elif np.any(active_dq_states['state'] == 0):
         overall_dq_active_state = False
-    elif all(active_dq_states.values()):
+    else:
         overall_dq_active_state = True
-    goods = [k for k, v in dq_states.items() if v is True]
-    bads = [k for k, v in dq_states.items() if v is False]
-    unknowns = [k for k, v in dq_states.items() if v is None]
+    goods = dq_states['name'][dq_states['state'] == 1].tolist()
+    bads = dq_states['name'][dq_states['state'] == 0].tolist()
+    unknowns = dq_states['name'][dq_states['state'] < 0].tolist()
     fmt = "Detector state for active instruments is {}.\n{}"
     msg = fmt.format(
         {None: 'unknown', False: 'bad', True: 'good'}[overall_dq_active_state],
@@ -569,7 +871,7 @@ def check_vectors(event, graceid, start, end):
         json_state = "error"
     else:
         json_state = state
-    file = dqr_json(json_state, state_summary)
+    file = dqr_json(json_state, state_summary, states)
     filename = 'gwcelerydetcharcheckvectors-{}.json'.format(graceid)
     message = "DQR-compatible json generated from check_vectors results"
     gracedb.upload.delay(
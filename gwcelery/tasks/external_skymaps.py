@@ -1,12 +1,17 @@
 """Create and upload external sky maps."""
+import functools
+import gzip
+import io
+
 from astropy import units as u
-from astropy.coordinates import ICRS, SkyCoord
-from astropy_healpix import HEALPix, pixel_resolution_to_nside
+from astropy.table import Table
+from astropy.time import Time
+from astropy_healpix import pixel_resolution_to_nside
 from celery import group
 #  import astropy.utils.data
 import numpy as np
-from ligo.skymap.io import fits
-from ligo.skymap.tool import ligo_skymap_combine
+from ligo.skymap.distance import parameters_to_marginal_moments
+from ligo.skymap.io import fits, read_sky_map
 import gcn
 import healpy as hp
 import lxml.etree
@@ -17,7 +22,6 @@ import urllib
 from ..import app
 from . import gracedb
 from . import skymaps
-from ..util.cmdline import handling_system_exit
 from ..util.tempfile import NamedTemporaryFile
 from ..import _version
 
@@ -26,15 +30,12 @@ def create_combined_skymap(se_id, ext_id):
     """Creates and uploads the combined LVC-Fermi skymap.
 
     This also uploads the external trigger skymap to the external trigger
-    GraceDB page.
+    GraceDB page. Both sky maps are downloaded concurrently.
     """
     se_skymap_filename = get_skymap_filename(se_id)
     ext_skymap_filename = get_skymap_filename(ext_id)
     new_skymap_filename = re.findall(r'(.*).fits.gz', se_skymap_filename)[0]
 
-    #  FIXME: put download functions in canvas
-    se_skymap = gracedb.download(se_skymap_filename, se_id)
-    ext_skymap = gracedb.download(ext_skymap_filename, ext_id)
     message = 'Combined LVC-external sky map using {0} and {1}'.format(
         se_skymap_filename, ext_skymap_filename)
     message_png = (
@@ -43,7 +44,12 @@ def create_combined_skymap(se_id, ext_id):
             graceid=se_id, filename=new_skymap_filename + '-ext.fits.gz')
 
     (
-        combine_skymaps.si(se_skymap, ext_skymap)
+        group(
+            gracedb.download.si(se_skymap_filename, se_id),
+            gracedb.download.si(ext_skymap_filename, ext_id)
+        )
+        |
+        combine_skymaps.s()
         |
         group(
             gracedb.upload.s(new_skymap_filename + '-ext.fits.gz', se_id,
@@ -59,40 +65,123 @@ def create_combined_skymap(se_id, ext_id):
 
 @app.task(autoretry_for=(ValueError,), retry_backoff=10,
           retry_backoff_max=600)
-def get_skymap_filename(graceid):
+def get_skymap_filename(graceid, versioned=False):
     """Get the skymap fits filename.
 
+    If `versioned` is True, then return the versioned filename (for example,
+    ``bayestar.fits.gz,0``), which identifies the contents of the file.
+
     If not available, will try again 10 seconds later, then 20, then 40, etc.
     until up to 10 minutes after initial attempt.
     """
     gracedb_log = gracedb.get_log(graceid)
     if 'S' in graceid:
-        for message in reversed(gracedb_log):
-            filename = message['filename']
-            if filename.endswith('.fits.gz'):
-                return filename
+        extensions = ('.fits.gz',)
     else:
-        for message in reversed(gracedb_log):
-            filename = message['filename']
-            if (filename.endswith('.fits') or filename.endswith('.fit') or
-                    filename.endswith('.fits.gz')):
-                return filename
+        extensions = ('.fits', '.fit', '.fits.gz')
+    for message in reversed(gracedb_log):
+        filename = message['filename']
+        if filename.endswith(extensions):
+            if versioned:
+                return '{},{}'.format(filename, message['file_version'])
+            return filename
     raise ValueError('No skymap available for {0} yet.'.format(graceid))
 
 
+@functools.lru_cache(maxsize=4)
+def _ring_index(nside):
+    """Get the RING index of each pixel of a NESTED HEALPix map, as a
+    read-only array, for reordering RING-ordered sky maps.
+    """
+    index = hp.nest2ring(nside, np.arange(hp.nside2npix(nside)))
+    index.flags.writeable = False
+    return index
+
+
+def _read_nested_skymap(filecontents):
+    """Read a sky map from the byte contents of a FITS file as a NESTED table
+    with a ``PROB`` column and any distance columns, and its metadata.
+
+    Multi-order sky maps are flattened with
+    :func:`gwcelery.tasks.skymaps.rasterize_moc`, and RING-ordered sky maps
+    are reordered with the cached index of :func:`_ring_index`.
+    """
+    with skymaps.open_fits(filecontents) as hdus:
+        if 'UNIQ' in hdus[1].columns.names:
+            table = skymaps.rasterize_moc(read_sky_map(hdus, moc=True))
+            return table, table.meta
+        has_distance = 'DISTMU' in hdus[1].columns.names
+        data, meta = read_sky_map(hdus, nest=None, distances=has_distance)
+    names = ['PROB', 'DISTMU', 'DISTSIGMA', 'DISTNORM']
+    table = Table(data if has_distance else [data],
+                  names=names if has_distance else names[:1])
+    if not meta['nest']:
+        table = table[_ring_index(hp.npix2nside(len(table)))]
+    return table, meta
+
+
 @app.task(shared=False)
-def combine_skymaps(skymap1filebytes, skymap2filebytes):
-    """This task combines the two input skymaps, in this case the external
-    trigger skymap and the LVC skymap and writes to a temporary output file. It
-    then returns the contents of the file as a byte array.
+def combine_skymaps(skymaps_filebytes):
+    """Combine sky maps by multiplying their probabilities, and return the
+    contents of the combined gzip-compressed FITS file.
+
+    This does the same thing as the command-line tool
+    :doc:`ligo-skymap-combine <ligo.skymap:tool/ligo_skymap_combine>`, but
+    without writing any temporary files. The sky maps are combined at the
+    highest resolution of the inputs, in NESTED ordering. The distance
+    layers, if any, are taken from the first sky map that has them.
+
+    Parameters
+    ----------
+    skymaps_filebytes : list
+        The byte contents of the FITS files, in this case the LVC sky map
+        (which may be multi-order) and the external trigger sky map.
+
+    Returns
+    -------
+    bytes
+        The byte contents of the combined FITS file.
+
     """
-    with NamedTemporaryFile(mode='rb', suffix='.fits.gz') as combinedskymap, \
-            NamedTemporaryFile(content=skymap1filebytes) as skymap1file, \
-            NamedTemporaryFile(content=skymap2filebytes) as skymap2file, \
-            handling_system_exit():
-        ligo_skymap_combine.main([skymap1file.name,
-                                  skymap2file.name, combinedskymap.name])
-        return combinedskymap.read()
+    tables, metas = zip(*(_read_nested_skymap(filebytes)
+                          for filebytes in skymaps_filebytes))
+    npix = max(len(table) for table in tables)
+
+    prob = None
+    distances = None
+    for table in tables:
+        repeats = npix // len(table)
+        layer = np.repeat(np.asarray(table['PROB']), repeats)
+        prob = layer if prob is None else prob * layer
+        if distances is None and 'DISTMU' in table.colnames:
+            distances = [np.repeat(np.asarray(table[name]), repeats)
+                         for name in ['DISTMU', 'DISTSIGMA', 'DISTNORM']]
+
+    norm = prob.sum()
+    if norm <= 0:
+        raise ValueError('input sky maps are disjoint')
+    prob /= norm
+
+    kwargs = {'gps_creation_time': Time.now().gps}
+    gps_times = [meta['gps_time'] for meta in metas if 'gps_time' in meta]
+    if gps_times:
+        kwargs['gps_time'] = np.mean(gps_times)
+    instruments = set()
+    for meta in metas:
+        instruments.update(meta.get('instruments', ()))
+    if instruments:
+        kwargs['instruments'] = instruments
+    if distances is not None:
+        kwargs['distmean'], kwargs['diststd'], _ = \
+            parameters_to_marginal_moments(prob, *distances[:2])
+        data = (prob, *distances)
+    else:
+        data = prob
+
+    with io.BytesIO() as f:
+        with gzip.GzipFile(fileobj=f, mode='wb') as gzfile:
+            fits.write_sky_map(gzfile, data, nest=True, **kwargs)
+        return f.getvalue()
 
 
 @app.task(shared=False)
@@ -203,6 +292,88 @@ def get_upload_external_skymap(graceid, search, skymap_link=None):
     ).delay()
 
 
+_MAX_CACHED_NSIDE = 256
+"""Largest resolution for which :func:`_unit_vectors` caches the unit vectors
+of all pixels. The table takes 24 bytes per pixel, so this limits it to about
+19 MB."""
+
+_GAUSSIAN_TRUNCATION = 10.0
+"""Number of standard deviations beyond which Gaussian sky maps are set to
+zero at resolutions above :obj:`_MAX_CACHED_NSIDE`."""
+
+_FERMI_SYSTEMATICS = {
+    # Flight notice: values from first row of Table 7
+    gcn.NoticeType.FERMI_GBM_FLT_POS: ([0.897, 0.103], [7.52, 55.6]),
+    # Ground notice: values from first row of Table 3
+    gcn.NoticeType.FERMI_GBM_GND_POS: ([0.804, 0.196], [3.72, 13.7]),
+    # Final notice: values from second row of Table 3
+    gcn.NoticeType.FERMI_GBM_FIN_POS: ([0.900, 0.100], [3.71, 14.3])}
+"""Weights and scales in degrees of the core and tail Gaussians that account
+for Fermi GBM systematics, by notice type."""
+
+
+@functools.lru_cache(maxsize=4)
+def _unit_vectors(nside):
+    """Get the unit vectors of all pixels of a RING-ordered HEALPix map, as a
+    read-only array of shape ``(npix, 3)``.
+    """
+    xyz = np.column_stack(hp.pix2vec(nside, np.arange(hp.nside2npix(nside))))
+    xyz.flags.writeable = False
+    return xyz
+
+
+def _gaussian_skymap(nside, ra, dec, sigma):
+    """Evaluate a normalized Gaussian on a RING-ordered HEALPix map.
+
+    The angular distance of each pixel from the center is computed from the
+    dot product of their unit vectors.
+
+    Parameters
+    ----------
+    nside : int
+        HEALPix resolution.
+    ra, dec : float
+        Center in degrees.
+    sigma : float
+        Standard deviation in radians.
+
+    Returns
+    -------
+    skymap : numpy array
+        sky map array
+
+    """
+    center = hp.ang2vec(ra, dec, lonlat=True)
+    if nside <= _MAX_CACHED_NSIDE:
+        ipix = slice(None)
+        xyz = _unit_vectors(nside)
+    else:
+        ipix = hp.query_disc(nside, center, _GAUSSIAN_TRUNCATION * sigma)
+        xyz = np.column_stack(hp.pix2vec(nside, ipix))
+    distance = np.arccos(np.clip(xyz @ center, -1, 1))
+    skymap = np.zeros(hp.nside2npix(nside))
+    skymap[ipix] = np.exp(-0.5 * np.square(distance / sigma))
+    return skymap / skymap.sum()
+
+
+@functools.lru_cache(maxsize=16)
+def _fermi_beam_window(notice_type, lmax):
+    """Get the combined harmonic-space window of the core and tail Gaussians
+    for Fermi GBM systematics.
+    """
+    try:
+        weights, scales = _FERMI_SYSTEMATICS[notice_type]
+    except KeyError:
+        raise AssertionError(
+            'Need to provide a supported Fermi notice type')
+    window = sum(
+        weight * hp.gauss_beam(
+            np.radians(scale) * np.sqrt(8 * np.log(2)), lmax=lmax)
+        for weight, scale in zip(weights, scales))
+    window.flags.writeable = False
+    return window
+
+
 def create_external_skymap(ra, dec, error, pipeline, notice_type=111):
     """Create a sky map, either a gaussian or a single
     pixel sky map, given an RA, dec, and error radius.
@@ -229,6 +400,14 @@ def create_external_skymap(ra, dec, error, pipeline, notice_type=111):
     skymap : numpy array
         sky map array
 
+    Notes
+    -----
+    The unit vectors of the pixels are cached for each resolution, so that
+    evaluating a Gaussian only costs one matrix-vector product. Because
+    convolution is linear, the core and tail Gaussians for Fermi are applied
+    together: the sky map is transformed to spherical harmonics once, and is
+    multiplied by the weighted sum of the two (cached) beam windows.
+
     """
     max_nside = 2048
     if error:
@@ -243,47 +422,22 @@ def create_external_skymap(ra, dec, error, pipeline, notice_type=111):
         nside = max_nside
 
         #  Find the one pixel the event can localized to
-        hpx = HEALPix(nside, 'ring', frame=ICRS())
-        skymap = np.zeros(hpx.npix)
-        ind = hpx.lonlat_to_healpix(ra * u.deg, dec * u.deg)
+        skymap = np.zeros(hp.nside2npix(nside))
+        ind = hp.ang2pix(nside, ra, dec, lonlat=True)
         skymap[ind] = 1.
     else:
         #  If larger error, create gaussian sky map
-        hpx = HEALPix(nside, 'ring', frame=ICRS())
-        ipix = np.arange(hpx.npix)
-
-        #  Evaluate Gaussian.
-        center = SkyCoord(ra * u.deg, dec * u.deg)
-        distance = hpx.healpix_to_skycoord(ipix).separation(center)
-        skymap = np.exp(-0.5 * np.square(distance / error_radius).to_value(
-            u.dimensionless_unscaled))
-        skymap /= skymap.sum()
+        skymap = _gaussian_skymap(nside, ra, dec, np.radians(error))
     if pipeline == 'Fermi':
         # Correct for Fermi systematics based on recommendations from GBM team
         # Convolve with both a narrow core and wide tail Gaussian with error
         # radius determined by the scales respectively, each comprising a
         # fraction determined by the weights respectively
-        if notice_type == gcn.NoticeType.FERMI_GBM_FLT_POS:
-            # Flight notice
-            # Values from first row of Table 7
-            weights = [0.897, 0.103]
-            scales = [7.52, 55.6]
-        elif notice_type == gcn.NoticeType.FERMI_GBM_GND_POS:
-            # Ground notice
-            # Values from first row of Table 3
-            weights = [0.804, 0.196]
-            scales = [3.72, 13.7]
-        elif notice_type == gcn.NoticeType.FERMI_GBM_FIN_POS:
-            # Final notice
-            # Values from second row of Table 3
-            weights = [0.900, 0.100]
-            scales = [3.71, 14.3]
-        else:
-            raise AssertionError(
-                'Need to provide a supported Fermi notice type')
-        skymap = sum(
-            weight * hp.sphtfunc.smoothing(skymap, sigma=np.radians(scale))
-            for weight, scale in zip(weights, scales))
+        nside = hp.npix2nside(len(skymap))
+        lmax = 3 * nside - 1
+        window = _fermi_beam_window(notice_type, lmax)
+        alm = hp.map2alm(skymap, lmax=lmax, iter=3)
+        skymap = hp.alm2map(hp.almxfl(alm, window), nside, lmax=lmax)
 
     # Renormalize due to possible lack of precision
     return skymap / skymap.sum()
@@ -197,8 +197,8 @@ def handle_grb_lvalert(alert):
     GRB external trigger event, or a label associated with completeness of sky
     maps:
 
-    * Any new event triggers a coincidence search with
-      :meth:`gwcelery.tasks.raven.coincidence_search`.
+    * Any new event triggers coincidence searches with
+      :meth:`gwcelery.tasks.raven.coincidence_searches`.
     * When both a GW and GRB sky map are available during a coincidence,
       indicated by the labels ``SKYMAP_READY`` and ``EXT_SKYMAP_READY``
       respectfully, this trigger the spacetime coinc FAR to be calculated. If
@@ -221,32 +221,28 @@ def handle_grb_lvalert(alert):
                     alert['object'], None, alert['object']['created'])
 
             # launch standard Burst-GRB search
-            raven.coincidence_search(graceid, alert['object'], group='Burst')
+            specs = [('Burst', [], None)]
 
             if alert['object']['search'] in ['SubGRB', 'SubGRBTargeted']:
                 # if sub-threshold GRB, launch search with that pipeline
-                raven.coincidence_search(
-                    graceid, alert['object'], group='CBC',
-                    searches=['SubGRB', 'SubGRBTargeted'],
-                    pipelines=[alert['object']['pipeline']])
+                specs.append(('CBC', [alert['object']['pipeline']],
+                              ['SubGRB', 'SubGRBTargeted']))
             else:
                 # if threshold GRB, launch standard CBC-GRB search
-                raven.coincidence_search(graceid, alert['object'],
-                                         group='CBC', searches=['GRB'])
+                specs.append(('CBC', [], ['GRB']))
+            raven.coincidence_searches(graceid, alert['object'], specs)
         elif 'S' in graceid:
             # launch standard GRB search based on group
             preferred_event_id = alert['object']['preferred_event']
             gw_group = gracedb.get_group(preferred_event_id)
-            raven.coincidence_search(graceid, alert['object'],
-                                     group=gw_group, searches=['GRB'])
+            specs = [(gw_group, [], ['GRB'])]
             if gw_group == 'CBC':
                 # launch subthreshold searches if CBC
                 # for Fermi and Swift separately to use different time windows
-                for pipeline in ['Fermi', 'Swift']:
-                    raven.coincidence_search(
-                        graceid, alert['object'], group='CBC',
-                        searches=['SubGRB', 'SubGRBTargeted'],
-                        pipelines=[pipeline])
+                specs.extend(
+                    ('CBC', [pipeline], ['SubGRB', 'SubGRBTargeted'])
+                    for pipeline in ['Fermi', 'Swift'])
+            raven.coincidence_searches(graceid, alert['object'], specs)
 
     # rerun raven pipeline or created combined sky map when sky maps are
     # available
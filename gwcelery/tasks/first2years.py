@@ -7,13 +7,12 @@ from celery.task import PeriodicTask
 from celery.utils.log import get_task_logger
 from ligo.lw import utils
 from ligo.lw import lsctables
-import ligo.lw.table
 import lal
-from ligo.skymap.io.events.ligolw import ContentHandler
 import numpy as np
 
 from ..data import first2years as data_first2years
 from ..import app
+from ..util.ligolw import load_ligolw
 from . import gracedb
 
 log = get_task_logger(__name__)
@@ -21,19 +20,16 @@ log = get_task_logger(__name__)
 
 def pick_coinc():
     """Pick a coincidence from the "First Two Years" paper."""
-    with resources.open_binary(data_first2years, 'gstlal.xml.gz') as f:
-        xmldoc = utils.load_fileobj(f, contenthandler=ContentHandler)
-    root, = xmldoc.childNodes
-
-    # Remove unneeded tables
-    for name in (
+    # Skip unneeded tables
+    xmldoc = load_ligolw(
+        resources.read_binary(data_first2years, 'gstlal.xml.gz'),
+        exclude_tables={
             'filter',  # lsctables.FilterTable removed from ligo.lw
             lsctables.SegmentTable.tableName,
             lsctables.SegmentDefTable.tableName,
             lsctables.SimInspiralTable.tableName,
             lsctables.SummValueTable.tableName,
-            lsctables.SearchSummVarsTable.tableName):
-        root.removeChild(ligo.lw.table.get_table(xmldoc, name))
+            lsctables.SearchSummVarsTable.tableName})
 
     coinc_inspiral_table = table = lsctables.CoincInspiralTable.get_table(
         xmldoc)
@@ -111,8 +107,7 @@ def pick_coinc():
 
 
 def _jitter_snr(coinc_bytes):
-    coinc_xml = io.BytesIO(coinc_bytes)
-    xmldoc = utils.load_fileobj(coinc_xml, contenthandler=ContentHandler)
+    xmldoc = load_ligolw(coinc_bytes)
 
     coinc_inspiral_table = lsctables.CoincInspiralTable.get_table(xmldoc)
 
@@ -1,17 +1,49 @@
 """Communication with GraceDB."""
 from requests.exceptions import ConnectionError, HTTPError
 import functools
+import hashlib
+import inspect
+import pickle
 import re
 
+from astropy.time import Time
 from celery.utils.log import get_task_logger
 import gracedb_sdk
 
 from ..import app
-from ..util import PromiseProxy
+from ..import blobs
+from ..util import PooledHTTPAdapter, PromiseProxy
 
-client = PromiseProxy(gracedb_sdk.Client,
-                      ('https://' + app.conf.gracedb_host + '/api/',),
-                      {'fail_if_noauth': True, 'cert_reload': True})
+transport = PromiseProxy(PooledHTTPAdapter, (), {
+    'pool_maxsize': app.conf['gracedb_pool_maxsize'],
+    'pool_block': app.conf['gracedb_pool_block']})
+"""HTTP connection pool that is shared by :obj:`client` and by
+:obj:`gwcelery.tasks.legacy_gracedb.client`. See
+:attr:`~gwcelery.util.transport.PooledHTTPAdapter.stats` for statistics."""
+
+
+def mount_transport(session):
+    """Send all requests from a :class:`requests.Session` to the GraceDB
+    server through the shared connection pool, :obj:`transport`.
+
+    The shared connection pool creates connections in the same way as the
+    adapter that it replaces (see
+    :meth:`~gwcelery.util.transport.PooledHTTPAdapter.compose`), so that the
+    client certificate is still reloaded before it expires.
+    """
+    prefix = 'https://' + app.conf['gracedb_host'] + '/'
+    transport.compose(session.get_adapter(prefix))
+    session.mount(prefix, transport)
+
+
+def _create_client(url):
+    client = gracedb_sdk.Client(url, fail_if_noauth=True, cert_reload=True)
+    mount_transport(client.session)
+    return client
+
+
+client = PromiseProxy(_create_client,
+                      ('https://' + app.conf.gracedb_host + '/api/',))
 
 log = get_task_logger(__name__)
 
@@ -48,6 +80,271 @@ def task(*args, **kwargs):
                     retry_kwargs=dict(max_retries=10))
 
 
+_CACHE_PREFIX = __name__ + '.cache:'
+"""Prefix for the Redis keys of the GraceDB read cache."""
+
+
+def _generation_key(graceid):
+    return '{}{}:generation'.format(_CACHE_PREFIX, graceid)
+
+
+def _cache_generation(graceid):
+    """Get the generation of the cached reads for an event or superevent.
+
+    The generation is incremented by :func:`invalidate_cache` and is part of
+    the Redis keys of the cached reads. A read that started before the event
+    or superevent was modified therefore stores its possibly stale result
+    under a key of an old generation, which is never looked up again.
+    """
+    return int(app.backend.client.get(_generation_key(graceid)) or 0)
+
+
+def _cache_key(name, graceid, generation):
+    return '{}{}:{}:{}'.format(_CACHE_PREFIX, graceid, generation, name)
+
+
+def cached_read(f):
+    """Decorator to cache the results of a task that reads an object from
+    GraceDB, keyed by graceid.
+
+    The results are kept in Redis for
+    :obj:`~gwcelery.conf.gracedb_cache_ttl` seconds, or until they are
+    invalidated by :func:`invalidate_cache`.
+    """
+    @functools.wraps(f)
+    def wrapper(graceid):
+        ttl = app.conf['gracedb_cache_ttl']
+        if not ttl:
+            return f(graceid)
+        redis = app.backend.client
+        key = _cache_key(f.__name__, graceid, _cache_generation(graceid))
+        value = redis.get(key)
+        if value is not None:
+            redis.incr(_CACHE_PREFIX + 'hits')
+            return pickle.loads(value)
+        redis.incr(_CACHE_PREFIX + 'misses')
+        result = f(graceid)
+        redis.set(key, pickle.dumps(result), px=int(ttl * 1000))
+        return result
+
+    return wrapper
+
+
+def invalidate_cache(*graceids):
+    """Discard all cached reads and downloads for the given GraceDB events or
+    superevents.
+    """
+    ttl = max(app.conf['gracedb_cache_ttl'],
+              app.conf['gracedb_download_cache_ttl'])
+    if ttl and graceids:
+        with app.backend.client.pipeline() as pipe:
+            for graceid in graceids:
+                key = _generation_key(graceid)
+                pipe.incr(key)
+                # Keep the generation for longer than any cached read of an
+                # older generation, so that it is not reset while they exist.
+                pipe.pexpire(key, int(2 * ttl * 1000))
+            pipe.execute()
+
+
+def invalidates_cache(f):
+    """Decorator for tasks that modify GraceDB events or superevents, to
+    invalidate cached reads for the objects that are named by their
+    ``graceid`` and ``superevent_id`` arguments.
+    """
+    signature = inspect.signature(f)
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs).arguments
+        try:
+            return f(*args, **kwargs)
+        finally:
+            invalidate_cache(*(arguments[name]
+                               for name in ('superevent_id', 'graceid')
+                               if name in arguments))
+
+    return wrapper
+
+
+def cache_stats():
+    """Get the numbers of hits and misses of the GraceDB read cache. Downloads
+    of files are counted separately (see :meth:`download_cache_stats`).
+
+    Returns
+    -------
+    stats : dict
+        A dictionary with keys ``hits`` and ``misses``.
+
+    """
+    redis = app.backend.client
+    return {key: int(redis.get(_CACHE_PREFIX + key) or 0)
+            for key in ('hits', 'misses')}
+
+
+def _log_index_key(graceid):
+    return '{}.log_index:{}'.format(__name__, graceid)
+
+
+def index_log_entries(graceid, *entries):
+    r"""Record the numbers of the log messages for files that were uploaded to
+    an event or superevent, so that :meth:`create_tag` can find them without
+    fetching the whole log.
+
+    The index is kept in Redis for :obj:`~gwcelery.conf.gracedb_log_index_ttl`
+    seconds after the last file was added to it.
+
+    Parameters
+    ----------
+    graceid : str
+        The event or superevent ID.
+    \*entries : dict
+        Log entries, such as the return value of :meth:`get_log`, the result of
+        creating a log entry, or the ``data`` field of an LVAlert message.
+
+    """
+    ttl = app.conf['gracedb_log_index_ttl']
+    if not ttl:
+        return
+    mapping = {'{},{}'.format(entry['filename'], entry['file_version']):
+               entry['N'] for entry in entries
+               if entry.get('filename') and 'file_version' in entry
+               and 'N' in entry}
+    if mapping:
+        key = _log_index_key(graceid)
+        with app.backend.client.pipeline() as pipe:
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, int(ttl))
+            pipe.execute()
+
+
+_TRIGGER_INDEX_MARGIN = 600.0
+"""Time in seconds after the trigger index is created, or after the LVAlert
+listener connects, before the index is trusted. This allows for superevents
+that were created just before then with :math:`t_0` in the future (early
+warning)."""
+
+
+def _trigger_index_key(kind):
+    return '{}.trigger_index:{}'.format(__name__, kind)
+
+
+def index_trigger(obj):
+    """Record the GPS time of an external event or superevent in a
+    time-sorted index, so that coincidence searches can tell whether there
+    are any candidates without querying GraceDB.
+
+    The index is kept in Redis as a sorted set for each kind of object.
+    Entries are discarded :obj:`~gwcelery.conf.gracedb_trigger_index_ttl`
+    seconds after their GPS time.
+
+    Parameters
+    ----------
+    obj : dict
+        The ``object`` field of an LVAlert message. Objects other than
+        external events and superevents are ignored.
+
+    """
+    ttl = app.conf['gracedb_trigger_index_ttl']
+    if not ttl:
+        return
+    if obj.get('superevent_id'):
+        kind, graceid, gpstime = 'Superevent', obj['superevent_id'], obj['t_0']
+    elif obj.get('group') == 'External':
+        kind, graceid, gpstime = 'External', obj['graceid'], obj['gpstime']
+    else:
+        return
+    key = _trigger_index_key(kind)
+    now = Time.now().gps
+    with app.backend.client.pipeline() as pipe:
+        pipe.set(key + ':since', now + _TRIGGER_INDEX_MARGIN, nx=True)
+        pipe.zadd(key, {graceid: float(gpstime)})
+        pipe.zremrangebyscore(key, '-inf', now - ttl)
+        pipe.expire(key, int(ttl))
+        pipe.expire(key + ':since', int(ttl))
+        pipe.execute()
+
+
+_LVALERT_LISTENER_KEY = __name__ + '.lvalert_listener'
+"""Redis key for the GPS time since which the LVAlert listener has been
+connected."""
+
+
+def record_lvalert_listener(since, ttl):
+    """Record that the LVAlert listener is connected, and has been connected
+    without interruption since a given time, or that it is disconnected.
+
+    The trigger index is only trusted while the LVAlert listener that keeps
+    it up to date is connected, so the listener must call this periodically.
+
+    Parameters
+    ----------
+    since : float, None
+        GPS time at which the listener connected, or None if it is
+        disconnected.
+    ttl : float
+        Forget that the listener is connected after this many seconds, unless
+        this function is called again.
+
+    """
+    redis = app.backend.client
+    if since is None:
+        redis.delete(_LVALERT_LISTENER_KEY)
+    else:
+        redis.set(_LVALERT_LISTENER_KEY, since, px=int(ttl * 1000))
+
+
+def lookup_triggers(kind, start, end):
+    """Look up external events or superevents in the trigger index that is
+    maintained by :meth:`index_trigger`.
+
+    Parameters
+    ----------
+    kind : {'External', 'Superevent'}
+        The kind of objects to look up.
+    start, end : float
+        GPS time interval, inclusive.
+
+    Returns
+    -------
+    list, None
+        The IDs of the objects whose GPS times are in the interval, or None if
+        the index is disabled or does not cover the whole interval, in which
+        case GraceDB must be queried instead.
+
+    Notes
+    -----
+    The index only covers the time since both the index was created and the
+    LVAlert listener last connected (see :meth:`record_lvalert_listener`),
+    plus a margin. If the listener is not connected, or has stopped
+    reporting that it is connected, then the index does not cover anything,
+    because it may have missed LVAlert messages.
+
+    """
+    ttl = app.conf['gracedb_trigger_index_ttl']
+    if not ttl:
+        return None
+    redis = app.backend.client
+    key = _trigger_index_key(kind)
+    since = redis.get(key + ':since')
+    listener_since = redis.get(_LVALERT_LISTENER_KEY)
+    if since is None or listener_since is None or start < max(
+            float(since), float(listener_since) + _TRIGGER_INDEX_MARGIN,
+            Time.now().gps - ttl):
+        return None
+    return [graceid.decode() for graceid in redis.zrangebyscore(
+        key, start, end)]
+
+
+def _lookup_log_number(graceid, filename, file_version):
+    if not app.conf['gracedb_log_index_ttl']:
+        return None
+    log_number = app.backend.client.hget(
+        _log_index_key(graceid), '{},{}'.format(filename, file_version))
+    if log_number is not None:
+        return int(log_number)
+
+
 versioned_filename_regex = re.compile(
     r'^(?P<filename>.*?)(?:,(?P<file_version>\d+))?$')
 
@@ -73,6 +370,7 @@ def create_event(filecontents, search, pipeline, group, labels=()):
 
 @task(ignore_result=True, shared=False)
 @catch_retryable_http_errors
+@invalidates_cache
 def create_label(label, graceid):
     """Create a label in GraceDB."""
     try:
@@ -92,6 +390,7 @@ def create_label(label, graceid):
 
 @task(ignore_result=True, shared=False)
 @catch_retryable_http_errors
+@invalidates_cache
 def remove_label(label, graceid):
     """Remove a label in GraceDB."""
     try:
@@ -106,6 +405,7 @@ def remove_label(label, graceid):
 
 @task(ignore_result=True, shared=False)
 @catch_retryable_http_errors
+@invalidates_cache
 def create_signoff(status, comment, signoff_type, graceid):
     """Create a signoff in GraceDB."""
     try:
@@ -121,16 +421,27 @@ def create_signoff(status, comment, signoff_type, graceid):
 
 @task(ignore_result=True, shared=False)
 @catch_retryable_http_errors
+@invalidates_cache
 def create_tag(filename, tag, graceid):
-    """Create a tag in GraceDB."""
+    """Create a tag in GraceDB.
+
+    The log message for the file is looked up in the index that is maintained
+    by :func:`index_log_entries`, if possible, or else by searching the full
+    log for the event.
+    """
     filename, file_version = _parse_versioned_filename(filename)
-    log = get_log(graceid)
-    if file_version is None:
-        *_, entry = (e for e in log if e['filename'] == filename)
-    else:
-        *_, entry = (e for e in log if e['filename'] == filename
-                     and e['file_version'] == file_version)
-    log_number = entry['N']
+    log_number = None
+    if file_version is not None:
+        log_number = _lookup_log_number(graceid, filename, file_version)
+    if log_number is None:
+        log = get_log(graceid)
+        index_log_entries(graceid, *log)
+        if file_version is None:
+            *_, entry = (e for e in log if e['filename'] == filename)
+        else:
+            *_, entry = (e for e in log if e['filename'] == filename
+                         and e['file_version'] == file_version)
+        log_number = entry['N']
     try:
         client.events[graceid].logs[log_number].tags.create(tag)
     except HTTPError as e:
@@ -143,6 +454,7 @@ def create_tag(filename, tag, graceid):
 
 @task(shared=False)
 @catch_retryable_http_errors
+@invalidates_cache
 def create_voevent(graceid, voevent_type, **kwargs):
     """Create a VOEvent.
 
@@ -157,16 +469,150 @@ def create_voevent(graceid, voevent_type, **kwargs):
     return response['filename']
 
 
+_DOWNLOAD_LOCK_TIMEOUT = 60
+"""Maximum time in seconds for one worker to hold the lock on a download."""
+
+
+def download_stats():
+    """Get the numbers of bytes that were downloaded from GraceDB for each
+    file name, not counting downloads that were shared through the download
+    cache.
+
+    Returns
+    -------
+    stats : dict
+        A dictionary of file names (without versions) and numbers of bytes.
+
+    """
+    redis = app.backend.client
+    return {key.decode(): int(value) for key, value
+            in redis.hgetall(_CACHE_PREFIX + 'download_bytes').items()}
+
+
+def download_cache_stats():
+    """Get the numbers of downloads from GraceDB that were shared through the
+    download cache (hits) and that were not (misses).
+
+    Returns
+    -------
+    stats : dict
+        A dictionary with keys ``hits`` and ``misses``.
+
+    """
+    redis = app.backend.client
+    return {key: int(redis.get(_CACHE_PREFIX + 'download_' + key) or 0)
+            for key in ('hits', 'misses')}
+
+
+def _download(filename, graceid):
+    with client.events[graceid].files[filename].get() as f:
+        data = f.read()
+    if app.conf['gracedb_download_cache_ttl']:
+        app.backend.client.hincrby(_CACHE_PREFIX + 'download_bytes',
+                                   filename.partition(',')[0], len(data))
+    return data
+
+
+_NOT_SHARED = object()
+"""Sentinel for a file that was too large to share through Redis."""
+
+
+def _get_shared_download(key):
+    """Get the contents of a file that was shared by :func:`_share_download`.
+
+    Returns
+    -------
+    bytes, :obj:`_NOT_SHARED`, None
+        The contents of the file, :obj:`_NOT_SHARED` if the file was too large
+        to share, or None if it has not been downloaded or has expired.
+
+    """
+    entry = app.backend.client.hgetall(key)
+    if b'data' in entry:
+        return entry[b'data']
+    elif b'blob' in entry:
+        store = blobs.get_blob_store()
+        if store is not None:
+            try:
+                return store.get(entry[b'blob'].decode())
+            except (KeyError, FileNotFoundError):
+                pass  # The blob has expired
+    elif b'size' in entry:
+        return _NOT_SHARED
+
+
+def _share_download(key, data, ttl):
+    """Share the contents of a downloaded file with other workers.
+
+    If a blob store is configured, then the contents are kept in it, and only
+    their digest is kept in Redis. Otherwise, the contents are kept in Redis
+    if they are no larger than
+    :obj:`~gwcelery.conf.gracedb_download_cache_max_size`.
+    """
+    store = blobs.get_blob_store()
+    if store is not None:
+        digest = hashlib.sha256(data).hexdigest()
+        store.put(digest, data)
+        mapping = {'blob': digest}
+    elif len(data) <= app.conf['gracedb_download_cache_max_size']:
+        mapping = {'data': data}
+    else:
+        mapping = {'size': len(data)}
+    with app.backend.client.pipeline() as pipe:
+        pipe.hset(key, mapping=mapping)
+        pipe.pexpire(key, int(ttl * 1000))
+        pipe.execute()
+
+
 @task(shared=False)
 @catch_retryable_http_errors
 def download(filename, graceid):
-    """Download a file from GraceDB."""
-    with client.events[graceid].files[filename].get() as f:
-        return f.read()
+    """Download a file from GraceDB.
+
+    Notes
+    -----
+    Concurrent downloads of the same file and version from the same event or
+    superevent are combined: one worker fetches the file while holding a lock
+    in Redis, and the others pick up its contents from the blob store (see
+    :mod:`gwcelery.blobs`), if one is configured, or else from Redis. Each
+    file is kept for :obj:`~gwcelery.conf.gracedb_download_cache_ttl` seconds,
+    or until the event or superevent is modified. Without a blob store, files
+    that are larger than :obj:`~gwcelery.conf.gracedb_download_cache_max_size`
+    are not shared; each worker downloads them separately.
+
+    """
+    ttl = app.conf['gracedb_download_cache_ttl']
+    if not ttl:
+        return _download(filename, graceid)
+    redis = app.backend.client
+    key = _cache_key('download:' + filename, graceid,
+                     _cache_generation(graceid))
+    data = _get_shared_download(key)
+    if data is None:
+        lock = redis.lock(key + '.lock', timeout=_DOWNLOAD_LOCK_TIMEOUT)
+        # If the lock is not released in time, then give up waiting and
+        # download the file without it.
+        locked = lock.acquire(blocking_timeout=_DOWNLOAD_LOCK_TIMEOUT)
+        try:
+            data = _get_shared_download(key)
+            if data is None:
+                redis.incr(_CACHE_PREFIX + 'download_misses')
+                data = _download(filename, graceid)
+                _share_download(key, data, ttl)
+                return data
+        finally:
+            if locked:
+                lock.release()
+    if data is _NOT_SHARED:
+        redis.incr(_CACHE_PREFIX + 'download_misses')
+        return _download(filename, graceid)
+    redis.incr(_CACHE_PREFIX + 'download_hits')
+    return data
 
 
 @task(ignore_result=True, shared=False)
 @catch_retryable_http_errors
+@invalidates_cache
 def expose(graceid):
     """Expose an event to the public.
 
@@ -189,6 +635,7 @@ def get_events(query, **kwargs):
 
 @task(shared=False)
 @catch_retryable_http_errors
+@cached_read
 def get_event(graceid):
     """Retrieve an event from GraceDB."""
     return client.events[graceid].get()
@@ -210,6 +657,7 @@ def get_search(graceid):
 
 @task(shared=False)
 @catch_retryable_http_errors
+@cached_read
 def get_labels(graceid):
     """Get all labels for an event in GraceDB."""
     return {row['name'] for row in client.events[graceid].labels.get()}
@@ -217,6 +665,7 @@ def get_labels(graceid):
 
 @task(shared=False)
 @catch_retryable_http_errors
+@cached_read
 def get_log(graceid):
     """Get all log messages for an event in GraceDB."""
     return client.events[graceid].logs.get()
@@ -224,6 +673,7 @@ def get_log(graceid):
 
 @task(shared=False)
 @catch_retryable_http_errors
+@cached_read
 def get_superevent(graceid):
     """Retrieve a superevent from GraceDB."""
     return client.superevents[graceid].get()
@@ -231,6 +681,7 @@ def get_superevent(graceid):
 
 @task(shared=False)
 @catch_retryable_http_errors
+@invalidates_cache
 def replace_event(graceid, payload):
     """Get an event from GraceDB."""
     client.events.update(graceid, filecontents=payload)
@@ -238,11 +689,13 @@ def replace_event(graceid, payload):
 
 @task(shared=False)
 @catch_retryable_http_errors
+@invalidates_cache
 def upload(filecontents, filename, graceid, message, tags=()):
     """Upload a file to GraceDB."""
     result = client.events[graceid].logs.create(
         comment=message, filename=filename,
         filecontents=filecontents, tags=tags)
+    index_log_entries(graceid, result)
     return '{},{}'.format(result['filename'], result['file_version'])
 
 
@@ -269,6 +722,7 @@ def get_superevents(query, **kwargs):
 
 @task(ignore_result=True, shared=False)
 @catch_retryable_http_errors
+@invalidates_cache
 def update_superevent(superevent_id, t_start=None,
                       t_end=None, t_0=None, preferred_event=None,
                       em_type=None, time_coinc_far=None,
@@ -307,6 +761,7 @@ def update_superevent(superevent_id, t_start=None,
 
 @task(shared=False)
 @catch_retryable_http_errors
+@invalidates_cache
 def create_superevent(graceid, t0, t_start, t_end):
     """Create new superevent in GraceDB with `graceid`
 
@@ -335,6 +790,7 @@ def create_superevent(graceid, t0, t_start, t_end):
 
 @task(ignore_result=True, shared=False)
 @catch_retryable_http_errors
+@invalidates_cache
 def add_event_to_superevent(superevent_id, graceid):
     """Add an event to a superevent in GraceDB."""
     try:
@@ -7,10 +7,17 @@ from ligo.gracedb import rest
 
 from ..import app
 from ..util import PromiseProxy
+from .gracedb import mount_transport
 
-client = PromiseProxy(rest.GraceDb,
-                      ('https://' + app.conf.gracedb_host + '/api/',),
-                      {'fail_if_noauth': True, 'reload_certificate': True})
+
+def _create_client(url):
+    client = rest.GraceDb(url, fail_if_noauth=True, reload_certificate=True)
+    mount_transport(client)
+    return client
+
+
+client = PromiseProxy(_create_client,
+                      ('https://' + app.conf.gracedb_host + '/api/',))
 
 
 class RetryableHTTPError(rest.HTTPError):
@@ -42,6 +42,14 @@ class _LVAlertDispatchHandler(DispatchHandler):
                         service, gracedb.client.url)
             return None, None, None
 
+        # The event or superevent has changed, so discard any cached copies.
+        if 'uid' in alert:
+            gracedb.invalidate_cache(alert['uid'])
+            if alert.get('alert_type') == 'log':
+                gracedb.index_log_entries(alert['uid'], alert['data'])
+            elif alert.get('alert_type') in {'new', 'update'}:
+                gracedb.index_trigger(alert['object'])
+
         return super().process_args(node, alert)
 
 
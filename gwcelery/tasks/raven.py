@@ -1,22 +1,194 @@
 """Search for GRB-GW coincidences with ligo-raven."""
+import json
+import re
+
+import healpy as hp
 import ligo.raven.search
 from celery import group
 from celery.utils.log import get_task_logger
 from ligo.raven import gracedb_events
+from ligo.skymap.io import read_sky_map
 
 from ..import app
 from . import external_skymaps
 from . import gracedb
 from . import legacy_gracedb
+from . import skymaps
 
 log = get_task_logger(__name__)
 
 
+_skymaps = {}
+"""Sky maps that have been downloaded and decoded by :meth:`skymap_overlap`,
+keyed by GraceDB ID and versioned file name. Each value is a tuple of the
+HEALPix resolution of the original sky map, and a dictionary that maps each
+resolution at which an overlap integral was computed to the sky map degraded
+to that resolution (probabilities per pixel in nested ordering). The sky maps
+at their original resolutions are not kept."""
+
+_SKYMAPS_MAXBYTES = 64 * 1024**2
+"""Maximum total size in bytes of the sky maps in :obj:`_skymaps`."""
+
+
+def _read_skymap(graceid, filename):
+    filecontents = gracedb.download(filename, graceid)
+    with skymaps.open_fits(filecontents) as hdus:
+        skymap, _ = read_sky_map(hdus, nest=True, moc=False)
+    return skymap
+
+
+def _degrade(skymap, nside):
+    """Degrade a sky map by summing the probabilities of the pixels within
+    each pixel at the lower resolution.
+    """
+    npix = hp.nside2npix(nside)
+    if len(skymap) != npix:
+        skymap = skymap.reshape(npix, -1).sum(axis=1)
+    return skymap
+
+
+def _put_skymaps(key, nside, degraded):
+    size = sum(skymap.nbytes for skymap in degraded.values())
+    total = sum(skymap.nbytes for _, cached in _skymaps.values()
+                for skymap in cached.values())
+    # Evict the least recently used entries first.
+    while _skymaps and total + size > _SKYMAPS_MAXBYTES:
+        _, evicted = _skymaps.pop(next(iter(_skymaps)))
+        total -= sum(skymap.nbytes for skymap in evicted.values())
+    if size <= _SKYMAPS_MAXBYTES:
+        _skymaps[key] = nside, degraded
+
+
+def _get_skymaps(*keys):
+    """Get several sky maps, degraded to the lowest of their resolutions,
+    from :obj:`_skymaps` or by downloading and decoding them.
+
+    Parameters
+    ----------
+    keys : tuple
+        Tuples of the GraceDB ID and the versioned file name of each sky map.
+
+    Returns
+    -------
+    list
+        The sky maps.
+
+    """
+    entries = [_skymaps.pop(key, None) for key in keys]
+    originals = {key: _read_skymap(*key)
+                 for key, entry in zip(keys, entries) if entry is None}
+    nsides = [hp.npix2nside(len(originals[key])) if entry is None
+              else entry[0] for key, entry in zip(keys, entries)]
+    nside = min(nsides)
+
+    result = []
+    for key, original_nside, entry in zip(keys, nsides, entries):
+        degraded = {} if entry is None else entry[1]
+        skymap = degraded.get(nside)
+        if skymap is None:
+            original = originals.get(key)
+            if original is None:
+                original = _read_skymap(*key)
+            skymap = degraded[nside] = _degrade(original, nside)
+        _put_skymaps(key, original_nside, degraded)
+        result.append(skymap)
+    return result
+
+
+@app.task(shared=False)
+def skymap_overlap(se_id, se_filename, ext_id, ext_filename):
+    """Compute the overlap integral of a superevent sky map and an external
+    event sky map.
+
+    The overlap integral is computed by
+    :func:`ligo.raven.search.skymap_overlap_integral`. Rather than upsampling
+    the lower resolution sky map, the higher resolution sky map is first
+    degraded by summing the probabilities of its pixels, which gives the same
+    result. The degraded sky maps are kept in :obj:`_skymaps`, and the overlap
+    integrals are kept in Redis for
+    :obj:`~gwcelery.conf.raven_skymap_overlap_cache_ttl` seconds.
+
+    Parameters
+    ----------
+    se_id: str
+        superevent ID
+    se_filename: str
+        versioned file name of the superevent sky map
+    ext_id: str
+        external event ID
+    ext_filename: str
+        versioned file name of the external event sky map
+
+    Returns
+    -------
+    float or str
+        The overlap integral, or the message from ligo.raven that explains
+        why it could not be computed.
+
+    """
+    ttl = app.conf['raven_skymap_overlap_cache_ttl']
+    key = '{}.overlap:{}/{}:{}/{}'.format(
+        __name__, se_id, se_filename, ext_id, ext_filename)
+    if ttl:
+        result = app.backend.client.get(key)
+        if result is not None:
+            return json.loads(result)
+
+    se_skymap, ext_skymap = _get_skymaps(
+        (se_id, se_filename), (ext_id, ext_filename))
+    result = ligo.raven.search.skymap_overlap_integral(se_skymap, ext_skymap)
+    if not isinstance(result, str):
+        result = float(result)
+
+    if ttl:
+        app.backend.client.set(key, json.dumps(result), px=int(ttl * 1000))
+    return result
+
+
+def _submit_coincidence_far(coinc_far, superevent_id, exttrig_id):
+    """Report the result of :func:`ligo.raven.search.coinc_far` to GraceDB,
+    like :func:`ligo.raven.search.calc_signif_gracedb`.
+
+    If the coincidence FARs were computed, then they are uploaded to both
+    events. Otherwise, the message from ligo.raven that explains why is
+    written to the log of the superevent.
+
+    Returns
+    -------
+    dict or str
+        The coincidence FARs, or the message from ligo.raven.
+
+    """
+    if isinstance(coinc_far, str):
+        gracedb.upload.delay(None, None, superevent_id, coinc_far,
+                             tags=['ext_coinc'])
+        return coinc_far
+    url = 'https://{}/'.format(app.conf['gracedb_host'])
+    filecontents = json.dumps(coinc_far)
+    message = ("RAVEN: Computed coincident FAR(s) in Hz with external "
+               "trigger <a href='{0}events/{1}'>{1}</a>").format(
+                   url, exttrig_id)
+    gracedb.upload.delay(filecontents, 'coincidence_far.json', superevent_id,
+                         message, tags=['ext_coinc'])
+    message = ("RAVEN: Computed coincident FAR(s) in Hz with superevent "
+               "<a href='{0}superevents/{1}'>{1}</a>").format(
+                   url, superevent_id)
+    gracedb.upload.delay(filecontents, 'coincidence_far.json', exttrig_id,
+                         message, tags=['ext_coinc'])
+    return coinc_far
+
+
 @app.task(shared=False)
 def calculate_coincidence_far(superevent, exttrig, tl, th):
     """Compute coincidence FAR for external trigger and superevent
-    coincidence by calling ligo.raven.search.calc_signif_gracedb,
-    using sky map info if available.
+    coincidence with ligo.raven, using sky map info if available.
+
+    The temporal coincidence FAR is computed by
+    :func:`ligo.raven.search.coinc_far`. If both sky maps are available, then
+    the spatiotemporal coincidence FAR is computed from it with the sky map
+    overlap integral from :meth:`skymap_overlap`. The results are uploaded
+    to GraceDB in the same way as by
+    :func:`ligo.raven.search.calc_signif_gracedb`.
 
     Parameters
     ----------
@@ -29,6 +201,12 @@ def calculate_coincidence_far(superevent, exttrig, tl, th):
     th: float
         end of coincident time window
 
+    Returns
+    -------
+    dict or str
+        The coincidence FARs, or the message from ligo.raven that explains
+        why they could not be computed.
+
     """
     superevent_id = superevent['superevent_id']
     exttrig_id = exttrig['graceid']
@@ -37,25 +215,30 @@ def calculate_coincidence_far(superevent, exttrig, tl, th):
     if exttrig['pipeline'] == 'SNEWS':
         return
 
-    if {'EXT_SKYMAP_READY', 'SKYMAP_READY'}.issubset(exttrig['labels']):
+    coinc_far = ligo.raven.search.coinc_far(
+        superevent_id, exttrig_id, tl, th,
+        grb_search=exttrig['search'], incl_sky=False,
+        gracedb=legacy_gracedb.client, far_grb=exttrig['far'])
+
+    if isinstance(coinc_far, dict) and \
+            {'EXT_SKYMAP_READY', 'SKYMAP_READY'}.issubset(exttrig['labels']):
         #  if both sky maps available, calculate spatial coinc far
         se_skymap = external_skymaps.get_skymap_filename(
-            superevent_id)
+            superevent_id, versioned=True)
         ext_skymap = external_skymaps.get_skymap_filename(
-            exttrig_id)
-
-        return ligo.raven.search.calc_signif_gracedb(
-                   superevent_id, exttrig_id, tl, th,
-                   grb_search=exttrig['search'],
-                   se_fitsfile=se_skymap, ext_fitsfile=ext_skymap,
-                   incl_sky=True, gracedb=legacy_gracedb.client,
-                   far_grb=exttrig['far'])
-    else:
-        return ligo.raven.search.calc_signif_gracedb(
-                   superevent_id, exttrig_id, tl, th,
-                   grb_search=exttrig['search'],
-                   incl_sky=False, gracedb=legacy_gracedb.client,
-                   far_grb=exttrig['far'])
+            exttrig_id, versioned=True)
+        overlap = skymap_overlap(superevent_id, se_skymap,
+                                 exttrig_id, ext_skymap)
+        if isinstance(overlap, str):
+            coinc_far = overlap
+        else:
+            coinc_far = dict(
+                coinc_far, skymap_overlap=overlap,
+                spatiotemporal_coinc_far=(
+                    coinc_far['temporal_coinc_far'] / overlap
+                    if overlap > 0 else float('inf')))
+
+    return _submit_coincidence_far(coinc_far, superevent_id, exttrig_id)
 
 
 @app.task(shared=False)
@@ -156,18 +339,197 @@ def search(gracedb_id, alert_object, tl=-5, th=5, group=None,
     -------
         list with the dictionaries of related gracedb events
 
+    Notes
+    -----
+    If the time-sorted trigger index (see
+    :meth:`gwcelery.tasks.gracedb.lookup_triggers`) covers the search window
+    and has no candidates in it, then GraceDB is not queried for candidates
+    (see :class:`_UnionWindowClient`).
+
+    """
+    client = _UnionWindowClient(legacy_gracedb.client)
+    event, group, pipelines = _get_event(
+        gracedb_id, alert_object, group, pipelines, client)
+    return ligo.raven.search.search(event, tl, th, gracedb=client,
+                                    group=group, pipelines=pipelines,
+                                    searches=searches)
+
+
+def _get_event(gracedb_id, alert_object, group, pipelines, client):
+    """Get the ligo-raven event object for the trigger, and the group and
+    pipelines arguments that apply to searches around it.
     """
     if alert_object.get('superevent_id'):
-        event = gracedb_events.SE(gracedb_id, gracedb=legacy_gracedb.client)
+        event = gracedb_events.SE(gracedb_id, gracedb=client)
         group = None
     else:
-        event = gracedb_events.ExtTrig(gracedb_id,
-                                       gracedb=legacy_gracedb.client)
+        event = gracedb_events.ExtTrig(gracedb_id, gracedb=client)
         pipelines = []
-    return ligo.raven.search.search(event, tl, th,
-                                    gracedb=legacy_gracedb.client,
-                                    group=group, pipelines=pipelines,
-                                    searches=searches)
+    return event, group, pipelines
+
+
+class _UnionWindowClient:
+    """Wrapper for a GraceDB client that answers time range queries for
+    events and superevents from a single query over a wider time window.
+
+    If the time-sorted trigger index (see
+    :meth:`gwcelery.tasks.gracedb.lookup_triggers`) covers the range of a
+    query for external events or superevents and has no candidates in it,
+    then the query returns no candidates without querying GraceDB. Otherwise,
+    the first time range query of each kind fetches all of the candidates in
+    :attr:`window`, if it is set. Later queries for sub-windows of it are
+    filtered in memory. Queries that fall outside of the window, and all other
+    methods, are passed through to the wrapped client, except that individual
+    events and superevents are fetched only once.
+    """
+
+    _range = re.compile(r'(?P<prefix>.*?)\s*(?P<start>\S+) \.\. (?P<end>\S+)')
+
+    _indexed = {('events', 'External'): 'External',
+                ('superevents', ''): 'Superevent'}
+    """Kinds of objects in the trigger index, keyed by query method and query
+    prefix."""
+
+    def __init__(self, client):
+        self._client = client
+        self._candidates = {}
+        self._responses = {}
+        self.window = None
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _query(self, method, time_key, query, *args, **kwargs):
+        match = self._range.fullmatch(query)
+        if match is None or args or kwargs:
+            return getattr(self._client, method)(query, *args, **kwargs)
+        start, end = float(match['start']), float(match['end'])
+        kind = self._indexed.get((method, match['prefix']))
+        if kind is not None and gracedb.lookup_triggers(
+                kind, start, end) == []:
+            return []
+        if self.window is None:
+            return getattr(self._client, method)(query)
+        window_start, window_end = self.window
+        if start < window_start or end > window_end:
+            return getattr(self._client, method)(query)
+        key = (method, match['prefix'])
+        try:
+            candidates = self._candidates[key]
+        except KeyError:
+            prefix = match['prefix'] + ' ' if match['prefix'] else ''
+            candidates = self._candidates[key] = list(
+                getattr(self._client, method)('{}{} .. {}'.format(
+                    prefix, window_start, window_end)))
+        return [candidate for candidate in candidates
+                if start <= float(candidate[time_key]) <= end]
+
+    def _get(self, method, graceid):
+        key = (method, graceid)
+        try:
+            return self._responses[key]
+        except KeyError:
+            response = self._responses[key] = getattr(
+                self._client, method)(graceid)
+            return response
+
+    def events(self, query, *args, **kwargs):
+        return self._query('events', 'gpstime', query, *args, **kwargs)
+
+    def superevents(self, query, *args, **kwargs):
+        return self._query('superevents', 't_0', query, *args, **kwargs)
+
+    def event(self, graceid):
+        return self._get('event', graceid)
+
+    def superevent(self, superevent_id):
+        return self._get('superevent', superevent_id)
+
+
+@app.task(shared=False)
+def coincidence_searches(gracedb_id, alert_object, specs):
+    """Perform several ligo-raven searches for coincidences around the same
+    trigger, and launch the raven pipeline for each of them.
+
+    This is equivalent to calling :meth:`coincidence_search` once for each
+    search specification, but GraceDB is queried only once for the union of
+    the time windows, in a single task.
+
+    Parameters
+    ----------
+    gracedb_id: str
+        ID of the trigger used by GraceDB
+    alert_object: dict
+        lvalert['object']
+    specs: list
+        list of ``(group, pipelines, searches)`` tuples, with the same
+        meanings as the arguments of :meth:`coincidence_search`
+
+    """
+    (
+        search_many.si(gracedb_id, alert_object, specs)
+        |
+        raven_pipelines.s(gracedb_id, alert_object, specs)
+    ).delay()
+
+
+@app.task(shared=False)
+def search_many(gracedb_id, alert_object, specs):
+    """Perform several ligo-raven searches for coincidences around the same
+    trigger with a single GraceDB query.
+
+    Parameters
+    ----------
+    gracedb_id: str
+        ID of the trigger used by GraceDB
+    alert_object: dict
+        lvalert['object']
+    specs: list
+        list of ``(group, pipelines, searches)`` tuples
+
+    Returns
+    -------
+        list with the results of :meth:`search` for each specification
+
+    """
+    windows = [_time_window(gracedb_id, *spec) for spec in specs]
+    client = _UnionWindowClient(legacy_gracedb.client)
+    results = []
+    for (gw_group, pipelines, searches), (tl, th) in zip(specs, windows):
+        event, gw_group, pipelines = _get_event(
+            gracedb_id, alert_object, gw_group, pipelines, client)
+        if client.window is None:
+            client.window = (event.gpstime + min(tl for tl, _ in windows),
+                             event.gpstime + max(th for _, th in windows))
+        results.append(ligo.raven.search.search(
+            event, tl, th, gracedb=client, group=gw_group,
+            pipelines=pipelines, searches=searches))
+    return results
+
+
+@app.task(ignore_result=True, shared=False)
+def raven_pipelines(raven_search_results, gracedb_id, alert_object, specs):
+    """Launch a separate :meth:`raven_pipeline` task for the results of each
+    search of :meth:`search_many`, so that the pipelines run in parallel and
+    a failure in one of them does not affect the others.
+
+    Parameters
+    ----------
+    raven_search_results: list
+        list with the results of :meth:`search` for each specification
+    gracedb_id: str
+        ID of either a superevent or external trigger
+    alert_object: dict
+        lvalert['object'], either a superevent or an external event
+    specs: list
+        list of ``(group, pipelines, searches)`` tuples
+
+    """
+    group(
+        raven_pipeline.si(results, gracedb_id, alert_object,
+                          *_time_window(gracedb_id, *spec), spec[0])
+        for results, spec in zip(raven_search_results, specs)
+    ).delay()
 
 
 @app.task(shared=False)
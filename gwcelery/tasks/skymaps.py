@@ -1,13 +1,20 @@
 """Annotations for sky maps."""
+import gzip
 import io
 import os
 import tempfile
 
+from astropy.coordinates import SkyCoord
 from astropy.io import fits
-from astropy import table
+from astropy.table import Table
+from astropy import units as u
+import astropy_healpix as ah
 from celery import group
 from celery.exceptions import Ignore
-from ligo.skymap.tool import ligo_skymap_flatten
+from ligo.skymap import moc
+from ligo.skymap import plot as _plot
+from ligo.skymap.io import read_sky_map, write_sky_map
+from ligo.skymap.postprocess import find_greedy_credible_levels
 from ligo.skymap.tool import ligo_skymap_from_samples
 from ligo.skymap.tool import ligo_skymap_plot
 from ligo.skymap.tool import ligo_skymap_plot_volume
@@ -19,16 +26,70 @@ from . import lvalert
 from ..import app
 from ..jinja import env
 from ..util.cmdline import handling_system_exit
-from ..util.matplotlib import closing_figures
+from ..util.matplotlib import cached_plot, closing_figures, FigurePool
 from ..util.tempfile import NamedTemporaryFile
 
 
+def _get_plot_rc_params():
+    parser = ligo_skymap_plot.parser()
+    dpi = float(parser.get_default('dpi'))
+    return {
+        'figure.figsize': (float(parser.get_default('figure_width')),
+                           float(parser.get_default('figure_height'))),
+        'figure.dpi': dpi,
+        'image.cmap': parser.get_default('colormap'),
+        'savefig.dpi': dpi,
+        'savefig.transparent': bool(int(parser.get_default('transparent')))}
+
+
+_PLOT_RC_PARAMS = _get_plot_rc_params()
+"""Matplotlib settings from the default options of the ``ligo-skymap-plot``
+command-line tool."""
+
+
+def _setup_allsky_figure(fig):
+    ax = fig.add_subplot(projection='astro mollweide')
+    ax.grid()
+
+
+_allsky_figures = FigurePool(
+    _setup_allsky_figure, figsize=_PLOT_RC_PARAMS['figure.figsize'],
+    dpi=_PLOT_RC_PARAMS['figure.dpi'])
+"""Pre-built figures with Mollweide axes for :meth:`plot_allsky`."""
+
+
+def open_fits(filecontents):
+    """Open the contents of an (optionally gzip-compressed) FITS file in
+    memory, without writing them to a temporary file.
+
+    Parameters
+    ----------
+    filecontents : bytes
+        The byte contents of the FITS file.
+
+    Returns
+    -------
+    hdus : :class:`astropy.io.fits.HDUList`
+        The list of HDUs.
+
+    """
+    return fits.open(io.BytesIO(filecontents))
+
+
 @app.task(ignore_result=True, shared=False)
 def annotate_fits(filecontents, versioned_filename, graceid, tags):
     """Perform annotations on a sky map.
 
-    This function downloads a FITS file and then generates and uploads all
-    derived images as well as an HTML dump of the FITS header.
+    This function generates and uploads all derived images as well as an HTML
+    dump of the FITS header.
+
+    Notes
+    -----
+    Only the headers of the FITS file are decoded here. They are rendered to
+    HTML right away, and they determine whether the sky map has distance
+    information, so the volume rendering is only launched for 3D sky maps.
+    The pixel data is decoded once in each of the plotting tasks.
+
     """
     filebase = versioned_filename.partition('.fits')[0]
     header_msg = (
@@ -44,65 +105,121 @@ def annotate_fits(filecontents, versioned_filename, graceid, tags):
         '{versioned_filename}">{versioned_filename}</a>').format(
             graceid=graceid, versioned_filename=versioned_filename)
 
-    group(
-        fits_header.s(versioned_filename) |
-        gracedb.upload.s(
-            filebase + '.html', graceid, header_msg, tags),
+    with open_fits(filecontents) as hdus:
+        header_html = _render_fits_header(hdus, versioned_filename)
+        is_3d = _has_distance(hdus)
+
+    tasks = [
+        gracedb.upload.si(
+            header_html, filebase + '.html', graceid, header_msg, tags),
 
         plot_allsky.s() |
         gracedb.upload.s(
-            filebase + '.png', graceid, allsky_msg, tags),
+            filebase + '.png', graceid, allsky_msg, tags)
+    ]
+    if is_3d:
+        tasks.append(
+            plot_volume.s() |
+            gracedb.upload.s(
+                filebase + '.volume.png', graceid, volume_msg, tags))
+
+    group(tasks).delay(filecontents)
 
-        annotate_fits_volume.s(
-            filebase + '.volume.png', graceid, volume_msg, tags)
-    ).delay(filecontents)
+
+def _has_distance(hdus):
+    # Only the header is needed to look up the column names.
+    return 'DISTNORM' in hdus[1].columns.names
 
 
 def is_3d_fits_file(filecontents):
     """Determine if a FITS file has distance information."""
-    with NamedTemporaryFile(content=filecontents) as fitsfile:
-        return 'DISTNORM' in table.Table.read(fitsfile.name).colnames
+    with open_fits(filecontents) as hdus:
+        return _has_distance(hdus)
 
 
-@app.task(ignore_result=True, shared=False)
-def annotate_fits_volume(filecontents, *args):
-    """Perform annotations that are specific to 3D sky maps."""
-    if is_3d_fits_file(filecontents):
-        (
-            plot_volume.s(filecontents)
-            |
-            gracedb.upload.s(*args)
-        ).apply_async()
+def _render_fits_header(hdus, filename):
+    template = env.get_template('fits_header.jinja2')
+    return template.render(filename=filename, hdus=hdus)
 
 
 @app.task(shared=False)
 def fits_header(filecontents, filename):
     """Dump FITS header to HTML."""
-    template = env.get_template('fits_header.jinja2')
-    with NamedTemporaryFile(content=filecontents) as fitsfile, \
-            fits.open(fitsfile.name) as hdus:
-        return template.render(filename=filename, hdus=hdus)
+    with open_fits(filecontents) as hdus:
+        return _render_fits_header(hdus, filename)
 
 
 @app.task(shared=False)
-@closing_figures()
+@cached_plot
 def plot_allsky(filecontents, ra=None, dec=None):
-    """Plot a Mollweide projection of a sky map using the command-line tool
-    :doc:`ligo-skymap-plot <ligo.skymap:tool/ligo_skymap_plot>`.
+    """Plot a Mollweide projection of a sky map.
+
+    This makes the same plot as the command-line tool
+    :doc:`ligo-skymap-plot <ligo.skymap:tool/ligo_skymap_plot>` with the
+    ``--annotate`` option and its default figure options, but without
+    writing any temporary files. The axes are borrowed from a pool of
+    pre-built figures, and the output is cached (see
+    :func:`~gwcelery.util.matplotlib.cached_plot`).
+
+    Parameters
+    ----------
+    filecontents : bytes
+        The contents of the FITS file.
+    ra, dec : float, optional
+        The right ascension and declination in degrees of a position to mark
+        on the plot, such as an external trigger. If not provided, then plot
+        the 50% and 90% credible contours instead.
+
+    Returns
+    -------
+    png : bytes
+        The contents of a PNG file.
+
     """
-    # Explicitly use a non-interactive Matplotlib backend.
-    plt.switch_backend('agg')
+    with open_fits(filecontents) as hdus:
+        skymap, metadata = read_sky_map(hdus, nest=None)
+    nside = ah.npix_to_nside(len(skymap))
+
+    # Convert sky map from probability to probability per square degree.
+    deg2perpix = ah.nside_to_pixel_area(nside).to_value(u.deg**2)
+    probperdeg2 = skymap / deg2perpix
+
+    with plt.rc_context(_PLOT_RC_PARAMS), _allsky_figures.figure() as fig:
+        ax, = fig.axes
+        ax.imshow_hpx((probperdeg2, 'ICRS'), nested=metadata['nest'],
+                      vmin=0., vmax=probperdeg2.max())
+
+        text = []
+        if 'objid' in metadata:
+            text.append('event ID: {}'.format(metadata['objid']))
 
-    with NamedTemporaryFile(mode='rb', suffix='.png') as pngfile, \
-            NamedTemporaryFile(content=filecontents) as fitsfile, \
-            handling_system_exit():
         if ra is not None and dec is not None:
-            ligo_skymap_plot.main([fitsfile.name, '-o', pngfile.name,
-                                   '--annotate', '--radec', str(ra), str(dec)])
+            ax.plot_coord(
+                SkyCoord(ra, dec, unit='deg'), '*',
+                markerfacecolor='white', markeredgecolor='black',
+                markersize=10)
         else:
-            ligo_skymap_plot.main([fitsfile.name, '-o', pngfile.name,
-                                   '--annotate', '--contour', '50', '90'])
-        return pngfile.read()
+            contours = [50, 90]
+            cls = 100 * find_greedy_credible_levels(skymap)
+            cs = ax.contour_hpx(
+                (cls, 'ICRS'), nested=metadata['nest'],
+                colors='k', linewidths=0.5, levels=contours)
+            fmt = r'%g\%%' if plt.rcParams['text.usetex'] else '%g%%'
+            ax.clabel(cs, fmt=fmt, fontsize=6, inline=True)
+            areas = np.round(np.searchsorted(np.sort(cls), contours) *
+                             deg2perpix).astype(int)
+            for contour, area in zip(contours, areas):
+                text.append('{:d}% area: {:,d} deg²'.format(contour, area))
+
+        # Add a white outline to all text to make it stand out from the
+        # background.
+        _plot.outline_text(ax)
+
+        ax.text(1, 1, '\n'.join(text), transform=ax.transAxes, ha='right')
+
+        with io.BytesIO() as f:
+            fig.savefig(f, format='png')
+            return f.getvalue()
 
 
 @app.task(priority=1, queue='openmp', shared=False)
@@ -122,18 +239,83 @@ def plot_volume(filecontents):
         return pngfile.read()
 
 
+def _flatten_index(uniq):
+    """Get the permutation that sorts the pixels of a multi-order sky map in
+    NESTED order, and the number of pixels at the highest order that each
+    of them covers.
+    """
+    order, ipix = moc.uniq2nest(uniq)
+    max_order = order.max()
+    shift = 2 * (max_order - order).astype(np.int64)
+    permutation = np.argsort(ipix << shift, kind='stable')
+    repeats = (np.int64(1) << shift)[permutation]
+    npix = ah.nside_to_npix(ah.level_to_nside(max_order))
+    if repeats.sum() != npix:
+        raise ValueError('sky map pixels do not cover the sphere exactly once')
+    return permutation, repeats
+
+
+def rasterize_moc(table):
+    """Convert a multi-order sky map to a NESTED sky map at its highest
+    resolution.
+
+    This gives the same result as :func:`ligo.skymap.bayestar.rasterize`
+    with no `order` argument. The multi-order pixels are sorted into NESTED
+    order once, and then each column is expanded with a single
+    :func:`numpy.repeat`.
+
+    Parameters
+    ----------
+    table : :class:`astropy.table.Table`
+        The multi-order sky map, with a ``UNIQ`` column and a
+        ``PROBDENSITY`` column.
+
+    Returns
+    -------
+    table : :class:`astropy.table.Table`
+        The flat sky map, with a ``PROB`` column instead of the
+        ``PROBDENSITY`` column.
+
+    """
+    permutation, repeats = _flatten_index(table['UNIQ'])
+    npix = repeats.sum()
+    result = Table(meta=table.meta)
+    for name in table.colnames:
+        if name == 'UNIQ':
+            continue
+        if name == 'PROBDENSITY':
+            column = np.repeat(
+                np.asarray(table[name])[permutation] * (4 * np.pi / npix),
+                repeats)
+            result['PROB'] = column
+            result['PROB'].unit = u.pixel ** -1
+        else:
+            result[name] = np.repeat(
+                np.asarray(table[name])[permutation], repeats)
+            result[name].unit = table[name].unit
+    return result
+
+
 @app.task(shared=False)
 def flatten(filecontents, filename):
     """Convert a HEALPix FITS file from multi-resolution UNIQ indexing to the
-    more common IMPLICIT indexing using the command-line tool
-    :doc:`ligo-skymap-flatten <ligo.skymap:tool/ligo_skymap_flatten>`.
+    more common IMPLICIT indexing.
+
+    This does the same thing as the command-line tool
+    :doc:`ligo-skymap-flatten <ligo.skymap:tool/ligo_skymap_flatten>`, but
+    without writing any temporary files (see :func:`rasterize_moc`). If
+    `filename` ends in ``.gz``, then the output is gzip-compressed as it is
+    written.
     """
-    with NamedTemporaryFile(content=filecontents) as infile, \
-            tempfile.TemporaryDirectory() as tmpdir, \
-            handling_system_exit():
-        outfilename = os.path.join(tmpdir, filename)
-        ligo_skymap_flatten.main([infile.name, outfilename])
-        return open(outfilename, 'rb').read()
+    with open_fits(filecontents) as hdus:
+        table = rasterize_moc(read_sky_map(hdus, moc=True))
+    with io.BytesIO() as f:
+        if filename.endswith('.gz'):
+            with gzip.GzipFile(fileobj=f, mode='wb') as gzfile:
+                write_sky_map(gzfile, table, nest=True)
+        else:
+            write_sky_map(f, table, nest=True)
+        return f.getvalue()
 
 
 @app.task(shared=False, queue='openmp')
@@ -258,8 +440,8 @@ def plot_coherence(filecontents):
     # Explicitly use a non-interactive Matplotlib backend.
     plt.switch_backend('agg')
 
-    with NamedTemporaryFile(content=filecontents) as fitsfile:
-        header = fits.getheader(fitsfile, 1)
+    with open_fits(filecontents) as hdus:
+        header = hdus[1].header
     try:
         logb = header['LOGBCI']
     except KeyError:
@@ -6,8 +6,12 @@ superevents.
 *   Primary logic to respond to low latency triggers contained in
     :meth:`process` function.
 """
+from bisect import bisect_left, bisect_right
 from itertools import filterfalse
+import json
+import time
 
+from celery.signals import task_postrun
 from celery.utils.log import get_task_logger
 from ligo.segments import segment, segmentlist
 
@@ -57,6 +61,10 @@ def handle(payload):
         log.info("Skipping processing of %s because of high FAR", gid)
         return
 
+    if alert_type in {'label_added', 'label_removed', 'update'}:
+        _update_preferred_event_key.si(payload['object']).apply_async(
+            priority=0)
+
     priority = 1
     if alert_type == 'label_added':
         priority = 0
@@ -73,7 +81,132 @@ def handle(payload):
     elif alert_type != 'new':
         return
 
-    process.si(payload).apply_async(priority=priority)
+    if alert_type == 'new' and app.conf['superevent_batch_window'] \
+            and not payload['object'].get('superevent'):
+        _add_to_batch(payload)
+    else:
+        process.si(payload).apply_async(priority=priority)
+
+
+_BATCH_KEY = __name__ + '.batch'
+"""Redis key of the list of LVAlert messages waiting to be processed by
+:meth:`process_cluster`."""
+
+
+def _add_to_batch(payload):
+    """Append an LVAlert message for a new event to the batch, and schedule
+    the batch to be flushed after :obj:`~gwcelery.conf.superevent_batch_window`
+    seconds, or immediately if it has reached
+    :obj:`~gwcelery.conf.superevent_batch_size` messages.
+    """
+    n = app.backend.client.rpush(_BATCH_KEY, json.dumps(payload))
+    if n >= app.conf['superevent_batch_size']:
+        flush_batch.delay()
+    elif n == 1:
+        flush_batch.apply_async(countdown=app.conf['superevent_batch_window'])
+
+
+@app.task(ignore_result=True, shared=False)
+def flush_batch():
+    """Take all LVAlert messages from the batch, group them into clusters of
+    overlapping events, and hand each cluster to :meth:`process_cluster`.
+    """
+    with app.backend.client.pipeline() as pipe:
+        pipe.lrange(_BATCH_KEY, 0, -1)
+        pipe.delete(_BATCH_KEY)
+        payloads, _ = pipe.execute()
+    for cluster in _cluster_payloads([json.loads(p) for p in payloads]):
+        process_cluster.si(cluster).apply_async(priority=1)
+
+
+def _cluster_payloads(payloads):
+    """Group LVAlert messages for new events into clusters of events of the
+    same category whose time segments (see :meth:`get_ts`) overlap.
+
+    Parameters
+    ----------
+    payloads : list
+        List of LVAlert payloads
+
+    Returns
+    -------
+    clusters : list
+        List of lists of LVAlert payloads
+
+    """
+    keyed = sorted(
+        ((get_category(payload['object']), *get_ts(payload['object'])[1:]),
+         i, payload) for i, payload in enumerate(payloads))
+    clusters = []
+    last_category = last_t_end = None
+    for (category, t_start, t_end), _, payload in keyed:
+        if category == last_category and t_start <= last_t_end:
+            clusters[-1].append(payload)
+            last_t_end = max(last_t_end, t_end)
+        else:
+            clusters.append([payload])
+            last_category = category
+            last_t_end = t_end
+    return clusters
+
+
+_ALERTS_KEY = __name__ + '.superevent_alerts'
+"""Redis key of the list of LVAlert messages for superevents waiting to be
+applied to the superevent index by :meth:`_apply_superevent_alerts`."""
+
+_INDEXED_ALERT_TYPES = {'new', 'update', 'event_added', 'event_removed',
+                        'label_added', 'label_removed'}
+"""Types of LVAlert messages for superevents that can change what the
+superevent index records about them."""
+
+
+@lvalert.handler('superevent',
+                 'mdc_superevent',
+                 shared=False)
+def handle_superevent(alert):
+    """Pass changes to superevents that are made outside of :meth:`process`
+    on to the superevent index of the superevent worker.
+
+    This handler runs on the default queue, so that the many messages from
+    the superevent nodes do not hold up :meth:`process` on the
+    **superevent** queue. It only stores the messages in Redis; the
+    superevent worker applies them the next time that it reads its index.
+    """
+    if alert['alert_type'] not in _INDEXED_ALERT_TYPES:
+        return
+    with app.backend.client.pipeline() as pipe:
+        pipe.rpush(_ALERTS_KEY, json.dumps(alert))
+        # Messages that are older than the index are of no use.
+        pipe.pexpire(_ALERTS_KEY,
+                     int(1000 * app.conf['superevent_index_max_age']))
+        pipe.execute()
+
+
+def _apply_superevent_alerts():
+    """Take all LVAlert messages that :meth:`handle_superevent` has stored,
+    and apply them to the superevent index.
+    """
+    if not _index:
+        return
+    with app.backend.client.pipeline() as pipe:
+        pipe.lrange(_ALERTS_KEY, 0, -1)
+        pipe.delete(_ALERTS_KEY)
+        alerts, _ = pipe.execute()
+    for alert in alerts:
+        _index.apply_alert(json.loads(alert))
+
+
+@task_postrun.connect
+def _on_task_postrun(task=None, args=(), state=None, **kwargs):
+    """Record labels that were applied to superevents by
+    :meth:`gwcelery.tasks.gracedb.create_label` tasks running on this worker
+    (in particular, the delayed application of :obj:`FROZEN_LABEL`) without
+    waiting for the corresponding LVAlert message to arrive.
+    """
+    if task.name == gracedb.create_label.name and state == 'SUCCESS' \
+            and len(args) == 2:
+        label, graceid = args
+        _index.add_label(graceid, label)
 
 
 @gracedb.task(queue='superevent', shared=False)
@@ -97,7 +230,8 @@ def process(payload):
     if event_info.get('superevent'):
         sid = event_info['superevent']
         log.info('Event %s already belongs to superevent %s', gid, sid)
-        s = gracedb.get_superevent(sid)
+        _apply_superevent_alerts()
+        s = _index.get(sid) or gracedb.get_superevent(sid)
         superevent = _SuperEvent(s['t_start'],
                                  s['t_end'],
                                  s['t_0'],
@@ -110,10 +244,10 @@ def process(payload):
                            t_end=None)
     else:  # not event_info.get('superevent')
         log.info('Event %s does not yet belong to a superevent', gid)
-        superevents = gracedb.get_superevents('category: {} {} .. {}'.format(
+        superevents = _get_superevents(
             category,
             event_info['gpstime'] - app.conf['superevent_query_d_t_start'],
-            event_info['gpstime'] + app.conf['superevent_query_d_t_end']))
+            event_info['gpstime'] + app.conf['superevent_query_d_t_end'])
 
         for s in superevents:
             if gid in s['gw_events']:
@@ -153,6 +287,7 @@ def process(payload):
                 log.info('Event %s in window of %s. '
                          'Adding event to superevent', gid, sid)
                 gracedb.add_event_to_superevent(sid, event_segment.gid)
+                _index.add_event(sid, event_segment.gid)
                 # extend the time window of the superevent
                 new_superevent = superevent | event_segment
                 if new_superevent != superevent:
@@ -175,18 +310,151 @@ def process(payload):
                          'creating new superevent', gid)
                 sid = gracedb.create_superevent(event_info['graceid'],
                                                 t_0, t_start, t_end)
+                if sid is None:
+                    # The event was already assigned to a superevent that we
+                    # did not know about, so the index is out of date.
+                    _index.invalidate(category)
+                else:
+                    _index.update(dict(superevent_id=sid,
+                                       category=category,
+                                       preferred_event=gid,
+                                       gw_events=[gid],
+                                       labels=[],
+                                       t_0=t_0,
+                                       t_start=t_start,
+                                       t_end=t_end))
+
+    _apply_publication_labels(sid, event_info)
 
-    if should_publish(event_info):
+
+@gracedb.task(queue='superevent', shared=False)
+@gracedb.catch_retryable_http_errors
+def process_cluster(payloads):
+    """Create or update a superevent for a cluster of new events at once.
+
+    This is the batched counterpart of :meth:`process` that is used if
+    :obj:`~gwcelery.conf.superevent_batch_window` is nonzero. The preferred
+    event and the time window are decided once for the whole cluster, so that
+    only one set of GraceDB updates is made for near-coincident events from
+    several pipelines.
+
+    Parameters
+    ----------
+    payloads : list
+        LVAlert payloads for new events that overlap in time, as grouped by
+        :meth:`flush_batch`
+
+    """
+    events = [payload['object'] for payload in payloads]
+    category = get_category(events[0])
+    superevents = _get_superevents(
+        category,
+        min(event['gpstime'] for event in events) -
+        app.conf['superevent_query_d_t_start'],
+        max(event['gpstime'] for event in events) +
+        app.conf['superevent_query_d_t_end'])
+
+    assigned = {gid for s in superevents for gid in s['gw_events']}
+    events = [event for event in events if event['graceid'] not in assigned]
+    if not events:
+        log.info('All events in cluster already belong to superevents. '
+                 'No action required')
+        return
+    gids = [event['graceid'] for event in events]
+
+    preferred_event = max(events, key=keyfunc)
+    t_0 = preferred_event['gpstime']
+    t_starts, t_ends = zip(*(get_ts(event)[1:] for event in events))
+    cluster_segment = _Event(t_0, min(t_starts), max(t_ends),
+                             preferred_event['graceid'],
+                             preferred_event['group'],
+                             preferred_event['pipeline'],
+                             preferred_event.get('search'),
+                             event_dict=preferred_event)
+
+    superevent = _partially_intersects(superevents, cluster_segment)
+
+    if superevent:
+        sid = superevent.superevent_id
+        log.info('Events %s in window of %s. '
+                 'Adding events to superevent', gids, sid)
+        for gid in gids:
+            gracedb.add_event_to_superevent(sid, gid)
+            _index.add_event(sid, gid)
+        new_superevent = superevent | cluster_segment
+        if new_superevent != superevent:
+            new_t_start, new_t_end = new_superevent
+        else:
+            new_t_start = new_t_end = None
+        _update_superevent(superevent,
+                           preferred_event,
+                           t_0=t_0,
+                           t_start=new_t_start,
+                           t_end=new_t_end)
+    else:
+        log.info('New events %s with no superevent in GraceDB, '
+                 'creating new superevent', gids)
+        t_start, t_end = cluster_segment
+        sid = gracedb.create_superevent(preferred_event['graceid'],
+                                        t_0, t_start, t_end)
+        if sid is None:
+            # Some of the events were already assigned to a superevent that
+            # we did not know about. Fall back to processing them one by one.
+            _index.invalidate(category)
+            for payload in payloads:
+                process(payload)
+            return
+        _index.update(dict(superevent_id=sid,
+                           category=category,
+                           preferred_event=preferred_event['graceid'],
+                           gw_events=[preferred_event['graceid']],
+                           labels=[],
+                           t_0=t_0,
+                           t_start=t_start,
+                           t_end=t_end))
+        _set_preferred_event_key(preferred_event['graceid'],
+                                 keyfunc(preferred_event))
+        for gid in gids:
+            if gid != preferred_event['graceid']:
+                gracedb.add_event_to_superevent(sid, gid)
+                _index.add_event(sid, gid)
+
+    _apply_publication_labels(sid, *events)
+
+
+def _get_superevents(category, start, end):
+    """Get all superevents of a given category with ``t_0`` between `start`
+    and `end`, from the worker-local index if possible or else from GraceDB.
+    """
+    _apply_superevent_alerts()
+    superevents = _index.lookup(category, start, end)
+    if superevents is None:
+        superevents = gracedb.get_superevents(
+            'category: {} {} .. {}'.format(category, start, end))
+        _index.replace(category, start, end, superevents)
+    return superevents
+
+
+def _apply_publication_labels(sid, *events):
+    """Request advocate signoff for a superevent if any of the given events
+    should be published, and freeze its preferred event if any of those
+    events is also complete.
+    """
+    publishable = [event for event in events if should_publish(event)]
+    if publishable:
         gracedb.create_label.delay('ADVREQ', sid)
-        if is_complete(event_info):
-            if app.conf['preliminary_alert_timeout'] \
-                    and 'EARLY_WARNING' not in event_info['labels']:
+        complete = [event for event in publishable if is_complete(event)]
+        if complete:
+            if app.conf['preliminary_alert_timeout'] and all(
+                    'EARLY_WARNING' not in event['labels']
+                    for event in complete):
                 gracedb.create_label.s(FROZEN_LABEL, sid).set(
                     queue='superevent',
                     countdown=app.conf['preliminary_alert_timeout']
                 ).delay()
             else:  # fast path if no countdown
                 gracedb.create_label(FROZEN_LABEL, sid)
+                _index.add_label(sid, FROZEN_LABEL)
 
 
 def get_category(event):
@@ -507,20 +775,68 @@ def _update_superevent(superevent, new_event_dict,
     if t_end is not None:
         kwargs['t_end'] = t_end
     if FROZEN_LABEL not in superevent.event_dict['labels']:
-        preferred_event_dict = gracedb.get_event(preferred_event)
-        if keyfunc(new_event_dict) > keyfunc(preferred_event_dict):
+        new_key = keyfunc(new_event_dict)
+        if new_event_dict['graceid'] == preferred_event:
+            _set_preferred_event_key(preferred_event, new_key)
+        elif new_key > _get_preferred_event_key(preferred_event):
             # update preferred event when EM_Selected is not applied
             kwargs['t_0'] = t_0
             kwargs['preferred_event'] = new_event_dict['graceid']
+            _set_preferred_event_key(new_event_dict['graceid'], new_key)
 
     if kwargs:
         gracedb.update_superevent(superevent_id, **kwargs)
+        _index.update_fields(superevent_id, **kwargs)
     # completeness takes first precedence in deciding preferred event
     # necessary and suffiecient condition to superevent as ready
     if is_complete(new_event_dict):
         gracedb.create_label.delay(READY_LABEL, superevent_id)
 
 
+_preferred_event_keys = {}
+"""Worker-local cache of the values of :meth:`keyfunc` for preferred events,
+keyed by graceid. Entries are refreshed by :meth:`_update_preferred_event_key`
+whenever the labels or contents of an event change."""
+
+_PREFERRED_EVENT_KEYS_MAXSIZE = 1000
+"""Maximum number of entries in :obj:`_preferred_event_keys`."""
+
+
+def _get_preferred_event_key(graceid):
+    """Get the value of :meth:`keyfunc` for a preferred event, fetching the
+    event from GraceDB only if it is not already cached.
+    """
+    try:
+        return _preferred_event_keys[graceid]
+    except KeyError:
+        key = keyfunc(gracedb.get_event(graceid))
+        _set_preferred_event_key(graceid, key)
+        return key
+
+
+def _set_preferred_event_key(graceid, key):
+    _preferred_event_keys.pop(graceid, None)
+    _preferred_event_keys[graceid] = key
+    if len(_preferred_event_keys) > _PREFERRED_EVENT_KEYS_MAXSIZE:
+        # Evict the least recently set entry.
+        del _preferred_event_keys[next(iter(_preferred_event_keys))]
+
+
+@app.task(queue='superevent', ignore_result=True, shared=False)
+def _update_preferred_event_key(event):
+    """Refresh the cached value of :meth:`keyfunc` for an event, if it is
+    cached, after its labels or contents have changed.
+
+    Parameters
+    ----------
+    event : dict
+        Event dictionary (e.g., the ``object`` of an LVAlert message).
+
+    """
+    if event['graceid'] in _preferred_event_keys:
+        _set_preferred_event_key(event['graceid'], keyfunc(event))
+
+
 def _superevent_segment_list(superevents):
     """Ingests a list of superevent dictionaries, and returns a segmentlist
     with start and end times as the duration of each segment.
@@ -603,3 +919,202 @@ class _SuperEvent(segment):
         self.superevent_id = sid
         self.preferred_event = preferred_event
         self.event_dict = event_dict
+
+
+class _SuperEventIndex:
+    """Worker-local index of recent superevents, sorted by ``t_0``.
+
+    The index is filled from the results of
+    :meth:`gwcelery.tasks.gracedb.get_superevents` queries, and kept up to date
+    by the changes that :meth:`process` itself makes in GraceDB and by the
+    LVAlert messages from :meth:`handle_superevent`. A query is answered from
+    the index only if its time window is contained in windows that were
+    fetched from GraceDB during the current generation of the index for that
+    category. Each generation lasts
+    for :obj:`~gwcelery.conf.superevent_index_max_age` seconds; after that,
+    everything that is known about the category is discarded.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Discard all superevents for all categories."""
+        self._superevents = {}
+        self._t_0s = {}
+        self._sids = {}
+        self._covered = {}
+        self._generation = {}
+
+    def invalidate(self, category):
+        """Discard all superevents for one category."""
+        self._superevents.pop(category, None)
+        self._t_0s.pop(category, None)
+        self._sids.pop(category, None)
+        self._covered.pop(category, None)
+        self._generation.pop(category, None)
+
+    def __bool__(self):
+        """Whether any category of the index is current."""
+        return any(self._is_current(category)
+                   for category in list(self._generation))
+
+    def _is_current(self, category):
+        try:
+            generation = self._generation[category]
+        except KeyError:
+            return False
+        if time.monotonic() - generation > app.conf[
+                'superevent_index_max_age']:
+            self.invalidate(category)
+            return False
+        return True
+
+    def _insert(self, category, superevent):
+        t_0s = self._t_0s[category]
+        i = bisect_right(t_0s, superevent['t_0'])
+        t_0s.insert(i, superevent['t_0'])
+        self._sids[category].insert(i, superevent['superevent_id'])
+        self._superevents[category][superevent['superevent_id']] = superevent
+
+    def _remove(self, category, sid):
+        superevent = self._superevents[category].pop(sid)
+        t_0s = self._t_0s[category]
+        sids = self._sids[category]
+        i = bisect_left(t_0s, superevent['t_0'])
+        i += sids[i:].index(sid)
+        del t_0s[i], sids[i]
+        return superevent
+
+    def _find(self, sid):
+        for category, superevents in self._superevents.items():
+            if sid in superevents and self._is_current(category):
+                return category, superevents[sid]
+        return None, None
+
+    def get(self, sid):
+        """Look up a superevent by its ID.
+
+        Returns
+        -------
+        superevent : dict, None
+            The superevent dictionary, or :obj:`None` if it is not in the
+            index.
+
+        """
+        _, superevent = self._find(sid)
+        return superevent
+
+    def lookup(self, category, start, end):
+        """Find all superevents of a given category with ``t_0`` in the
+        closed interval [`start`, `end`].
+
+        Returns
+        -------
+        superevents : list, None
+            List of superevent dictionaries, or :obj:`None` if the index
+            cannot answer the query and GraceDB must be consulted instead.
+
+        """
+        if not self._is_current(category) or \
+                segment(start, end) not in self._covered[category]:
+            return None
+        t_0s = self._t_0s[category]
+        superevents = self._superevents[category]
+        return [superevents[sid] for sid in self._sids[category][
+            bisect_left(t_0s, start):bisect_right(t_0s, end)]]
+
+    def replace(self, category, start, end, superevents):
+        """Replace the contents of a time window with the results of a
+        GraceDB query for all superevents in that window.
+        """
+        if not self._is_current(category):
+            self._superevents[category] = {}
+            self._t_0s[category] = []
+            self._sids[category] = []
+            self._covered[category] = segmentlist()
+            self._generation[category] = time.monotonic()
+        t_0s = self._t_0s[category]
+        for sid in self._sids[category][
+                bisect_left(t_0s, start):bisect_right(t_0s, end)]:
+            self._remove(category, sid)
+        for superevent in superevents:
+            self._remove_any(superevent['superevent_id'])
+            self._insert(category, superevent)
+        self._covered[category] |= segmentlist([segment(start, end)])
+        self._covered[category].coalesce()
+
+    def _remove_any(self, sid):
+        category, _ = self._find(sid)
+        if category is not None:
+            self._remove(category, sid)
+
+    def update(self, superevent):
+        """Insert a new superevent or replace an existing one."""
+        category = superevent.get('category', '').lower()
+        self._remove_any(superevent['superevent_id'])
+        if self._is_current(category):
+            self._insert(category, superevent)
+
+    def update_fields(self, sid, **kwargs):
+        """Apply changes from :meth:`gwcelery.tasks.gracedb.update_superevent`
+        to a superevent in the index.
+        """
+        category, superevent = self._find(sid)
+        if superevent is not None:
+            self._remove(category, sid)
+            self._insert(category, dict(superevent, **{
+                key: value for key, value in kwargs.items()
+                if value is not None}))
+
+    def apply_alert(self, alert):
+        """Apply an LVAlert message about a superevent.
+
+        Label changes are applied directly. Any other message is compared
+        with the superevent in the index, and ignored if they agree. If they
+        do not agree, then either the message is stale (it was sent before a
+        change that this worker has made since), or it reports a change that
+        was made elsewhere. GraceDB superevents carry no modification time
+        that would tell these apart, so the contents of the message are never
+        applied; instead, the whole category is discarded so that it is
+        fetched again from GraceDB.
+        """
+        category, superevent = self._find(alert['uid'])
+        alert_type = alert['alert_type']
+        if alert_type in {'label_added', 'label_removed'}:
+            if superevent is not None:
+                label = alert['data']['name']
+                labels = [
+                    item for item in superevent.get('labels', [])
+                    if item != label]
+                if alert_type == 'label_added':
+                    labels.append(label)
+                superevent['labels'] = labels
+            return
+        new = alert.get('object', {})
+        if superevent is not None and alert_type != 'event_removed' and all(
+                new.get(key) == superevent.get(key)
+                for key in ['t_0', 't_start', 't_end', 'preferred_event']
+        ) and set(new.get('gw_events', [])) <= set(
+                superevent.get('gw_events', [])):
+            return
+        self.invalidate(category or new.get('category', '').lower())
+
+    def add_event(self, sid, graceid):
+        """Record that an event was added to a superevent."""
+        _, superevent = self._find(sid)
+        if superevent is not None:
+            gw_events = superevent.get('gw_events', [])
+            if graceid not in gw_events:
+                superevent['gw_events'] = [*gw_events, graceid]
+
+    def add_label(self, sid, label):
+        """Record that a label was applied to a superevent."""
+        _, superevent = self._find(sid)
+        if superevent is not None:
+            labels = superevent.get('labels', [])
+            if label not in labels:
+                superevent['labels'] = [*labels, label]
+
+
+_index = _SuperEventIndex()
@@ -21,6 +21,14 @@ def celeryconf(tmp_path_factory):
         task_eager_propagates=True,
         lvalert_host='lvalert.invalid',
         gracedb_host='gracedb.invalid',
+        gracedb_cache_ttl=0,
+        gracedb_download_cache_ttl=0,
+        gracedb_log_index_ttl=0,
+        gracedb_trigger_index_ttl=0,
+        plot_cache_ttl=0,
+        raven_skymap_overlap_cache_ttl=0,
+        detchar_cache_ttl=0,
+        omegascan_threads=1,
         expose_to_public=True
     )
     tmp = {key: app.conf[key] for key in new_conf.keys()}
@@ -45,5 +53,129 @@ def fake_legacy_gracedb_client(monkeypatch):
     yield
 
 
+@pytest.fixture(autouse=True)
+def clear_worker_caches():
+    from ..tasks import superevents
+    superevents._index.clear()
+    superevents._preferred_event_keys.clear()
+    yield
+
+
+class FakeRedis(dict):
+
+    def get(self, key, default=None):
+        return super().get(key, default)
+
+    def set(self, key, value, px=None, nx=False):
+        if nx and key in self:
+            return False
+        self[key] = value if isinstance(value, bytes) else str(value).encode()
+        return True
+
+    def incr(self, key):
+        value = int(self.get(key, 0)) + 1
+        self[key] = str(value).encode()
+        return value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.pop(key, None)
+
+    def hset(self, key, mapping):
+        self.setdefault(key, {}).update(
+            {field: value if isinstance(value, bytes) else str(value).encode()
+             for field, value in mapping.items()})
+
+    def hget(self, key, field):
+        return self.get(key, {}).get(field)
+
+    def hdel(self, key, *fields):
+        hash = self.get(key, {})
+        return sum(hash.pop(field, None) is not None for field in fields)
+
+    def hgetall(self, key):
+        return {field.encode(): value
+                for field, value in self.get(key, {}).items()}
+
+    def hincrby(self, key, field, amount):
+        hash = self.setdefault(key, {})
+        hash[field] = str(int(hash.get(field, 0)) + amount).encode()
+
+    def rpush(self, key, *values):
+        items = self.setdefault(key, [])
+        items.extend(value if isinstance(value, bytes) else str(value).encode()
+                     for value in values)
+        return len(items)
+
+    def lrange(self, key, start, end):
+        items = self.get(key, [])
+        return items[start:None if end == -1 else end + 1]
+
+    def zadd(self, key, mapping):
+        self.setdefault(key, {}).update(mapping)
+
+    def zrangebyscore(self, key, min, max):
+        return [member.encode() for member, score
+                in sorted(self.get(key, {}).items(), key=lambda item: item[1])
+                if float(min) <= score <= float(max)]
+
+    def zremrangebyscore(self, key, min, max):
+        zset = self.get(key, {})
+        for member in self.zrangebyscore(key, min, max):
+            del zset[member.decode()]
+
+    def expire(self, key, seconds):
+        pass
+
+    def pexpire(self, key, milliseconds):
+        pass
+
+    def lock(self, name, timeout=None):
+        return unittest.mock.Mock(**{'acquire.return_value': True})
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+
+    def __init__(self, redis):
+        self._redis = redis
+        self._results = []
+
+    def __getattr__(self, name):
+        """Queue a call to a method of the Redis client."""
+        method = getattr(self._redis, name)
+
+        def call(*args, **kwargs):
+            self._results.append(method(*args, **kwargs))
+            return self
+
+        return call
+
+    def __enter__(self):
+        """Start the pipeline."""
+        return self
+
+    def __exit__(self, *args):
+        """Discard the pipeline."""
+
+    def execute(self):
+        results, self._results = self._results, []
+        return results
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(app._local, 'backend',
+                        unittest.mock.Mock(client=redis), raising=False)
+    monkeypatch.setitem(app.conf, 'gracedb_cache_ttl', 10.0)
+    monkeypatch.setitem(app.conf, 'gracedb_download_cache_ttl', 60.0)
+    monkeypatch.setitem(app.conf, 'gracedb_log_index_ttl', 86400)
+    monkeypatch.setitem(app.conf, 'gracedb_trigger_index_ttl', 86400)
+    return redis
+
+
 def pytest_runtest_setup():
     disable_socket()
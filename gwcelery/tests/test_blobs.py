@@ -0,0 +1,66 @@
+import os
+import pickle
+
+import pytest
+
+from .. import app, blobs
+
+
+@pytest.fixture
+def file_blob_store(monkeypatch, tmpdir):
+    monkeypatch.setitem(app.conf, 'blob_store', 'file://' + str(tmpdir))
+    monkeypatch.setitem(app.conf, 'blob_store_threshold', 16)
+    yield str(tmpdir)
+
+
+def test_dumps_without_blob_store(monkeypatch):
+    monkeypatch.setitem(app.conf, 'blob_store', None)
+    obj = {'data': b'x' * 1024}
+    assert blobs.get_blob_store() is None
+    assert pickle.loads(blobs.dumps(obj)) == obj
+    assert blobs.loads(blobs.dumps(obj)) == obj
+
+
+def test_dumps_with_file_blob_store(file_blob_store):
+    small = b'small'
+    large = b'x' * 1024
+    obj = ('args', large, [small, large])
+
+    data = blobs.dumps(obj)
+
+    # The large payload is stored once, and not inline in the message.
+    assert len(os.listdir(file_blob_store)) == 1
+    assert large not in data
+    assert small in data
+    assert len(data) < len(large)
+
+    assert blobs.loads(data) == obj
+
+
+def test_file_blob_store_cleanup(tmpdir):
+    store = blobs.FileBlobStore(str(tmpdir), expires=60)
+    store.put('old', b'old')
+    store.put('new', b'new')
+    os.utime(str(tmpdir / 'old'), (0, 0))
+
+    store.cleanup(force=True)
+
+    assert os.listdir(str(tmpdir)) == ['new']
+    assert store.get('new') == b'new'
+
+
+def test_file_blob_store_get_refreshes(tmpdir):
+    store = blobs.FileBlobStore(str(tmpdir), expires=60)
+    store.put('blob', b'blob')
+    os.utime(str(tmpdir / 'blob'), (0, 0))
+
+    assert store.get('blob') == b'blob'
+    store.cleanup(force=True)
+
+    assert os.listdir(str(tmpdir)) == ['blob']
+
+
+def test_file_blob_store_empty(tmpdir):
+    store = blobs.FileBlobStore(str(tmpdir), expires=60)
+    store.put('empty', b'')
+    assert store.get('empty') == b''
@@ -5,11 +5,14 @@ from xml.sax import SAXParseException
 from astropy import table
 from astropy.io import fits
 from celery.exceptions import Ignore
+from ligo.skymap.io import events
 import numpy as np
 import pytest
 
 from . import data
+from ..tasks import bayestar
 from ..tasks.bayestar import localize
+from ..util.ligolw import BAYESTAR_TABLES, load_ligolw
 from ..util.tempfile import NamedTemporaryFile
 
 
@@ -51,8 +54,45 @@ def test_localize(coinc_psd):
         assert url == 'https://gracedb.invalid/events/G211117'
 
 
+@patch('ligo.skymap.bayestar.localize', mock_bayestar)
+def test_localize_reuses_psd(coinc_psd, monkeypatch):
+    """Test that the PSD file is parsed only once for repeated events"""
+    monkeypatch.setattr(bayestar, '_psd_docs', {})
+    with patch.object(bayestar, 'load_ligolw',
+                      wraps=bayestar.load_ligolw) as mock_load_ligolw:
+        localize(coinc_psd, 'G211117')
+        localize(coinc_psd, 'G211117')
+    assert mock_load_ligolw.call_count == 3
+    assert len(bayestar._psd_docs) == 1
+
+
 @patch('ligo.skymap.bayestar.localize', mock_bayestar)
 def test_localize_all_detectors_disabled(coinc_psd):
     """Test running BAYESTAR on G211117, all detectors disabled"""
     with pytest.raises(Ignore):
         localize(coinc_psd, 'G211117', disabled_detectors=['H1', 'L1', 'V1'])
+
+
+def test_fast_xml(coinc_psd):
+    """Test reading only the tables that BAYESTAR needs from coinc.xml"""
+    coinc, psd = coinc_psd
+    psd_doc = load_ligolw(psd)
+    (full_event,), (fast_event,) = (
+        events.ligolw.open(doc, psd_file=psd_doc, coinc_def=None).values()
+        for doc in [load_ligolw(coinc),
+                    load_ligolw(coinc, tables=BAYESTAR_TABLES)])
+
+    assert fast_event.template_args == full_event.template_args
+    assert len(fast_event.singles) == len(full_event.singles)
+    for fast_single, full_single in zip(fast_event.singles,
+                                        full_event.singles):
+        for key in ['detector', 'snr', 'phase', 'time', 'zerolag_time']:
+            assert getattr(fast_single, key) == getattr(full_single, key)
+        for key in ['psd', 'snr_series']:
+            full_series = getattr(full_single, key)
+            fast_series = getattr(fast_single, key)
+            if full_series is None:
+                assert fast_series is None
+            else:
+                np.testing.assert_array_equal(
+                    fast_series.data.data, full_series.data.data)
@@ -1,5 +1,7 @@
 import subprocess
+from unittest.mock import Mock, patch
 
+from celery.exceptions import Ignore
 import pytest
 
 from ..tasks import condor
@@ -125,3 +127,78 @@ def test_check_output_fails(mock_condor_submit):
 #     """Test a job that immediately succeeds."""
 #
 #     condor.check_output.delay(['sleep', '1'])
+
+
+def _event_xml(cluster, mytype, return_value=None):
+    xml = '<c>\n<a n="MyType"><s>{}</s></a>\n'.format(mytype)
+    xml += '<a n="Cluster"><i>{}</i></a>\n'.format(cluster)
+    if return_value is not None:
+        xml += '<a n="TerminatedNormally"><b v="t"/></a>\n'
+        xml += '<a n="ReturnValue"><i>{}</i></a>\n'.format(return_value)
+    return xml + '</c>\n'
+
+
+def test_event_log(tmpdir):
+    """Test reading a shared job event log incrementally."""
+    path = str(tmpdir / 'events.log')
+    event_log = condor.EventLog(path)
+    assert event_log.read() == []
+
+    with open(path, 'w') as f:
+        f.write(_event_xml(1, 'SubmitEvent'))
+        f.write(_event_xml(2, 'SubmitEvent'))
+        # Write only part of the next event.
+        partial = _event_xml(1, 'JobTerminatedEvent', 0)
+        f.write(partial[:20])
+    assert event_log.read() == [{'MyType': 'SubmitEvent', 'Cluster': 1},
+                                {'MyType': 'SubmitEvent', 'Cluster': 2}]
+    assert event_log.read() == []
+
+    with open(path, 'a') as f:
+        f.write(partial[20:])
+    assert event_log.read() == [{'MyType': 'JobTerminatedEvent',
+                                 'Cluster': 1, 'TerminatedNormally': True,
+                                 'ReturnValue': 0}]
+
+    # If the log is truncated, start over.
+    with open(path, 'w') as f:
+        f.write(_event_xml(3, 'JobAbortedEvent'))
+    assert event_log.read() == [{'MyType': 'JobAbortedEvent', 'Cluster': 3}]
+
+
+def test_parse_cluster_id():
+    assert condor._parse_cluster_id(
+        b'Submitting job(s).\n1 job(s) submitted to cluster 1234.\n') == 1234
+    with pytest.raises(ValueError):
+        condor._parse_cluster_id(b'')
+
+
+@pytest.mark.parametrize('terminated_first', [False, True])
+@patch('gwcelery.tasks.condor.submit.run')
+def test_job_tracker_resumes_task(mock_submit, terminated_first,
+                                  fake_redis):
+    """Test that a task that is waiting for a job is resumed exactly once
+    when the job tracker finds the job's terminal event, even if the job
+    terminated before the task started waiting for it.
+    """
+    event = {'MyType': 'JobTerminatedEvent', 'Cluster': 1234,
+             'TerminatedNormally': True, 'ReturnValue': 0}
+    task = Mock(**{'signature_from_request.return_value':
+                   condor.submit.s('example.sub')})
+
+    if terminated_first:
+        condor.job_terminated(event)
+    mock_submit.assert_not_called()
+    with pytest.raises(Ignore):
+        condor._wait(task, 1234, ('example.sub',), {})
+    task.signature_from_request.assert_called_once_with(
+        task.request, ('example.sub',), {})
+    if not terminated_first:
+        mock_submit.assert_not_called()
+        condor.job_terminated(event)
+    mock_submit.assert_called_once_with('example.sub', event=event)
+
+    # A duplicate event (for example, if the log is read again after the
+    # job tracker restarts) does not resume the task again.
+    condor.job_terminated(event)
+    mock_submit.assert_called_once()
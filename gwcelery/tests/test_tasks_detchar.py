@@ -4,7 +4,7 @@ import logging
 from unittest.mock import call, patch
 
 from astropy.time import Time
-from gwpy.timeseries import Bits
+from gwpy.timeseries import Bits, StateVector
 import matplotlib.pyplot as plt
 import numpy as np
 import pytest
@@ -91,8 +91,11 @@ with resources.path(data, '') as expected_path:
     expected_path = str(expected_path / 'llhoft/omegascan/scanme.gwf')
 
 
+@pytest.mark.parametrize('threads', [1, 2])
 @patch('gwcelery.tasks.detchar.create_cache', return_value=[expected_path])
-def test_make_omegascan_worked(mock_create_cache, scan_strainname):
+def test_make_omegascan_worked(mock_create_cache, threads, monkeypatch,
+                               scan_strainname):
+    monkeypatch.setitem(app.conf, 'omegascan_threads', threads)
     durs = [1, 1, 1]
     t0 = 1126259463
     png = detchar.make_omegascan('H1', t0, durs)
@@ -174,6 +177,31 @@ def test_dqr_json(mock_time, mock_host, mock_user):
     }
 
 
+@pytest.mark.parametrize('logic_type,reduce', [('all', np.all),
+                                               ('any', np.any)])
+def test_evaluate_bits(logic_type, reduce):
+    bits = Bits(channel='H1:GDS-CALIB_STATE_VECTOR',
+                bits=app.conf['detchar_bit_definitions'][
+                    'ligo_state_vector_bits']['bits'])
+    values = np.asarray([0b111100011, 0b111000011, 0b101100001],
+                        dtype=np.uint32)
+    states = detchar.evaluate_bits(values, 'H1', bits, logic_type)
+    statevector = StateVector(values, bits=bits)
+    expected = {'H1:' + key: int(reduce(value.value)) for key, value
+                in statevector.get_bit_series().items()}
+    assert dict(zip(states['name'], states['state'])) == expected
+    assert states['ifo'].tolist() == ['H1'] * 6
+    assert states['injection'].tolist() == [False] * 2 + [True] * 4
+
+
+def test_evaluate_bits_unknown():
+    bits = Bits(channel='H1:DMT-DQ_VECTOR', bits={1: 'A', 2: 'B'})
+    states = detchar.evaluate_bits(np.asarray([]), 'H1', bits)
+    assert states['state'].tolist() == [-1, -1]
+    with pytest.raises(ValueError):
+        detchar.evaluate_bits(None, 'H1', bits, 'some')
+
+
 def test_check_vector(llhoft_glob_pass):
     channel = 'H1:DMT-DQ_VECTOR'
     start, end = 1216577976, 1216577980
@@ -203,6 +231,128 @@ def test_check_vector_fails_on_empty(mock_statevector, llhoft_glob_pass):
         'H1:NO_DMT-ETMY_ESD_DAC_OVERFLOW': None}
 
 
+def test_read_channels(llhoft_glob_pass):
+    """Test that channels that are read together give the same results as
+    channels that are read one at a time.
+    """
+    channels = ['H1:DMT-DQ_VECTOR', 'H1:GDS-CALIB_STATE_VECTOR']
+    start, end = 1216577976, 1216577980
+    cache, data = detchar.read_channels('H1', channels, start, end)
+    assert sorted(data) == channels
+    bit_defs = {channel_type: Bits(channel=bitdef['channel'],
+                                   bits=bitdef['bits'])
+                for channel_type, bitdef
+                in app.conf['detchar_bit_definitions'].items()}
+    for channel, bits in zip(channels, ['dmt_dq_vector_bits',
+                                        'ligo_state_vector_bits']):
+        expected = detchar.check_vector(
+            cache, channel, start, end, bit_defs[bits])
+        assert None not in expected.values()
+        assert detchar.check_vector(
+            cache, channel, start, end, bit_defs[bits],
+            data=data[channel]) == expected
+
+
+def test_read_channels_cached(monkeypatch, llhoft_glob_pass):
+    """Test that overlapping time spans are served from the cache, reading
+    only the missing edges.
+    """
+    monkeypatch.setitem(app.conf, 'detchar_cache_ttl', 60)
+    monkeypatch.setattr(detchar, '_series', {})
+    channels = ['H1:DMT-DQ_VECTOR', 'H1:GDS-CALIB_STATE_VECTOR']
+    start, end = 1216577977, 1216577978
+    _, data = detchar.read_channels('H1', channels, start, end)
+
+    with patch('gwcelery.tasks.detchar.TimeSeriesDict.read',
+               wraps=detchar.TimeSeriesDict.read) as mock_read:
+        # Same span: nothing is read.
+        _, cached_data = detchar.read_channels('H1', channels, start, end)
+        mock_read.assert_not_called()
+        for channel in channels:
+            assert np.array_equal(cached_data[channel], data[channel])
+
+        # Longer span: only the right edge is read.
+        _, cached_data = detchar.read_channels('H1', channels, start, end + 1)
+        mock_read.assert_called_once()
+        assert mock_read.call_args[1]['start'] == end
+
+    monkeypatch.setitem(app.conf, 'detchar_cache_ttl', 0)
+    _, expected = detchar.read_channels('H1', channels, start, end + 1)
+    for channel in channels:
+        assert cached_data[channel].span == expected[channel].span
+        assert np.array_equal(cached_data[channel], expected[channel])
+
+
+def test_read_channels_cached_edge_unavailable(monkeypatch,
+                                               llhoft_glob_pass):
+    """Test that if a missing edge cannot be read, then the whole span is
+    read instead of returning only the cached data.
+    """
+    monkeypatch.setitem(app.conf, 'detchar_cache_ttl', 60)
+    monkeypatch.setattr(detchar, '_series', {})
+    channels = ['H1:DMT-DQ_VECTOR', 'H1:GDS-CALIB_STATE_VECTOR']
+    start, end = 1216577977, 1216577978
+    detchar.read_channels('H1', channels, start, end)
+    read = detchar.TimeSeriesDict.read
+
+    def read_except_edge(cache, channels, *, start, end):
+        if start == 1216577978:
+            raise RuntimeError('edge is not available')
+        return read(cache, channels, start=start, end=end)
+
+    with patch('gwcelery.tasks.detchar.TimeSeriesDict.read',
+               side_effect=read_except_edge) as mock_read:
+        _, data = detchar.read_channels('H1', channels, start, end + 1)
+    assert mock_read.call_count == 2
+    assert mock_read.call_args[1]['start'] == start
+    for channel in channels:
+        assert data[channel].span == (start, end + 1)
+
+    # If the whole span cannot be read either, then nothing is returned.
+    monkeypatch.setattr(detchar, '_series', {})
+    detchar.read_channels('H1', channels, start, end)
+    with patch('gwcelery.tasks.detchar.TimeSeriesDict.read',
+               side_effect=RuntimeError('data is not available')):
+        _, data = detchar.read_channels('H1', channels, start, end + 1)
+    assert data == {}
+
+
+def test_read_channels_cache_cropped(monkeypatch, llhoft_glob_pass):
+    """Test that time series are cropped to their most recent data before
+    they are cached.
+    """
+    monkeypatch.setitem(app.conf, 'detchar_cache_ttl', 60)
+    monkeypatch.setattr(detchar, '_series', {})
+    monkeypatch.setattr(detchar, '_SERIES_MAX_DURATION', 1.0)
+    channel = 'H1:DMT-DQ_VECTOR'
+    _, data = detchar.read_channels('H1', [channel], 1216577977, 1216577979)
+    assert data[channel].span == (1216577977, 1216577979)
+    _, series = detchar._series[channel]
+    assert series.span == (1216577978, 1216577979)
+
+
+@patch('gwcelery.tasks.detchar.dqr_json', return_value='dqrjson')
+@patch('gwcelery.tasks.gracedb.upload.run')
+@patch('gwcelery.tasks.gracedb.remove_label')
+@patch('gwcelery.tasks.gracedb.create_label')
+def test_check_vectors_reads_each_ifo_once(
+        mock_create_label, mock_remove_label, mock_upload, mock_json,
+        llhoft_glob_pass, ifo_h1, ifo_h1_idq):
+    event = {'search': 'AllSky', 'instruments': 'H1', 'pipeline': 'oLIB'}
+    start, end = 1216577978, 1216577978.1
+    with patch('gwcelery.tasks.detchar.read_channels',
+               wraps=detchar.read_channels) as mock_read, \
+            patch('gwcelery.tasks.detchar.StateVector.read') as mock_sv, \
+            patch('gwcelery.tasks.detchar.TimeSeries.read') as mock_ts:
+        detchar.check_vectors(event, 'S12345a', start, end)
+    mock_read.assert_called_once_with(
+        'H1', ['H1:DMT-DQ_VECTOR', 'H1:GDS-CALIB_STATE_VECTOR',
+               'H1:IDQ-PGLITCH_OVL_32_2048'], start - 1.5, end + 1.5)
+    mock_sv.assert_not_called()
+    mock_ts.assert_not_called()
+    mock_create_label.assert_called_with('DQOK', 'S12345a')
+
+
 def test_check_vectors_skips_mdc(caplog):
     """Test that detchar checks are skipped for MDC events."""
     caplog.set_level(logging.INFO)
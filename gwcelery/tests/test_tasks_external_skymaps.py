@@ -1,6 +1,15 @@
 from importlib import resources
+import io
 from unittest.mock import patch
 
+from astropy import units as u
+from astropy.coordinates import ICRS, SkyCoord
+from astropy.io import fits
+from astropy.table import Table
+from astropy_healpix import HEALPix
+import gcn
+import healpy as hp
+from ligo.skymap.io import read_sky_map, write_sky_map
 import numpy as np
 import pytest
 
@@ -64,7 +73,8 @@ def mock_get_file_contents(monkeypatch, toy_fits_filecontents):  # noqa: F811
 @patch('gwcelery.tasks.skymaps.plot_allsky.run')
 @patch('gwcelery.tasks.gracedb.upload.run')
 @patch('gwcelery.tasks.external_skymaps.combine_skymaps.run')
-@patch('gwcelery.tasks.gracedb.download')
+@patch('gwcelery.tasks.gracedb.download.run',
+       side_effect=lambda filename, graceid: graceid.encode())
 @patch('gwcelery.tasks.external_skymaps.get_skymap_filename',
        return_value='fermi_skymap.fits.gz,0')
 def test_create_combined_skymap(mock_get_skymap_filename,
@@ -74,14 +84,52 @@ def test_create_combined_skymap(mock_get_skymap_filename,
     """Test creating combined LVC and Fermi skymap"""
     # Run function under test
     external_skymaps.create_combined_skymap('S12345', 'E12345')
-    mock_combine_skymaps.assert_called_once()
+    mock_combine_skymaps.assert_called_once_with([b'S12345', b'E12345'])
     mock_upload.assert_called()
 
 
+def test_combine_skymaps():
+    """Test combining a multi-order sky map with a RING-ordered sky map."""
+    rng = np.random.default_rng(0)
+
+    # Multi-order sky map: order 1, except that the first pixel is split
+    # into four pixels at order 2.
+    uniq = np.concatenate((4 * 4**2 + np.arange(4),
+                           4 * 4**1 + np.arange(1, 48)))
+    probdensity = rng.uniform(size=len(uniq))
+    gw_table = Table([uniq, probdensity], names=['UNIQ', 'PROBDENSITY'])
+    gw_table.meta['gps_time'] = 1e9
+    gw_table.meta['instruments'] = {'H1', 'L1'}
+    with io.BytesIO() as f:
+        write_sky_map(f, gw_table)
+        gw_filecontents = f.getvalue()
+
+    ext_ring = rng.uniform(size=hp.nside2npix(2))
+    with io.BytesIO() as f:
+        write_sky_map(f, ext_ring, nest=False, gps_time=1e9 + 2)
+        ext_filecontents = f.getvalue()
+
+    combined = external_skymaps.combine_skymaps(
+        [gw_filecontents, ext_filecontents])
+    with fits.open(io.BytesIO(combined)) as hdus:
+        prob, meta = read_sky_map(hdus, nest=True)
+
+    gw_nest = np.concatenate((probdensity[:4],
+                              np.repeat(probdensity[4:], 4)))
+    ext_nest = np.repeat(ext_ring[hp.nest2ring(2, np.arange(48))], 4)
+    expected = gw_nest * ext_nest
+    np.testing.assert_allclose(prob, expected / expected.sum())
+    assert meta['gps_time'] == pytest.approx(1e9 + 1)
+    assert meta['instruments'] == {'H1', 'L1'}
+
+
 @patch('gwcelery.tasks.gracedb.get_log', mock_get_log)
 def test_get_skymap_filename():
     """Test getting the LVC skymap fits filename"""
-    external_skymaps.get_skymap_filename('S12345')
+    assert external_skymaps.get_skymap_filename('S12345') == \
+        'bayestar.fits.gz'
+    assert external_skymaps.get_skymap_filename('S12345', versioned=True) == \
+        'bayestar.fits.gz,0'
 
 
 @patch('gwcelery.tasks.gracedb.get_event', mock_get_event)
@@ -156,6 +204,37 @@ def test_create_fermi_skymap():
            pytest.approx(1.0, 1.e-9))
 
 
+@pytest.mark.parametrize('nside', [64, 512])
+def test_gaussian_skymap(nside):
+    """Test Gaussian sky maps against angular separations from astropy."""
+    ra, dec, sigma = 123.0, -45.0, np.radians(2.0)
+    skymap = external_skymaps._gaussian_skymap(nside, ra, dec, sigma)
+    hpx = HEALPix(nside, 'ring', frame=ICRS())
+    distance = hpx.healpix_to_skycoord(np.arange(hpx.npix)).separation(
+        SkyCoord(ra * u.deg, dec * u.deg)).rad
+    expected = np.exp(-0.5 * np.square(distance / sigma))
+    expected[distance > external_skymaps._GAUSSIAN_TRUNCATION * sigma] = 0
+    expected /= expected.sum()
+    np.testing.assert_allclose(skymap, expected, rtol=1e-9, atol=1e-15)
+
+
+def test_fermi_beam_window():
+    """Test that the combined beam window is equivalent to smoothing with the
+    core and tail Gaussians separately.
+    """
+    ra, dec, error = 10.0, 20.0, 5.0
+    skymap = external_skymaps._gaussian_skymap(16, ra, dec, np.radians(error))
+    weights, scales = external_skymaps._FERMI_SYSTEMATICS[
+        gcn.NoticeType.FERMI_GBM_GND_POS]
+    expected = sum(
+        weight * hp.sphtfunc.smoothing(skymap, sigma=np.radians(scale))
+        for weight, scale in zip(weights, scales))
+    expected /= expected.sum()
+    result = external_skymaps.create_external_skymap(
+        ra, dec, error, 'Fermi', gcn.NoticeType.FERMI_GBM_GND_POS)
+    np.testing.assert_allclose(result, expected, rtol=1e-9, atol=1e-15)
+
+
 @patch('gwcelery.tasks.gracedb.upload.run')
 @patch('gwcelery.tasks.skymaps.plot_allsky.run')
 def test_create_upload_swift_skymap(mock_plot_allsky,
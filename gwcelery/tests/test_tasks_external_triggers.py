@@ -314,8 +314,8 @@ def test_handle_replace_snews_event(mock_get_events, mock_replace_event):
     mock_replace_event.assert_called_once_with('E1', text)
 
 
-@patch('gwcelery.tasks.raven.coincidence_search')
-def test_handle_grb_exttrig_creation(mock_raven_coincidence_search):
+@patch('gwcelery.tasks.raven.coincidence_searches')
+def test_handle_grb_exttrig_creation(mock_raven_coincidence_searches):
     """Test dispatch of an LVAlert message for an exttrig creation."""
     # Test LVAlert payload.
     alert = read_json(data, 'lvalert_exttrig_creation.json')
@@ -324,13 +324,13 @@ def test_handle_grb_exttrig_creation(mock_raven_coincidence_search):
     external_triggers.handle_grb_lvalert(alert)
 
     # Check that the correct tasks were dispatched.
-    mock_raven_coincidence_search.assert_has_calls([
-        call('E1234', alert['object'], group='Burst'),
-        call('E1234', alert['object'], group='CBC', searches=['GRB'])])
+    mock_raven_coincidence_searches.assert_called_once_with(
+        'E1234', alert['object'],
+        [('Burst', [], None), ('CBC', [], ['GRB'])])
 
 
-@patch('gwcelery.tasks.raven.coincidence_search')
-def test_handle_subgrb_exttrig_creation(mock_raven_coincidence_search):
+@patch('gwcelery.tasks.raven.coincidence_searches')
+def test_handle_subgrb_exttrig_creation(mock_raven_coincidence_searches):
     """Test dispatch of an LVAlert message for an exttrig creation."""
     # Test LVAlert payload.
     alert = read_json(data, 'lvalert_subgrb_creation.json')
@@ -339,15 +339,15 @@ def test_handle_subgrb_exttrig_creation(mock_raven_coincidence_search):
     external_triggers.handle_grb_lvalert(alert)
 
     # Check that the correct tasks were dispatched.
-    mock_raven_coincidence_search.assert_has_calls([
-        call('E1234', alert['object'], group='Burst'),
-        call('E1234', alert['object'], group='CBC',
-             searches=['SubGRB', 'SubGRBTargeted'], pipelines=['Fermi'])])
+    mock_raven_coincidence_searches.assert_called_once_with(
+        'E1234', alert['object'],
+        [('Burst', [], None),
+         ('CBC', ['Fermi'], ['SubGRB', 'SubGRBTargeted'])])
 
 
 @patch('gwcelery.tasks.external_skymaps.create_upload_external_skymap')
-@patch('gwcelery.tasks.raven.coincidence_search')
-def test_handle_subgrb_targeted_creation(mock_raven_coincidence_search,
+@patch('gwcelery.tasks.raven.coincidence_searches')
+def test_handle_subgrb_targeted_creation(mock_raven_coincidence_searches,
                                          mock_create_upload_external_skymap):
     """Test dispatch of an LVAlert message for an exttrig creation."""
     # Test LVAlert payload.
@@ -361,11 +361,10 @@ def test_handle_subgrb_targeted_creation(mock_raven_coincidence_search,
         alert['object'], None, alert['object']['created'])
 
     # Check that the correct tasks were dispatched.
-    mock_raven_coincidence_search.assert_has_calls([
-        call('E1234', alert['object'], group='Burst'),
-        call('E1234', alert['object'], group='CBC',
-             searches=['SubGRB', 'SubGRBTargeted'],
-             pipelines=['Swift'])])
+    mock_raven_coincidence_searches.assert_called_once_with(
+        'E1234', alert['object'],
+        [('Burst', [], None),
+         ('CBC', ['Swift'], ['SubGRB', 'SubGRBTargeted'])])
 
 
 @pytest.mark.parametrize('calls, path',
@@ -391,8 +390,8 @@ def test_handle_sntrig_creation(mock_raven_coincidence_search, calls, path):
 @patch('gwcelery.tasks.gracedb.get_superevent',
        return_value={'preferred_event': 'M4634'})
 @patch('gwcelery.tasks.gracedb.get_group', return_value='CBC')
-@patch('gwcelery.tasks.raven.coincidence_search')
-def test_handle_superevent_cbc_creation(mock_raven_coincidence_search,
+@patch('gwcelery.tasks.raven.coincidence_searches')
+def test_handle_superevent_cbc_creation(mock_raven_coincidence_searches,
                                         mock_get_group,
                                         mock_get_superevent):
     """Test dispatch of an LVAlert message for a CBC superevent creation."""
@@ -403,20 +402,18 @@ def test_handle_superevent_cbc_creation(mock_raven_coincidence_search,
     external_triggers.handle_grb_lvalert(alert)
 
     # Check that the correct tasks were dispatched.
-    mock_raven_coincidence_search.assert_has_calls([
-        call('S180616h', alert['object'], group='CBC',
-             searches=['GRB']),
-        call('S180616h', alert['object'], group='CBC',
-             pipelines=['Fermi'], searches=['SubGRB', 'SubGRBTargeted']),
-        call('S180616h', alert['object'], group='CBC',
-             pipelines=['Swift'], searches=['SubGRB', 'SubGRBTargeted'])])
+    mock_raven_coincidence_searches.assert_called_once_with(
+        'S180616h', alert['object'],
+        [('CBC', [], ['GRB']),
+         ('CBC', ['Fermi'], ['SubGRB', 'SubGRBTargeted']),
+         ('CBC', ['Swift'], ['SubGRB', 'SubGRBTargeted'])])
 
 
 @patch('gwcelery.tasks.gracedb.get_superevent',
        return_value={'preferred_event': 'M4634'})
 @patch('gwcelery.tasks.gracedb.get_group', return_value='Burst')
-@patch('gwcelery.tasks.raven.coincidence_search')
-def test_handle_superevent_burst_creation(mock_raven_coincidence_search,
+@patch('gwcelery.tasks.raven.coincidence_searches')
+def test_handle_superevent_burst_creation(mock_raven_coincidence_searches,
                                           mock_get_group,
                                           mock_get_superevent):
     """Test dispatch of an LVAlert message for a burst superevent creation."""
@@ -427,5 +424,5 @@ def test_handle_superevent_burst_creation(mock_raven_coincidence_search,
     external_triggers.handle_grb_lvalert(alert)
 
     # Check that the correct tasks were dispatched.
-    mock_raven_coincidence_search.assert_has_calls([
-        call('S180616h', alert['object'], group='Burst', searches=['GRB'])])
+    mock_raven_coincidence_searches.assert_called_once_with(
+        'S180616h', alert['object'], [('Burst', [], ['GRB'])])
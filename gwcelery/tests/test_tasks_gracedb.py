@@ -2,6 +2,9 @@ from collections import defaultdict
 from importlib import resources
 from unittest import mock
 
+from astropy.time import Time
+
+from .. import app
 from ..tasks import gracedb
 from . import data
 
@@ -161,3 +164,162 @@ def test_replace_event(mock_gracedb):
     gracedb.replace_event(graceid='G123456', payload=text)
     mock_gracedb.events.update.assert_called_once_with('G123456',
                                                        filecontents=text)
+
+
+@patch('gwcelery.tasks.gracedb.client')
+def test_cached_read(mock_gracedb, fake_redis):
+    get = mock_gracedb.events['G123456'].get
+    get.return_value = {'graceid': 'G123456', 'labels': []}
+
+    assert gracedb.get_event('G123456') == get.return_value
+    assert gracedb.get_event('G123456') == get.return_value
+    get.assert_called_once_with()
+    assert gracedb.cache_stats() == {'hits': 1, 'misses': 1}
+
+    # Writes discard the cached copy.
+    gracedb.create_label('DQV', 'G123456')
+    gracedb.get_event('G123456')
+    assert get.call_count == 2
+
+    # So do LVAlert messages, through invalidate_cache.
+    gracedb.get_event('G123456')
+    assert get.call_count == 2
+    gracedb.invalidate_cache('G123456')
+    gracedb.get_event('G123456')
+    assert get.call_count == 3
+
+
+@patch('gwcelery.tasks.gracedb.client')
+def test_create_superevent_invalidates_cache(mock_gracedb, fake_redis):
+    """Test that creating a superevent discards the cached copy of its
+    preferred event, which now names the superevent.
+    """
+    get = mock_gracedb.events['G123456'].get
+    get.return_value = {'graceid': 'G123456', 'superevent': None}
+    mock_gracedb.superevents.create.return_value = {'superevent_id': 'S1'}
+
+    gracedb.get_event('G123456')
+    get.return_value = {'graceid': 'G123456', 'superevent': 'S1'}
+    assert gracedb.create_superevent('G123456', 1.0, 0.0, 2.0) == 'S1'
+    assert gracedb.get_event('G123456') == get.return_value
+    assert get.call_count == 2
+
+
+@patch('gwcelery.tasks.gracedb.client')
+def test_cached_read_stale_fill(mock_gracedb, fake_redis):
+    """Test that a read that started before a write does not fill the cache
+    with the stale result that it got.
+    """
+    get = mock_gracedb.events['G123456'].get
+
+    def get_and_modify():
+        # The event is modified while the read is in flight.
+        gracedb.invalidate_cache('G123456')
+        return {'graceid': 'G123456', 'labels': []}
+
+    get.side_effect = get_and_modify
+    assert gracedb.get_event('G123456') == {'graceid': 'G123456',
+                                            'labels': []}
+
+    get.side_effect = None
+    get.return_value = {'graceid': 'G123456', 'labels': ['DQV']}
+    assert gracedb.get_event('G123456') == get.return_value
+    assert gracedb.get_event('G123456') == get.return_value
+    assert get.call_count == 2
+
+
+@patch('gwcelery.tasks.gracedb.client')
+@patch('gwcelery.tasks.gracedb.get_log')
+def test_create_tag_from_log_index(mock_get_log, mock_gracedb, fake_redis):
+    mock_gracedb.events['graceid'].logs.create.return_value = {
+        'N': 5, 'filename': 'bat', 'file_version': 1}
+    filename = gracedb.upload('filecontents', 'bat', 'graceid', 'message')
+    assert filename == 'bat,1'
+    gracedb.create_tag(filename, 'tag', 'graceid')
+    mock_get_log.assert_not_called()
+    mock_gracedb.events['graceid'].logs[
+        5].tags.create.assert_called_once_with('tag')
+
+    # Files that are not in the index are found by searching the full log.
+    mock_get_log.return_value = [
+        {'filename': 'bat', 'file_version': 0, 'N': 3}]
+    gracedb.create_tag('bat,0', 'tag', 'graceid')
+    mock_get_log.assert_called_once_with('graceid')
+    mock_gracedb.events['graceid'].logs[
+        3].tags.create.assert_called_once_with('tag')
+    assert gracedb._lookup_log_number('graceid', 'bat', 0) == 3
+
+
+@patch('gwcelery.tasks.gracedb.client')
+def test_download_shared(mock_gracedb, fake_redis):
+    files = mock_gracedb.events['graceid'].files
+    files['coinc.xml'].get.return_value.__enter__.return_value.read \
+        .return_value = b'coinc'
+
+    assert gracedb.download('coinc.xml', 'graceid') == b'coinc'
+    assert gracedb.download('coinc.xml', 'graceid') == b'coinc'
+    files['coinc.xml'].get.assert_called_once_with()
+    assert gracedb.download_stats() == {'coinc.xml': 5}
+    assert gracedb.download_cache_stats() == {'hits': 1, 'misses': 1}
+    # Downloads do not count towards the hit rate of the read cache.
+    assert gracedb.cache_stats() == {'hits': 0, 'misses': 0}
+
+    # A new upload discards the shared copy.
+    gracedb.upload(b'new coinc', 'coinc.xml', 'graceid', 'message')
+    gracedb.download('coinc.xml', 'graceid')
+    assert files['coinc.xml'].get.call_count == 2
+    assert gracedb.download_stats() == {'coinc.xml': 10}
+
+
+@patch('gwcelery.tasks.gracedb.client')
+def test_download_too_large_to_share(mock_gracedb, monkeypatch, fake_redis):
+    monkeypatch.setitem(app.conf, 'gracedb_download_cache_max_size', 4)
+    files = mock_gracedb.events['graceid'].files
+    files['coinc.xml'].get.return_value.__enter__.return_value.read \
+        .return_value = b'coinc'
+
+    assert gracedb.download('coinc.xml', 'graceid') == b'coinc'
+    assert gracedb.download('coinc.xml', 'graceid') == b'coinc'
+    assert files['coinc.xml'].get.call_count == 2
+    assert b'coinc' not in fake_redis.values()
+
+
+@patch('gwcelery.tasks.gracedb.client')
+def test_download_shared_blob_store(mock_gracedb, monkeypatch, tmpdir,
+                                    fake_redis):
+    monkeypatch.setitem(app.conf, 'blob_store', 'file://' + str(tmpdir))
+    monkeypatch.setitem(app.conf, 'gracedb_download_cache_max_size', 4)
+    files = mock_gracedb.events['graceid'].files
+    files['coinc.xml'].get.return_value.__enter__.return_value.read \
+        .return_value = b'coinc'
+
+    assert gracedb.download('coinc.xml', 'graceid') == b'coinc'
+    assert gracedb.download('coinc.xml', 'graceid') == b'coinc'
+    files['coinc.xml'].get.assert_called_once_with()
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_trigger_index(monkeypatch, fake_redis):
+    monkeypatch.setattr(gracedb, '_TRIGGER_INDEX_MARGIN', 0.0)
+    now = Time.now().gps
+    gracedb.record_lvalert_listener(now - 1000, 30)
+    gracedb.index_trigger({'superevent_id': 'S1', 't_0': now + 10})
+    gracedb.index_trigger({'graceid': 'E1', 'group': 'External',
+                           'gpstime': now + 20})
+    gracedb.index_trigger({'graceid': 'G1', 'group': 'CBC',
+                           'gpstime': now + 10})
+
+    assert gracedb.lookup_triggers('Superevent', now + 5, now + 15) == ['S1']
+    assert gracedb.lookup_triggers('External', now + 5, now + 15) == []
+    assert gracedb.lookup_triggers('External', now + 5, now + 25) == ['E1']
+    # Windows that begin before the index was created are not covered.
+    assert gracedb.lookup_triggers('Superevent', now - 100, now + 15) is None
+
+    # Nothing is covered if the LVAlert listener is disconnected, or has
+    # reconnected since the window began, because it may have missed
+    # messages.
+    gracedb.record_lvalert_listener(None, 30)
+    assert gracedb.lookup_triggers('External', now + 5, now + 15) is None
+    gracedb.record_lvalert_listener(now + 6, 30)
+    assert gracedb.lookup_triggers('External', now + 5, now + 15) is None
+    assert gracedb.lookup_triggers('External', now + 7, now + 15) == []
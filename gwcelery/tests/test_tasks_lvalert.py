@@ -8,7 +8,7 @@ from unittest.mock import patch
 import lxml
 import pytest
 
-from ..tasks import lvalert
+from ..tasks import gracedb, lvalert
 from . import data
 
 
@@ -59,6 +59,36 @@ def test_handle_messages(mock_superevents_handle, mock_get_event,
     mock_superevents_handle.assert_called_once()
 
 
+@patch('gwcelery.tasks.orchestrator.handle_cbc_event.run')
+@patch('gwcelery.tasks.superevents.handle.run')
+def test_handle_messages_invalidates_cache(mock_superevents_handle,
+                                           mock_handle_cbc_event,
+                                           netrc_lvalert, fake_lvalert,
+                                           fake_redis):
+    """Test that an LVAlert message discards the cached reads of the event
+    that it is about.
+    """
+    node, payload = fake_lvalert
+
+    # Manipulate alert content
+    alert = json.loads(payload)
+    alert['object']['self'] = \
+        alert['object']['self'].replace('gracedb.ligo.org', 'gracedb.invalid')
+    payload = json.dumps(alert)
+
+    get = gracedb.client.events[alert['uid']].get
+    get.return_value = {'graceid': alert['uid'], 'labels': []}
+    gracedb.get_event(alert['uid'])
+    gracedb.get_event(alert['uid'])
+    get.assert_called_once_with()
+
+    # Run function under test
+    get.return_value = {'graceid': alert['uid'], 'labels': ['EM_READY']}
+    lvalert.handler.dispatch(node, payload)
+    assert gracedb.get_event(alert['uid']) == get.return_value
+    assert get.call_count == 2
+
+
 @patch('gwcelery.tasks.superevents.handle.run')
 def test_handle_messages_wrong_server(mock_superevents_handle,
                                       netrc_lvalert, fake_lvalert, caplog):
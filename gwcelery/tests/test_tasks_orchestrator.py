@@ -349,7 +349,8 @@ def test_handle_cbc_event(mock_localize, mock_get_event):
     'alert_type,filename',
     [['new', ''], ['log', 'psd.xml.gz'],
      ['log', 'test.posterior_samples.hdf5']])
-def test_handle_posterior_samples(monkeypatch, alert_type, filename):
+def test_handle_posterior_samples(monkeypatch, alert_type, filename,
+                                  toy_3d_fits_filecontents):  # noqa: F811
     alert = {
         'alert_type': alert_type,
         'uid': 'S1234',
@@ -358,10 +359,9 @@ def test_handle_posterior_samples(monkeypatch, alert_type, filename):
 
     download = Mock()
     em_bright_pe = Mock()
-    skymap_from_samples = Mock()
-    fits_header = Mock()
+    skymap_from_samples = Mock(return_value=toy_3d_fits_filecontents)
     plot_allsky = Mock()
-    annotate_fits_volume = Mock()
+    plot_volume = Mock()
     upload = Mock()
     flatten = Mock()
 
@@ -370,10 +370,8 @@ def test_handle_posterior_samples(monkeypatch, alert_type, filename):
     monkeypatch.setattr('gwcelery.tasks.gracedb.download._orig_run', download)
     monkeypatch.setattr('gwcelery.tasks.skymaps.skymap_from_samples.run',
                         skymap_from_samples)
-    monkeypatch.setattr('gwcelery.tasks.skymaps.fits_header.run', fits_header)
     monkeypatch.setattr('gwcelery.tasks.skymaps.plot_allsky.run', plot_allsky)
-    monkeypatch.setattr('gwcelery.tasks.skymaps.annotate_fits_volume.run',
-                        annotate_fits_volume)
+    monkeypatch.setattr('gwcelery.tasks.skymaps.plot_volume.run', plot_volume)
     monkeypatch.setattr('gwcelery.tasks.gracedb.upload._orig_run', upload)
     monkeypatch.setattr('gwcelery.tasks.skymaps.flatten.run', flatten)
 
@@ -383,16 +381,14 @@ def test_handle_posterior_samples(monkeypatch, alert_type, filename):
     if alert['alert_type'] != 'log' or \
             not alert['data']['filename'].endswith('.posterior_samples.hdf5'):
         skymap_from_samples.assert_not_called()
-        fits_header.assert_not_called()
         plot_allsky.assert_not_called()
-        annotate_fits_volume.assert_not_called()
+        plot_volume.assert_not_called()
         flatten.assert_not_called()
     else:
         em_bright_pe.assert_called_once()
         skymap_from_samples.assert_called_once()
-        fits_header.assert_called_once()
         plot_allsky.assert_called_once()
-        annotate_fits_volume.assert_called_once()
+        plot_volume.assert_called_once()
         flatten.assert_called_once()
 
 
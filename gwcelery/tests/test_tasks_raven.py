@@ -1,8 +1,16 @@
-from unittest.mock import call, patch
-
+import io
+import json
+from unittest.mock import ANY, Mock, call, patch
+
+from astropy.table import Table
+from astropy.time import Time
+import healpy as hp
+import numpy as np
 import pytest
 
 from .test_tasks_skymaps import toy_fits_filecontents  # noqa: F401
+from .. import app
+from ..tasks import gracedb as tasks_gracedb
 from ..tasks import legacy_gracedb as gracedb
 from ..tasks import raven
 
@@ -52,20 +60,135 @@ def test_raven_search(mock_raven_search, mock_se_cls, mock_exttrig_cls,
     raven.search(event_id, alert_object)
     if event_id == 'S1234':
         mock_raven_search.assert_called_once_with(
-            mock_se_cls(event_id, gracedb=gracedb.client), -5, 5,
-            gracedb=gracedb.client, group=None, pipelines=[], searches=[])
+            mock_se_cls.return_value, -5, 5,
+            gracedb=ANY, group=None, pipelines=[], searches=[])
+        mock_se_cls.assert_called_once_with(event_id, gracedb=ANY)
     elif event_id == 'E1234':
         mock_raven_search.assert_called_once_with(
-            mock_exttrig_cls(event_id, gracedb=gracedb.client), -5, 5,
-            gracedb=gracedb.client, group=None, pipelines=[], searches=[])
+            mock_exttrig_cls.return_value, -5, 5,
+            gracedb=ANY, group=None, pipelines=[], searches=[])
+        mock_exttrig_cls.assert_called_once_with(event_id, gracedb=ANY)
     else:
         raise ValueError
+    client = mock_raven_search.call_args[1]['gracedb']
+    assert client.writeLog is gracedb.client.writeLog
+
+
+@patch('ligo.raven.gracedb_events.SE')
+def test_raven_search_trigger_index(mock_se_cls, monkeypatch,
+                                    fake_redis):
+    """Test that GraceDB is only queried for candidates if the trigger index
+    has candidates, or if it does not cover the search window, and that
+    ligo.raven reports the result either way.
+    """
+    monkeypatch.setattr(tasks_gracedb, '_TRIGGER_INDEX_MARGIN', 0.0)
+    client = Mock()
+    client.events.return_value = []
+    monkeypatch.setattr(gracedb, 'client', client)
+    now = Time.now().gps
+    alert_object = {'superevent_id': 'S1', 't_0': now + 100}
+    mock_se_cls.return_value = Mock(graceid='S1', neighbor_type='E',
+                                    gpstime=now + 100)
+    tasks_gracedb.index_trigger(alert_object)
+    tasks_gracedb.index_trigger({'graceid': 'E1', 'group': 'External',
+                                 'gpstime': now + 10})
+
+    # The LVAlert listener has not reported that it is connected, so the
+    # index cannot be trusted.
+    assert raven.search('S1', alert_object, -5, 1,
+                        pipelines=['Fermi']) == []
+    client.events.assert_called_once()
+    client.writeLog.assert_called_once_with(
+        'S1', ANY, tag_name=['ext_coinc'])
+
+    client.reset_mock()
+    tasks_gracedb.record_lvalert_listener(now - 1000, 30)
+    assert raven.search('S1', alert_object, -5, 1,
+                        pipelines=['Fermi']) == []
+    client.events.assert_not_called()
+    client.writeLog.assert_called_once_with(
+        'S1', ANY, tag_name=['ext_coinc'])
+
+    tasks_gracedb.index_trigger({'graceid': 'E2', 'group': 'External',
+                                 'gpstime': now + 99})
+    raven.search('S1', alert_object, -5, 1, pipelines=['Fermi'])
+    client.events.assert_called_once()
+
+
+@patch('gwcelery.tasks.raven.raven_pipeline.run')
+@patch('gwcelery.tasks.raven.search_many.run',
+       return_value=[[{'graceid': 'E2'}], []])
+def test_coincidence_searches(mock_search_many, mock_raven_pipeline):
+    """Test that a fused search launches the raven pipeline for each
+    search specification with its own time window.
+    """
+    alert_object = {'superevent_id': 'S1'}
+    specs = [('CBC', [], ['GRB']),
+             ('CBC', ['Fermi'], ['SubGRB', 'SubGRBTargeted'])]
+    raven.coincidence_searches('S1', alert_object, specs)
+
+    mock_search_many.assert_called_once_with('S1', alert_object, specs)
+    mock_raven_pipeline.assert_has_calls([
+        call([{'graceid': 'E2'}], 'S1', alert_object, -1, 5, 'CBC'),
+        call([], 'S1', alert_object, -1, 11, 'CBC')])
+
+
+@patch('gwcelery.tasks.raven.group')
+def test_raven_pipelines(mock_group):
+    """Test that the raven pipeline for each search specification is launched
+    as its own task.
+    """
+    alert_object = {'superevent_id': 'S1'}
+    specs = [('CBC', [], ['GRB']),
+             ('CBC', ['Fermi'], ['SubGRB', 'SubGRBTargeted'])]
+    raven.raven_pipelines([[{'graceid': 'E2'}], []], 'S1', alert_object,
+                          specs)
+
+    mock_group.return_value.delay.assert_called_once_with()
+    (signatures,), _ = mock_group.call_args
+    assert list(signatures) == [
+        raven.raven_pipeline.si(
+            [{'graceid': 'E2'}], 'S1', alert_object, -1, 5, 'CBC'),
+        raven.raven_pipeline.si([], 'S1', alert_object, -1, 11, 'CBC')]
+
+
+@patch('ligo.raven.gracedb_events.SE')
+@patch('ligo.raven.search.search')
+def test_search_many(mock_raven_search, mock_se_cls, monkeypatch):
+    """Test that a fused search queries GraceDB only once for the union of
+    the time windows.
+    """
+    client = Mock()
+    client.events.return_value = [{'graceid': 'E1', 'gpstime': 100.5},
+                                  {'graceid': 'E2', 'gpstime': 110.0},
+                                  {'graceid': 'E3', 'gpstime': 115.0}]
+    monkeypatch.setattr(gracedb, 'client', client)
+    mock_se_cls.return_value.gpstime = 100.0
+
+    def search(event, tl, th, gracedb, group, pipelines, searches):
+        return gracedb.events('External {} .. {}'.format(
+            event.gpstime + tl, event.gpstime + th))
+
+    mock_raven_search.side_effect = search
+    specs = [('CBC', [], ['GRB']),
+             ('CBC', ['Fermi'], ['SubGRB', 'SubGRBTargeted']),
+             ('CBC', ['Swift'], ['SubGRB', 'SubGRBTargeted'])]
+    results = raven.search_many('S1', {'superevent_id': 'S1'}, specs)
+
+    assert [[event['graceid'] for event in result]
+            for result in results] == [['E1'], ['E1', 'E2'],
+                                       ['E1', 'E2', 'E3']]
+    client.events.assert_called_once_with('External 90.0 .. 120.0')
+    assert mock_raven_search.call_args_list[1][1]['pipelines'] == ['Fermi']
 
 
 @pytest.mark.parametrize('group', ['CBC', 'Burst'])
-@patch('ligo.raven.search.calc_signif_gracedb')
+@patch('gwcelery.tasks.gracedb.upload.run')
+@patch('ligo.raven.search.coinc_far',
+       return_value={'temporal_coinc_far': 1e-6,
+                     'spatiotemporal_coinc_far': None})
 def test_calculate_coincidence_far(
-        mock_calc_signif, group):
+        mock_coinc_far, mock_upload, group):
     se = {'superevent_id': 'S1234'}
     ext = {'graceid': 'E4321',
            'pipeline': 'Fermi',
@@ -76,15 +199,24 @@ def test_calculate_coincidence_far(
         tl, th = -5, 1
     else:
         tl, th = -600, 60
-    raven.calculate_coincidence_far(se, ext, tl, th)
-    mock_calc_signif.assert_called_once_with(
+    result = raven.calculate_coincidence_far(se, ext, tl, th)
+    mock_coinc_far.assert_called_once_with(
         'S1234', 'E4321', tl, th,
         incl_sky=False, grb_search='GRB',
         gracedb=gracedb.client, far_grb=None)
-
-
-@patch('ligo.raven.search.calc_signif_gracedb')
-def test_calculate_coincidence_far_subgrb(mock_calc_signif):
+    assert result == mock_coinc_far.return_value
+    assert mock_upload.call_count == 2
+    for args, graceid in zip(mock_upload.call_args_list,
+                             ['S1234', 'E4321']):
+        assert json.loads(args[0][0]) == result
+        assert args[0][1:3] == ('coincidence_far.json', graceid)
+
+
+@patch('gwcelery.tasks.gracedb.upload.run')
+@patch('ligo.raven.search.coinc_far',
+       return_value={'temporal_coinc_far': 1e-6,
+                     'spatiotemporal_coinc_far': None})
+def test_calculate_coincidence_far_subgrb(mock_coinc_far, mock_upload):
     se = {'superevent_id': 'S1234'}
     ext = {'graceid': 'E4321',
            'pipeline': 'Fermi',
@@ -93,35 +225,127 @@ def test_calculate_coincidence_far_subgrb(mock_calc_signif):
            'far': 1e5}
     tl, th = -1, 10
     raven.calculate_coincidence_far(se, ext, tl, th)
-    mock_calc_signif.assert_called_once_with(
+    mock_coinc_far.assert_called_once_with(
         'S1234', 'E4321', tl, th,
         incl_sky=False, grb_search='GRB',
         gracedb=gracedb.client, far_grb=1e5)
 
 
-@pytest.mark.parametrize('group', ['CBC', 'Burst'])  # noqa: F811
-@patch('gwcelery.tasks.external_skymaps.get_skymap_filename',
-       return_value='fermi_skymap.fits.gz')
-@patch('ligo.raven.search.calc_signif_gracedb')
+@patch('gwcelery.tasks.gracedb.upload.run')
+@patch('ligo.raven.search.coinc_far', return_value='RAVEN: WARNING')
+def test_calculate_coincidence_far_message(mock_coinc_far, mock_upload):
+    """Test that a message from ligo.raven is written to the log of the
+    superevent instead of the coincidence FARs.
+    """
+    se = {'superevent_id': 'S1234'}
+    ext = {'graceid': 'E4321',
+           'pipeline': 'Fermi',
+           'search': 'GRB',
+           'labels': ['EXT_SKYMAP_READY', 'SKYMAP_READY'],
+           'far': None}
+    result = raven.calculate_coincidence_far(se, ext, -5, 1)
+    assert result == 'RAVEN: WARNING'
+    mock_upload.assert_called_once_with(
+        None, None, 'S1234', 'RAVEN: WARNING', tags=['ext_coinc'])
+
+
+@pytest.mark.parametrize('overlap', [2.0, 0.0, 'RAVEN: ERROR'])
+@patch('gwcelery.tasks.gracedb.upload.run')
+@patch('gwcelery.tasks.raven.skymap_overlap.run')
+@patch('gwcelery.tasks.external_skymaps.get_skymap_filename.run')
+@patch('ligo.raven.search.coinc_far',
+       return_value={'temporal_coinc_far': 1e-6,
+                     'spatiotemporal_coinc_far': None})
 def test_calculate_spacetime_coincidence_far(
-        mock_calc_signif, mock_get_skymap_filename, group):
+        mock_coinc_far, mock_get_skymap_filename, mock_skymap_overlap,
+        mock_upload, overlap):
+    mock_get_skymap_filename.side_effect = lambda graceid, versioned: \
+        {'S1234': 'bayestar.fits.gz,0',
+         'E4321': 'fermi_skymap.fits.gz,1'}[graceid]
+    mock_skymap_overlap.return_value = overlap
     se = {'superevent_id': 'S1234'}
     ext = {'graceid': 'E4321',
            'pipeline': 'Fermi',
            'search': 'GRB',
            'labels': ['EXT_SKYMAP_READY', 'SKYMAP_READY'],
            'far': None}
-    if group == 'CBC':
-        tl, th = -5, 1
-    else:
-        tl, th = -600, 60
-    raven.calculate_coincidence_far(se, ext, tl, th)
-    mock_calc_signif.assert_called_once_with(
-        'S1234', 'E4321', tl, th,
-        incl_sky=True, grb_search='GRB',
-        se_fitsfile='fermi_skymap.fits.gz',
-        ext_fitsfile='fermi_skymap.fits.gz',
+    result = raven.calculate_coincidence_far(se, ext, -5, 1)
+
+    mock_coinc_far.assert_called_once_with(
+        'S1234', 'E4321', -5, 1, grb_search='GRB', incl_sky=False,
         gracedb=gracedb.client, far_grb=None)
+    mock_skymap_overlap.assert_called_once_with(
+        'S1234', 'bayestar.fits.gz,0', 'E4321', 'fermi_skymap.fits.gz,1')
+    if isinstance(overlap, str):
+        assert result == overlap
+        mock_upload.assert_called_once_with(
+            None, None, 'S1234', overlap, tags=['ext_coinc'])
+    else:
+        assert result == {'temporal_coinc_far': 1e-6,
+                          'spatiotemporal_coinc_far':
+                          5e-7 if overlap else float('inf'),
+                          'skymap_overlap': overlap}
+        assert mock_upload.call_count == 2
+        for args, graceid in zip(mock_upload.call_args_list,
+                                 ['S1234', 'E4321']):
+            assert json.loads(args[0][0]) == result
+            assert args[0][1:3] == ('coincidence_far.json', graceid)
+
+
+def _nested_fits_filecontents(prob):
+    bytesio = io.BytesIO()
+    table = Table([prob], names=['PROB'])
+    table.meta['ORDERING'] = 'NESTED'
+    table.write(bytesio, format='fits')
+    return bytesio.getvalue()
+
+
+def test_skymap_overlap(monkeypatch, fake_redis):
+    """Test that the sky map overlap integral matches that of ligo-raven, and
+    that it is not computed again if neither sky map has changed.
+    """
+    monkeypatch.setitem(app.conf, 'raven_skymap_overlap_cache_ttl', 60)
+    monkeypatch.setattr(raven, '_skymaps', {})
+    rng = np.random.default_rng(0)
+    se_skymap = rng.uniform(size=hp.nside2npix(4))
+    ext_skymap = rng.uniform(size=hp.nside2npix(2))
+    files = {('S1', 'bayestar.fits.gz,0'):
+             _nested_fits_filecontents(se_skymap),
+             ('E1', 'glg_healpix_all_bn_v00.fit,0'):
+             _nested_fits_filecontents(ext_skymap)}
+    mock_download = Mock(side_effect=lambda filename, graceid:
+                         files[(graceid, filename)])
+    monkeypatch.setattr('gwcelery.tasks.gracedb.download.run',
+                        mock_download)
+
+    # Same calculation as ligo.raven.search.skymap_overlap_integral at the
+    # original resolutions
+    se_ring = hp.reorder(se_skymap, n2r=True)
+    ext_ring = hp.ud_grade(hp.reorder(ext_skymap, n2r=True), nside_out=4)
+    expected = (np.dot(se_ring, ext_ring) / se_ring.sum() / ext_ring.sum()
+                * len(se_ring))
+
+    args = ('S1', 'bayestar.fits.gz,0', 'E1', 'glg_healpix_all_bn_v00.fit,0')
+    assert raven.skymap_overlap(*args) == pytest.approx(expected)
+    assert mock_download.call_count == 2
+
+    # Only the sky maps at the matched resolution are kept in memory.
+    assert {key: (nside, set(degraded)) for key, (nside, degraded)
+            in raven._skymaps.items()} == {
+        ('S1', 'bayestar.fits.gz,0'): (4, {2}),
+        ('E1', 'glg_healpix_all_bn_v00.fit,0'): (2, {2})}
+
+    monkeypatch.setattr(raven, '_skymaps', {})
+    assert raven.skymap_overlap(*args) == pytest.approx(expected)
+    assert mock_download.call_count == 2
+
+    # The sky maps in memory are limited by their total size.
+    monkeypatch.setitem(app.conf, 'raven_skymap_overlap_cache_ttl', 0)
+    monkeypatch.setattr(raven, '_SKYMAPS_MAXBYTES', ext_skymap.nbytes)
+    monkeypatch.setattr(raven, '_skymaps', {})
+    assert raven.skymap_overlap(*args) == pytest.approx(expected)
+    assert mock_download.call_count == 4
+    assert list(raven._skymaps) == [('E1', 'glg_healpix_all_bn_v00.fit,0')]
 
 
 def mock_get_labels(superevent_id):
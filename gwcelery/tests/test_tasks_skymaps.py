@@ -6,10 +6,17 @@ import os
 from unittest.mock import patch
 
 from astropy.table import Table
+from astropy import units as u
+from ligo.skymap.bayestar import rasterize
+from ligo.skymap.io import write_sky_map
+from ligo.skymap.tool import ligo_skymap_plot
+from matplotlib import pyplot as plt
 import numpy as np
 import pytest
 
 from ..tasks import skymaps
+from ..util.matplotlib import closing_figures
+from ..util.tempfile import NamedTemporaryFile
 from . import data
 
 
@@ -62,13 +69,33 @@ def mock_download(filename, graceid):
 
 
 @patch('gwcelery.tasks.gracedb.download.run', mock_download)
-@patch('ligo.skymap.tool.ligo_skymap_plot.main')
+@patch('gwcelery.tasks.skymaps.plot_allsky.run')
 @patch('ligo.skymap.tool.ligo_skymap_plot_volume.main')
 def test_annotate_fits(mock_plot_volume, mock_plot, toy_3d_fits_filecontents):
     skymaps.annotate_fits(
         toy_3d_fits_filecontents, 'test.fits,0', 'T12345', ['tag1'])
 
 
+@pytest.mark.parametrize('is_3d', [False, True])
+@patch('gwcelery.tasks.gracedb.upload.run')
+@patch('gwcelery.tasks.skymaps.plot_volume.run')
+@patch('gwcelery.tasks.skymaps.plot_allsky.run')
+def test_annotate_fits_decides_3d_from_header(
+        mock_plot_allsky, mock_plot_volume, mock_upload, is_3d,
+        toy_fits_filecontents, toy_3d_fits_filecontents):
+    filecontents = toy_3d_fits_filecontents if is_3d \
+        else toy_fits_filecontents
+    skymaps.annotate_fits(filecontents, 'test.fits,0', 'T12345', ['tag1'])
+
+    mock_plot_allsky.assert_called_once_with(filecontents)
+    assert mock_plot_volume.called == is_3d
+    html = skymaps.fits_header(filecontents, 'test.fits,0')
+    mock_upload.assert_any_call(
+        html, 'test.html', 'T12345',
+        'FITS headers for <a href="/api/superevents/T12345/files/'
+        'test.fits,0">test.fits,0</a>', ['tag1'])
+
+
 def test_fits_header(toy_fits_filecontents):
     # Run function under test
     html = skymaps.fits_header(toy_fits_filecontents, 'test.fits')
@@ -77,28 +104,69 @@ def test_fits_header(toy_fits_filecontents):
     assert html == resources.read_text(data, 'fits_header_result.html')
 
 
-@patch('ligo.skymap.tool.ligo_skymap_plot.main')
-def test_plot_allsky(mock_plot):
-    # Run function under test
-    skymaps.plot_allsky('')
-
-    # Check that the script would have been run once
-    # with the correct arguments
-    mock_plot.assert_called_once()
-    cmdline, = mock_plot.call_args[0]
-    assert cmdline[2].endswith('.png')
-
-
-@patch('ligo.skymap.tool.ligo_skymap_plot.main')
-def test_plot_allsky_swift(mock_plot):
-    # Run function under test
-    skymaps.plot_allsky('', ra=0, dec=0)
-
-    # Check that the script would have been run once
-    # with the correct arguments
-    mock_plot.assert_called_once()
-    cmdline, = mock_plot.call_args[0]
-    assert cmdline[2].endswith('.png')
+def test_plot_allsky(toy_3d_fits_filecontents):
+    png = skymaps.plot_allsky(toy_3d_fits_filecontents)
+    assert png.startswith(b'\x89PNG')
+
+
+def test_plot_allsky_swift(toy_3d_fits_filecontents):
+    png = skymaps.plot_allsky(toy_3d_fits_filecontents, ra=0, dec=0)
+    assert png.startswith(b'\x89PNG')
+
+
+@pytest.mark.parametrize('kwargs,args', [
+    [{}, ['--contour', '50', '90']],
+    [{'ra': 0, 'dec': 0}, ['--radec', '0', '0']]])
+def test_plot_allsky_matches_tool(toy_3d_fits_filecontents, kwargs, args):
+    """Test that plot_allsky draws the same image as ligo-skymap-plot, both
+    on a new figure and on one that is reused from the pool.
+    """
+    with NamedTemporaryFile(mode='rb', suffix='.png') as pngfile, \
+            NamedTemporaryFile(
+                content=toy_3d_fits_filecontents) as fitsfile, \
+            closing_figures(), plt.rc_context():
+        ligo_skymap_plot.main([fitsfile.name, '-o', pngfile.name,
+                               '--annotate', *args])
+        expected = plt.imread(pngfile)
+
+    for _ in range(2):
+        png = skymaps.plot_allsky(toy_3d_fits_filecontents, **kwargs)
+        np.testing.assert_array_equal(
+            plt.imread(io.BytesIO(png)), expected)
+
+
+def test_rasterize_moc():
+    # Order 0 everywhere except for pixel 3, which is split into order 1.
+    uniq = np.asarray([31, 30, 29, 28, *range(15, 7, -1), 6, 5, 4])
+    table = Table({'UNIQ': uniq,
+                   'PROBDENSITY': np.linspace(0.1, 1, len(uniq)),
+                   'DISTMU': np.arange(len(uniq), dtype=float),
+                   'DISTSIGMA': np.ones(len(uniq)),
+                   'DISTNORM': np.ones(len(uniq))})
+    table['DISTMU'].unit = u.Mpc
+    expected = rasterize(table)
+
+    result = skymaps.rasterize_moc(table)
+    assert result.colnames == expected.colnames
+    for name in result.colnames:
+        np.testing.assert_allclose(result[name], expected[name])
+        assert result[name].unit == expected[name].unit
+
+
+@pytest.mark.parametrize('filename', ['test.fits', 'test.fits.gz'])
+def test_flatten(filename):
+    table = Table({'UNIQ': np.arange(4, 16, dtype=np.int64),
+                   'PROBDENSITY': np.ones(12)})
+    with io.BytesIO() as f:
+        write_sky_map(f, table, moc=True)
+        filecontents = f.getvalue()
+
+    flat = skymaps.flatten(filecontents, filename)
+
+    assert flat.startswith(b'\x1f\x8b') == filename.endswith('.gz')
+    with skymaps.open_fits(flat) as hdus:
+        assert hdus[1].header['ORDERING'] == 'NESTED'
+        assert hdus[1].header['NSIDE'] == 1
 
 
 def test_is_3d_fits_file(toy_fits_filecontents, toy_3d_fits_filecontents):
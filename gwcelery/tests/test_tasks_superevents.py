@@ -5,6 +5,7 @@ from unittest.mock import call, patch, Mock
 from requests.exceptions import HTTPError
 from requests.models import Response
 
+from .. import app
 from ..tasks import gracedb, superevents
 from ..util import read_json
 from . import data
@@ -320,6 +321,34 @@ def test_update_preferred_event(superevent_labels, new_event_labels,
                     create_label.assert_not_called()
 
 
+def test_update_superevent_caches_preferred_event_key():
+    """The preferred event should be fetched from GraceDB only once while
+    several less significant events are added to the superevent.
+    """
+    preferred_event_dictionary = read_json(data, 'T0212_S0039_preferred.json')
+    superevent = superevents._SuperEvent(
+        1163905214.44, 1163905239.44, 1163905224.44, 'S0039',
+        preferred_event='T0212',
+        event_dict={'labels': [], 'superevent_id': 'S0039',
+                    'preferred_event': 'T0212'})
+    new_event_dictionary = dict(preferred_event_dictionary,
+                                graceid='T1234', far=1.0, labels=[])
+
+    with patch('gwcelery.tasks.gracedb.update_superevent') as p, \
+            patch('gwcelery.tasks.gracedb.get_event',
+                  return_value=preferred_event_dictionary) as get_event:
+        for _ in range(3):
+            superevents._update_superevent(
+                superevent, new_event_dictionary, None, None, None)
+        get_event.assert_called_once_with('T0212')
+        p.assert_not_called()
+
+    superevents._update_preferred_event_key(
+        dict(preferred_event_dictionary, labels=['INJ']))
+    assert superevents._preferred_event_keys['T0212'] == superevents.keyfunc(
+        dict(preferred_event_dictionary, labels=['INJ']))
+
+
 @pytest.mark.parametrize('labels',
                          [['PASTRO_READY', 'RAVEN_ALERT'],
                           ['SKYMAP_READY', 'EMBRIGHT_READY',
@@ -861,6 +890,143 @@ def test_S190421ar_spiir_scenario(mock_db):    # noqa: N802
         p2.assert_not_called()
 
 
+def test_superevent_index(monkeypatch):
+    index = superevents._SuperEventIndex()
+    assert index.lookup('production', 0.0, 200.0) is None
+
+    index.replace('production', 0.0, 200.0, _mock_superevents())
+    result = index.lookup('production', 50.0, 150.0)
+    assert [s['superevent_id'] for s in result] == ['S123456']
+    assert index.lookup('production', 101.0, 200.0) == []
+    assert index.lookup('production', 0.0, 300.0) is None
+    assert index.lookup('mdc', 50.0, 150.0) is None
+
+    index.update_fields('S123456', t_0=150.0, t_end=None)
+    index.add_event('S123456', 'G000003')
+    index.add_label('S123456', superevents.FROZEN_LABEL)
+    superevent = index.get('S123456')
+    assert superevent['t_0'] == 150.0
+    assert superevent['t_end'] == 101.0
+    assert superevent['gw_events'] == ['G000002', 'G000003']
+    assert superevent['labels'] == [superevents.FROZEN_LABEL]
+    assert index.lookup('production', 50.0, 149.0) == []
+
+    monkeypatch.setitem(app.conf, 'superevent_index_max_age', -1)
+    assert index.get('S123456') is None
+    assert index.lookup('production', 50.0, 150.0) is None
+
+
+@patch('gwcelery.tasks.gracedb.get_event', _mock_event)
+def test_process_uses_superevent_index(fake_redis):
+    """Two events in the same window should require only one GraceDB query
+    for superevents.
+    """
+    payload = dict(lvalert_content, alert_type='new', uid='G000002',
+                   object=_mock_event('G000002'))
+    with patch('gwcelery.tasks.gracedb.get_superevents',
+               return_value=[]) as get_superevents, \
+            patch('gwcelery.tasks.gracedb.create_superevent',
+                  return_value='S123456') as create_superevent, \
+            patch('gwcelery.tasks.gracedb.add_event_to_superevent') as add, \
+            patch('gwcelery.tasks.gracedb.create_label'):
+        superevents.process(payload)
+        create_superevent.assert_called_once()
+        get_superevents.assert_called_once()
+
+        payload['object'] = dict(payload['object'], graceid='G000003',
+                                 far=1e-30)
+        superevents.process(payload)
+        get_superevents.assert_called_once()
+        add.assert_called_once_with('S123456', 'G000003')
+
+
+def test_handle_superevent(fake_redis):
+    """Test that LVAlert messages for superevents are applied to the index,
+    except for stale ones.
+    """
+    superevents._index.replace('production', 0.0, 200.0, _mock_superevents())
+    alert = {'uid': 'S123456', 'alert_type': 'update',
+             'object': _mock_superevents()[0]}
+    superevents.handle_superevent(
+        {'uid': 'S123456', 'alert_type': 'log', 'data': {}})
+    superevents.handle_superevent(
+        {'uid': 'S123456', 'alert_type': 'label_added',
+         'data': {'name': 'DQV'}})
+    superevents.handle_superevent(alert)
+    superevents._apply_superevent_alerts()
+    assert superevents._index.get('S123456')['labels'] == ['DQV']
+    assert superevents._index.lookup('production', 50.0, 150.0) is not None
+
+    # The worker changes the superevent, and then receives a message that
+    # was sent before the change.
+    superevents._index.update_fields('S123456', t_0=100.5)
+    superevents.handle_superevent(alert)
+    superevents._apply_superevent_alerts()
+    assert superevents._index.get('S123456') is None
+    assert superevents._index.lookup('production', 50.0, 150.0) is None
+
+
+def _cluster_payload(graceid, gpstime, snr, category='production'):
+    event = dict(_mock_event('G000002'), graceid=graceid, gpstime=gpstime,
+                 extra_attributes=dict(
+                     CoincInspiral=dict(snr=snr),
+                     SingleInspiral=[{'ifo': ifo} for ifo in ['H1', 'L1']]))
+    if category == 'mdc':
+        event['search'] = 'MDC'
+    return dict(lvalert_content, alert_type='new', uid=graceid, object=event)
+
+
+def test_cluster_payloads():
+    payloads = [_cluster_payload('G1', 100.0, 10.0),
+                _cluster_payload('G2', 150.0, 10.0),
+                _cluster_payload('G3', 101.5, 10.0),
+                _cluster_payload('G4', 100.5, 10.0, category='mdc'),
+                _cluster_payload('G5', 103.0, 10.0)]
+    clusters = superevents._cluster_payloads(payloads)
+    assert [[p['uid'] for p in cluster] for cluster in clusters] == [
+        ['G4'], ['G1', 'G3', 'G5'], ['G2']]
+
+
+@patch('gwcelery.tasks.gracedb.create_label')
+@patch('gwcelery.tasks.gracedb.add_event_to_superevent')
+@patch('gwcelery.tasks.gracedb.create_superevent', return_value='S1')
+@patch('gwcelery.tasks.gracedb.get_superevents', return_value=[])
+def test_process_cluster_new_superevent(get_superevents, create_superevent,
+                                        add_event_to_superevent,
+                                        create_label):
+    payloads = [_cluster_payload('G1', 1000.0, 10.0),
+                _cluster_payload('G2', 1000.5, 20.0),
+                _cluster_payload('G3', 1001.0, 15.0)]
+    superevents.process_cluster(payloads)
+    get_superevents.assert_called_once()
+    create_superevent.assert_called_once_with('G2', 1000.5, 999.0, 1002.0)
+    assert add_event_to_superevent.call_args_list == [
+        call('S1', 'G1'), call('S1', 'G3')]
+    create_label.delay.assert_called_once_with('ADVREQ', 'S1')
+
+
+@patch('gwcelery.tasks.gracedb.get_event', _mock_event)
+@patch('gwcelery.tasks.gracedb.create_label')
+@patch('gwcelery.tasks.gracedb.update_superevent')
+@patch('gwcelery.tasks.gracedb.add_event_to_superevent')
+@patch('gwcelery.tasks.gracedb.create_superevent')
+@patch('gwcelery.tasks.gracedb.get_superevents', _mock_superevents)
+def test_process_cluster_existing_superevent(create_superevent,
+                                             add_event_to_superevent,
+                                             update_superevent,
+                                             create_label):
+    payloads = [_cluster_payload('G000002', 100.0, 20.0),
+                _cluster_payload('G1', 100.5, 10.0),
+                _cluster_payload('G2', 101.5, 30.0)]
+    superevents.process_cluster(payloads)
+    create_superevent.assert_not_called()
+    assert add_event_to_superevent.call_args_list == [
+        call('S123456', 'G1'), call('S123456', 'G2')]
+    update_superevent.assert_called_once_with(
+        'S123456', t_start=99.0, t_end=102.5, t_0=101.5,
+        preferred_event='G2')
+
+
 def test_inj_means_should_not_publish():
     event_dictionary = {'graceid': 'G1234',
                         'gpstime': 1239917954.40918,
@@ -1,8 +1,16 @@
+import functools
+import io
+import os
+import pickle
+import socket
 import sys
 
 import pytest
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
-from .. import util
+from .. import app, util
 
 
 def test_handling_exit_0():
@@ -14,3 +22,122 @@ def test_handling_exit_1():
     with pytest.raises(RuntimeError):
         with util.handling_system_exit():
             sys.exit(1)
+
+
+class CertReloadingHTTPSConnectionPool(HTTPSConnectionPool):
+
+    def __init__(self, *args, reload_buffer=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reload_buffer = reload_buffer
+
+
+class CertReloadingHTTPAdapter(HTTPAdapter):
+    """Stand-in for the certificate-reloading adapters that GraceDB clients
+    mount, which bind extra arguments to their pool classes.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': HTTPConnectionPool,
+            'https': functools.partial(CertReloadingHTTPSConnectionPool,
+                                       reload_buffer=300)}
+
+
+def test_pooled_http_adapter(tmp_path):
+    adapter = util.PooledHTTPAdapter(pool_maxsize=2)
+    pool = adapter.poolmanager.connection_from_url('https://gracedb.invalid/')
+    assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in \
+        pool.conn_kw['socket_options']
+    assert adapter.stats == {'requests': 0, 'connections': 0, 'pool_hits': 0}
+
+    # Renewing the client certificate drops pooled connections.
+    cert = tmp_path / 'cert.pem'
+    cert.write_text('old')
+    adapter._check_cert(str(cert))
+    assert adapter.poolmanager.connection_from_url(
+        'https://gracedb.invalid/') is pool
+    os.utime(cert, (0, 0))
+    adapter._check_cert((str(cert), 'key.pem'))
+    assert adapter.poolmanager.connection_from_url(
+        'https://gracedb.invalid/') is not pool
+
+
+def test_pooled_http_adapter_compose():
+    """Test that the shared adapter keeps the certificate reloading behavior
+    of the adapters of the clients that it is mounted on.
+    """
+    adapter = util.PooledHTTPAdapter(pool_maxsize=2)
+    session = requests.Session()
+    session.mount('https://', CertReloadingHTTPAdapter())
+    adapter.compose(session.get_adapter('https://gracedb.invalid/'))
+    session.mount('https://gracedb.invalid/', adapter)
+    # Composing again, for a second client, has no effect.
+    adapter.compose(HTTPAdapter())
+
+    pool = session.get_adapter(
+        'https://gracedb.invalid/api/').poolmanager.connection_from_url(
+        'https://gracedb.invalid/')
+    assert isinstance(pool, CertReloadingHTTPSConnectionPool)
+    assert pool.reload_buffer == 300
+    assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in \
+        pool.conn_kw['socket_options']
+
+    # The composed pool classes survive pickling.
+    pool = pickle.loads(pickle.dumps(adapter)).poolmanager.connection_from_url(
+        'https://gracedb.invalid/')
+    assert isinstance(pool, CertReloadingHTTPSConnectionPool)
+
+
+def test_figure_pool():
+    pool = util.FigurePool(lambda fig: fig.add_subplot(), figsize=(2, 2))
+    with pool.figure() as fig:
+        ax, = fig.axes
+        ax.plot([1, 2, 30])
+        ax.clabel(ax.contour([[0, 1], [1, 2]]))
+        fig.savefig(io.BytesIO(), format='png')
+
+    # The same figure is reused, without the artists from the last plot.
+    with pool.figure() as fig2:
+        assert fig2 is fig
+        assert not ax.lines
+        assert not ax.collections
+        assert not ax.texts
+        assert ax.get_ylim() == (0, 1)
+
+
+def test_cached_plot(monkeypatch, fake_redis):
+    monkeypatch.setitem(app.conf, 'plot_cache_ttl', 60)
+    calls = []
+
+    @util.cached_plot
+    def plot(filecontents, ra=None):
+        calls.append((filecontents, ra))
+        return b'png'
+
+    assert plot(b'fits', ra=1) == b'png'
+    assert plot(b'fits', ra=1) == b'png'
+    assert calls == [(b'fits', 1)]
+    plot(b'other fits', ra=1)
+    assert len(calls) == 2
+
+
+def test_frame_index(tmp_path):
+    def touch(start, duration=4):
+        path = tmp_path / 'H-H1_llhoft-{}-{}.gwf'.format(start, duration)
+        path.touch()
+        return str(path)
+
+    paths = [touch(start) for start in range(1000, 1040, 4)]
+    (tmp_path / 'README').touch()
+    index = util.FrameIndex(str(tmp_path / '*.gwf'))
+    assert index.start_time() == 1000
+    assert index.find(1005, 1010) == paths[1:3]
+    assert index.find(1004, 1008) == paths[1:2]
+    assert index.find(2000, 2001) == []
+
+    # New and expired frames are picked up.
+    new_path = touch(1040)
+    os.unlink(paths[0])
+    assert index.start_time() == 1004
+    assert index.find(1032, 1050) == [paths[-2], paths[-1], new_path]
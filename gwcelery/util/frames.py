@@ -0,0 +1,202 @@
+"""Index of the frame files in a directory."""
+import bisect
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import struct
+import threading
+
+__all__ = ('FrameIndex',)
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+
+_IN_ADDED = _IN_CLOSE_WRITE | _IN_MOVED_TO
+_IN_REMOVED = _IN_DELETE | _IN_MOVED_FROM
+_IN_GONE = _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_IGNORED
+
+_inotify_event = struct.Struct('iIII')
+
+
+class _Inotify:
+    """Minimal non-blocking wrapper for the Linux inotify API."""
+
+    _libc = None
+
+    def __init__(self, path):
+        if _Inotify._libc is None:
+            _Inotify._libc = ctypes.CDLL(
+                ctypes.util.find_library('c'), use_errno=True)
+        libc = _Inotify._libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = _IN_ADDED | _IN_REMOVED | _IN_DELETE_SELF | _IN_MOVE_SELF
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed', path)
+
+    def read(self):
+        """Return a list of ``(mask, name)`` tuples for all pending events."""
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(buf):
+                _, mask, _, length = _inotify_event.unpack_from(buf, offset)
+                offset += _inotify_event.size
+                name = buf[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _parse_filename(name):
+    """Get the GPS start and end times from a frame file name that follows the
+    ``{obs}-{tag}-{start}-{duration}.gwf`` convention of LIGO-T050017.
+    """
+    _, start, duration = os.path.splitext(name)[0].rsplit('-', 2)
+    start = int(start)
+    return start, start + int(duration)
+
+
+class FrameIndex:
+    """Index of the frame files in a directory, sorted by GPS start time.
+
+    Listing a directory of low-latency frames and parsing the name of every
+    file costs time in proportion to the number of files, which can be in the
+    thousands. This index lists the directory only once. After that, it is
+    updated incrementally from :manpage:`inotify(7)` events as frames arrive
+    and expire, and looking up the frames for a time interval takes
+    logarithmic time.
+
+    If inotify is not available (for example, if the directory does not exist
+    yet), then the index falls back to listing the directory again whenever
+    its modification time changes.
+
+    This class is thread-safe.
+
+    Parameters
+    ----------
+    pattern : str
+        A glob pattern for the frame files. Only the file name, and not the
+        directory, may contain wildcards.
+
+    """
+
+    def __init__(self, pattern):
+        self.directory, self.pattern = os.path.split(pattern)
+        self._lock = threading.Lock()
+        self._inotify = None
+        self._mtime = None
+        self._names = {}
+        self._starts = []
+        self._entries = []
+        self._max_duration = 0
+
+    def _add(self, name):
+        if name in self._names or not fnmatch.fnmatch(name, self.pattern):
+            return
+        try:
+            start, end = _parse_filename(name)
+        except ValueError:
+            return
+        self._names[name] = start
+        i = bisect.bisect_right(self._starts, start)
+        self._starts.insert(i, start)
+        self._entries.insert(i, (start, end, name))
+        self._max_duration = max(self._max_duration, end - start)
+
+    def _remove(self, name):
+        start = self._names.pop(name, None)
+        if start is None:
+            return
+        i = bisect.bisect_left(self._starts, start)
+        while self._entries[i][2] != name:
+            i += 1
+        del self._starts[i]
+        del self._entries[i]
+
+    def _rescan(self):
+        try:
+            with os.scandir(self.directory) as entries:
+                names = {entry.name for entry in entries}
+        except FileNotFoundError:
+            names = set()
+        for name in set(self._names) - names:
+            self._remove(name)
+        for name in names:
+            self._add(name)
+
+    def _refresh(self):
+        if self._inotify is not None:
+            for mask, name in self._inotify.read():
+                if mask & _IN_Q_OVERFLOW:
+                    self._rescan()
+                elif mask & _IN_GONE:
+                    self._inotify.close()
+                    self._inotify = None
+                    break
+                elif mask & _IN_ADDED:
+                    self._add(name)
+                elif mask & _IN_REMOVED:
+                    self._remove(name)
+            else:
+                return
+
+        try:
+            # Start watching before listing the directory so that no events
+            # are missed in between.
+            self._inotify = _Inotify(self.directory)
+        except (AttributeError, OSError):
+            try:
+                mtime = os.stat(self.directory).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime is not None and mtime == self._mtime:
+                return
+            self._mtime = mtime
+        self._rescan()
+
+    def start_time(self):
+        """Get the GPS start time of the earliest frame, or None if there are
+        no frames.
+        """
+        with self._lock:
+            self._refresh()
+            return self._starts[0] if self._starts else None
+
+    def find(self, start, end):
+        """Find the frames that overlap a time interval.
+
+        Parameters
+        ----------
+        start, end : int or float
+            GPS start and end times.
+
+        Returns
+        -------
+        list
+            The paths of the frame files, sorted by GPS start time.
+
+        """
+        with self._lock:
+            self._refresh()
+            lo = bisect.bisect_right(self._starts, start - self._max_duration)
+            hi = bisect.bisect_left(self._starts, end)
+            return [os.path.join(self.directory, name)
+                    for frame_start, frame_end, name in self._entries[lo:hi]
+                    if frame_end > start]
@@ -0,0 +1,82 @@
+"""Loading selected parts of LIGO-LW XML documents."""
+import io
+
+from ligo.lw.ligolw import (
+    FilteringLIGOLWContentHandler, LIGO_LW, PartialLIGOLWContentHandler)
+from ligo.lw.table import Table
+from ligo.lw.utils import load_fileobj
+from ligo.skymap.io.events.ligolw import ContentHandler
+
+__all__ = ('BAYESTAR_TABLES', 'load_ligolw')
+
+BAYESTAR_TABLES = frozenset({
+    'coinc_definer', 'coinc_event', 'coinc_event_map', 'process',
+    'sngl_inspiral', 'time_slide'})
+"""Names of the tables that BAYESTAR reads from a ``coinc.xml`` file if the
+PSDs are supplied separately."""
+
+_SERIES_NAMES = frozenset({'COMPLEX8TimeSeries', 'REAL8FrequencySeries'})
+"""Names of the ``LIGO_LW`` elements that contain SNR time series or PSDs."""
+
+
+class _PartialContentHandler(PartialLIGOLWContentHandler, ContentHandler):
+
+    def __init__(self, document, tables):
+        self.tables = tables
+        super().__init__(document, self._keep)
+
+    def _keep(self, name, attrs):
+        if name == Table.tagName:
+            return Table.TableName(attrs['Name']) in self.tables
+        else:
+            return (name == LIGO_LW.tagName
+                    and attrs.get('Name') in _SERIES_NAMES)
+
+
+class _FilteringContentHandler(FilteringLIGOLWContentHandler, ContentHandler):
+
+    def __init__(self, document, exclude_tables):
+        self.exclude_tables = exclude_tables
+        super().__init__(document, self._keep)
+
+    def _keep(self, name, attrs):
+        return (name != Table.tagName
+                or Table.TableName(attrs['Name']) not in self.exclude_tables)
+
+
+def load_ligolw(filecontents, tables=None, exclude_tables=None):
+    """Parse a LIGO-LW XML document, optionally skipping the parts that are
+    not needed.
+
+    Elements that are skipped are never converted to Python objects, which
+    saves most of the parsing time for large documents.
+
+    Parameters
+    ----------
+    filecontents : bytes
+        The byte contents of the (optionally gzip-compressed) file.
+    tables : set, optional
+        If provided, then load only the tables with these names (such as
+        :obj:`BAYESTAR_TABLES`), as well as any SNR time series and PSDs. The
+        elements are loaded as direct children of the document, so the
+        document is suitable for reading but not for writing.
+    exclude_tables : set, optional
+        If provided, then load everything except for the tables with these
+        names.
+
+    Returns
+    -------
+    xmldoc : :class:`ligo.lw.ligolw.Document`
+        The XML document.
+
+    """
+    if tables is not None:
+        def contenthandler(document):
+            return _PartialContentHandler(document, tables)
+    elif exclude_tables is not None:
+        def contenthandler(document):
+            return _FilteringContentHandler(document, exclude_tables)
+    else:
+        contenthandler = ContentHandler
+    return load_fileobj(io.BytesIO(filecontents),
+                        contenthandler=contenthandler)
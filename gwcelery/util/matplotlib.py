@@ -1,9 +1,14 @@
 """Matplotlib environment management."""
 from contextlib import contextmanager
+import functools
+import hashlib
+import pickle
 
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from matplotlib import pyplot as plt
 
-__all__ = ('closing_figures',)
+__all__ = ('cached_plot', 'closing_figures', 'FigurePool')
 
 
 @contextmanager
@@ -16,3 +21,125 @@ def closing_figures():
         new_fignums = set(plt.get_fignums())
         for fignum in new_fignums - old_fignums:
             plt.close(fignum)
+
+
+class FigurePool:
+    r"""A pool of pre-built Matplotlib figures that are reused between plots.
+
+    Setting up some kinds of axes (for example, all-sky projections with
+    graticules) costs more than drawing the data on them. A figure pool
+    builds each figure once, lends it out for one plot at a time, and
+    afterwards removes everything that was drawn on it so that it can be
+    reused.
+
+    Figures in the pool are not managed by :mod:`matplotlib.pyplot`, so they
+    are not affected by :func:`closing_figures`.
+
+    Parameters
+    ----------
+    setup : callable
+        Function to set up the axes of a new figure. It is called with the
+        :class:`matplotlib.figure.Figure` as its only argument.
+    maxsize : int
+        Maximum number of idle figures to keep.
+    \**kwargs
+        Additional keyword arguments for :class:`matplotlib.figure.Figure`.
+
+    Examples
+    --------
+    >>> pool = FigurePool(lambda fig: fig.add_subplot())
+    >>> with pool.figure() as fig:
+    ...     lines = fig.axes[0].plot([1, 2, 3])
+    ...     fig.savefig('plot.png')
+
+    """
+
+    def __init__(self, setup, maxsize=2, **kwargs):
+        self._setup = setup
+        self._maxsize = maxsize
+        self._kwargs = kwargs
+        self._idle = []
+
+    def _new_figure(self):
+        fig = Figure(**self._kwargs)
+        FigureCanvasAgg(fig)
+        self._setup(fig)
+        # Draw once, so that anything that is created on the first draw is
+        # part of the baseline and is kept.
+        fig.canvas.draw()
+        fig._gwcelery_baseline = {
+            ax: (set(ax.get_children()), ax.get_xlim(), ax.get_ylim())
+            for ax in fig.axes}
+        return fig
+
+    @staticmethod
+    def _reset(fig):
+        """Remove everything that was added to a figure since it was set up.
+
+        Returns
+        -------
+        success : bool
+            False if some artist could not be removed, in which case the
+            figure cannot be reused.
+
+        """
+        baseline = fig._gwcelery_baseline
+        try:
+            for ax in fig.axes:
+                if ax not in baseline:
+                    fig.delaxes(ax)
+                    continue
+                children, xlim, ylim = baseline[ax]
+                for artist in ax.get_children():
+                    # Removing some artists (such as contours) also removes
+                    # others (such as their labels), so check again.
+                    if artist not in children \
+                            and artist in ax.get_children():
+                        artist.remove()
+                ax.set_xlim(xlim)
+                ax.set_ylim(ylim)
+            for artist in [*fig.texts, *fig.legends]:
+                artist.remove()
+        except (NotImplementedError, ValueError):
+            return False
+        return True
+
+    @contextmanager
+    def figure(self):
+        """Borrow a figure from the pool."""
+        try:
+            fig = self._idle.pop()
+        except IndexError:
+            fig = self._new_figure()
+        yield fig
+        if self._reset(fig) and len(self._idle) < self._maxsize:
+            self._idle.append(fig)
+
+
+def cached_plot(f):
+    """Decorator to cache the output of a plotting function, keyed by a hash
+    of its arguments.
+
+    The outputs are kept in Redis for :obj:`~gwcelery.conf.plot_cache_ttl`
+    seconds, so that plotting the same file again (for example, when an
+    unchanged sky map is annotated again) does not redraw it.
+    """
+    prefix = '{}.plot:{}.{}:'.format(__name__, f.__module__, f.__name__)
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        from .. import app
+
+        ttl = app.conf['plot_cache_ttl']
+        if not ttl:
+            return f(*args, **kwargs)
+        redis = app.backend.client
+        key = prefix + hashlib.sha256(
+            pickle.dumps((args, sorted(kwargs.items())))).hexdigest()
+        result = redis.get(key)
+        if result is None:
+            result = f(*args, **kwargs)
+            redis.set(key, result, px=int(ttl * 1000))
+        return result
+
+    return wrapper
@@ -0,0 +1,150 @@
+"""Persistent HTTP connections shared between API clients."""
+import functools
+import os
+import socket
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+__all__ = ('PooledHTTPAdapter',)
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    r"""A :class:`requests.adapters.HTTPAdapter` that keeps a bounded pool of
+    persistent connections to each host and counts how often they are reused.
+
+    A single instance may be mounted on several :class:`requests.Session`
+    objects so that they share one set of connections, and therefore do not
+    have to repeat the TCP and TLS handshakes for every request.
+
+    Parameters
+    ----------
+    pool_maxsize : int
+        Maximum number of connections to keep open to each host.
+    pool_block : bool
+        If True, then a request waits for a connection to become free if
+        `pool_maxsize` requests to the same host are already in progress. This
+        limits the number of concurrent requests to each host.
+    keepalive_idle : int
+        Send TCP keep-alive probes once a connection has been idle for this
+        many seconds, so that idle connections are not dropped by firewalls.
+    \*\*kwargs
+        Additional keyword arguments for
+        :class:`requests.adapters.HTTPAdapter`.
+
+    Notes
+    -----
+    If the client certificate file changes (for example, because it has been
+    renewed), then all pooled connections are closed so that new connections
+    present the new certificate.
+
+    API clients such as :mod:`gracedb_sdk` and :mod:`ligo.gracedb.rest` mount
+    their own adapters, with connection pool classes that reconnect when the
+    certificate is about to expire. Call :meth:`compose` with such an adapter
+    before mounting this one in its place to keep that behavior.
+
+    """
+
+    __attrs__ = [*HTTPAdapter.__attrs__,
+                 '_socket_options', '_pool_classes', '_cert_mtime',
+                 'requests', 'connections']
+
+    def __init__(self, pool_maxsize=10, pool_block=False, keepalive_idle=60,
+                 **kwargs):
+        self._socket_options = [
+            *HTTPConnection.default_socket_options,
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            self._socket_options.append(
+                (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, keepalive_idle))
+        self._pool_classes = None
+        self._cert_mtime = None
+        self.requests = 0
+        self.connections = 0
+        super().__init__(pool_maxsize=pool_maxsize, pool_block=pool_block,
+                         **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault('socket_options', self._socket_options)
+        super().init_poolmanager(*args, **kwargs)
+        self._set_pool_classes()
+
+    def _set_pool_classes(self):
+        pool_classes = self._pool_classes
+        if pool_classes is None:
+            pool_classes = self.poolmanager.pool_classes_by_scheme
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: self._counting_pool_class(pool_class)
+            for scheme, pool_class in pool_classes.items()}
+
+    def compose(self, adapter):
+        """Create connections in the same way as another adapter.
+
+        Use the connection pool classes of `adapter`, such as the
+        certificate-reloading adapter of a GraceDB client, for all new
+        connections. Only the first call has any effect, so that the adapter
+        can be shared by several clients.
+
+        Parameters
+        ----------
+        adapter : :class:`requests.adapters.HTTPAdapter`
+            The adapter that this one replaces.
+
+        """
+        if self._pool_classes is not None:
+            return
+        self._pool_classes = dict(adapter.poolmanager.pool_classes_by_scheme)
+        self.poolmanager.clear()
+        self._set_pool_classes()
+
+    def _counting_pool_class(self, pool_class):
+        # Clients may bind extra arguments to their pool classes.
+        if isinstance(pool_class, functools.partial):
+            return functools.partial(
+                self._counting_pool_class(pool_class.func),
+                *pool_class.args, **pool_class.keywords)
+
+        adapter = self
+
+        class CountingConnectionPool(pool_class):
+
+            def _new_conn(self):
+                adapter.connections += 1
+                return super()._new_conn()
+
+        return CountingConnectionPool
+
+    def _check_cert(self, cert):
+        if isinstance(cert, (tuple, list)):
+            cert = cert[0]
+        if not cert:
+            return
+        try:
+            mtime = os.stat(cert).st_mtime
+        except OSError:
+            return
+        if self._cert_mtime is not None and mtime != self._cert_mtime:
+            self.poolmanager.clear()
+        self._cert_mtime = mtime
+
+    def send(self, request, cert=None, **kwargs):
+        self._check_cert(cert)
+        self.requests += 1
+        return super().send(request, cert=cert, **kwargs)
+
+    @property
+    def stats(self):
+        """Connection statistics.
+
+        Returns
+        -------
+        stats : dict
+            A dictionary with the number of ``requests`` that have been sent,
+            the number of new ``connections`` that had to be set up, and the
+            number of requests that reused a pooled connection
+            (``pool_hits``).
+
+        """
+        return {'requests': self.requests,
+                'connections': self.connections,
+                'pool_hits': max(self.requests - self.connections, 0)}